@@ -3,7 +3,7 @@ from django.urls import path
 from django.conf.urls.static import static
 
 from rest_framework.routers import DefaultRouter
-from mlplatform.core.views import JobViewSet
+from core.views import JobViewSet
 from .views import RegisterView, LoginView, ProfileView, ChangePasswordView, LogoutView
 
 # What is DefaultRouter?
@@ -1,5 +1,17 @@
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        # Connects the signals that drop blob references when datasets / jobs are deleted
+        from . import blobs  # noqa: F401
+
+        # Uploads are spooled here (core.uploads); Django's system checks
+        # refuse to start if it doesn't exist yet, e.g. on a fresh MEDIA_ROOT
+        if settings.FILE_UPLOAD_TEMP_DIR:
+            os.makedirs(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
@@ -0,0 +1,265 @@
+"""
+Content-addressed blob storage
+
+What it does:
+- Stores each distinct file content once, named by its SHA-256 and
+  sharded two levels deep so no directory holds more than a few entries:
+    blobs/ab/cd/abcdef0123...   (in default_storage)
+- Dataset files, image renditions and conversion outputs are all blobs,
+  so identical content is never stored twice
+- Counts references in Blob.ref_count: one per Dataset whose file is the
+  blob, one per Job and per JobResultCache entry whose result_data points
+  at it (their .artifacts). Deleting those rows drops their references
+  (signals below, connected in CoreConfig.ready)
+- collect_blobs() deletes blobs nobody has referenced for
+  BLOB_GC_GRACE_HOURS. The grace period also covers blobs a running job
+  has written but not reported yet.
+- Local files that must stay where they are (legacy dataset files being
+  moved over) are hard-linked into place, or reflinked / copied when the
+  filesystem can't link them
+"""
+
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Blob, Dataset, Job, JobResultCache
+from .uploads import INGEST_CHUNK_SIZE
+from .utils import LocalFile, StorageOutput
+
+BLOB_PREFIX = 'blobs'
+
+BLOB_NAME_RE = re.compile(rf'^{BLOB_PREFIX}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/([0-9a-f]{{64}})$')
+
+# ioctl that clones a file's extents (copy-on-write) on btrfs / XFS
+FICLONE = 0x40049409
+
+# Rows per UPDATE when changing reference counts
+REF_BATCH_SIZE = 500
+
+
+def blob_name(sha256):
+  return f"{BLOB_PREFIX}/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def blob_hash(name):
+  # The SHA-256 of a blob's storage name, or None for any other name
+  match = BLOB_NAME_RE.match(name or '')
+  return match.group(1) if match else None
+
+
+def hash_file(file_obj):
+  # (sha256, size) of a file, read in large chunks
+  digest = hashlib.sha256()
+  size = 0
+  file_obj.seek(0)
+  while True:
+    chunk = file_obj.read(INGEST_CHUNK_SIZE)
+    if not chunk:
+      break
+    digest.update(chunk)
+    size += len(chunk)
+  file_obj.seek(0)
+  return digest.hexdigest(), size
+
+
+def _local_path(name):
+  # Path of a storage name on local disk, or None if storage isn't local
+  try:
+    return default_storage.path(name)
+  except NotImplementedError:
+    return None
+
+
+def _reflink(source, target):
+  try:
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+      fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    return True
+  except OSError:
+    if os.path.exists(target):
+      os.remove(target)
+    return False
+
+
+def link_or_copy(source, target):
+  # Put source's content at target without moving source:
+  # hard link (same filesystem), else reflink, else a plain copy
+  # Goes through a temp name, so a half-copied file is never visible at target
+  os.makedirs(os.path.dirname(target), exist_ok=True)
+  temp = f"{target}.{uuid.uuid4().hex}.tmp"
+  try:
+    os.link(source, temp)
+  except OSError:
+    if not _reflink(source, temp):
+      shutil.copyfile(source, temp)
+  os.replace(temp, target)
+
+
+def put_blob(file_obj, sha256=None, size=None, refs=0, keep=False):
+  """
+    Store file_obj's content as a blob (unless it is already stored) and
+    return the blob's storage name. refs references are taken on it.
+
+    A file with a temporary_file_path is moved into place, or hard-linked
+    when keep=True (the caller still needs it). sha256 / size are computed
+    if not given.
+  """
+  if sha256 is None:
+    sha256, size = hash_file(file_obj)
+  name = blob_name(sha256)
+
+  with transaction.atomic():
+    # The row lock keeps two writers (or the collector) off the same blob
+    Blob.objects.select_for_update().get_or_create(sha256=sha256, defaults={'size': size})
+    if not default_storage.exists(name):
+      source = file_obj.temporary_file_path() if hasattr(file_obj, 'temporary_file_path') else None
+      target = _local_path(name)
+      if keep and source and target:
+        link_or_copy(source, target)
+      else:
+        saved = default_storage.save(name, file_obj)
+        if saved != name:
+          default_storage.delete(saved)
+          raise RuntimeError(f"Blob {sha256} could not be saved under its own name")
+    Blob.objects.filter(sha256=sha256).update(
+      ref_count=F('ref_count') + refs, updated_at=timezone.now()
+    )
+  return name
+
+
+class BlobOutput(StorageOutput):
+  # StorageOutput whose file ends up as a blob (.name is its blob name after the block)
+  #
+  # with BlobOutput() as output:
+  #   output.file.write(b'...')
+
+  def __init__(self, suffix=''):
+    super().__init__(f"output{suffix}")
+
+  def save(self):
+    return put_blob(LocalFile(self.file))
+
+
+def _change_refs(hashes, sign):
+  # One reference more (sign=1) or less (sign=-1) per occurrence in hashes
+  counts = Counter(sha256 for sha256 in hashes if sha256)
+  by_count = {}
+  for sha256, count in counts.items():
+    by_count.setdefault(count, []).append(sha256)
+
+  now = timezone.now()
+  for count, group in by_count.items():
+    for start in range(0, len(group), REF_BATCH_SIZE):
+      blobs = Blob.objects.filter(sha256__in=group[start:start + REF_BATCH_SIZE])
+      if sign < 0:
+        blobs = blobs.filter(ref_count__gte=count)
+      blobs.update(ref_count=F('ref_count') + sign * count, updated_at=now)
+
+
+def add_refs(hashes):
+  _change_refs(hashes, 1)
+
+
+def drop_refs(hashes):
+  _change_refs(hashes, -1)
+
+
+def result_blobs(result_data):
+  # SHA-256 of every blob a job result points at (anywhere in it)
+  found = set()
+  pending = [result_data]
+  while pending:
+    value = pending.pop()
+    if isinstance(value, dict):
+      pending.extend(value.values())
+    elif isinstance(value, (list, tuple)):
+      pending.extend(value)
+    elif isinstance(value, str):
+      sha256 = blob_hash(value)
+      if sha256:
+        found.add(sha256)
+  return found
+
+
+def hold_artifacts(rows, result_data):
+  # Make each row (a Job or JobResultCache queryset) hold a reference on exactly
+  # the blobs result_data points at: new ones are taken, ones an earlier result
+  # used are dropped. Recorded in .artifacts
+  hashes = result_blobs(result_data)
+  for pk, artifacts in rows.values_list('pk', 'artifacts'):
+    held = set(artifacts or [])
+    if held == hashes:
+      continue
+    add_refs(hashes - held)
+    drop_refs(held - hashes)
+    rows.model.objects.filter(pk=pk).update(artifacts=sorted(hashes))
+
+
+def collect_blobs(grace_hours=None):
+  # Delete blobs with no references for grace_hours; returns how many
+  grace_hours = settings.BLOB_GC_GRACE_HOURS if grace_hours is None else grace_hours
+  cutoff = timezone.now() - timedelta(hours=grace_hours)
+  unreferenced = Blob.objects.filter(ref_count=0, updated_at__lt=cutoff)
+
+  removed = 0
+  for sha256 in list(unreferenced.values_list('sha256', flat=True)):
+    with transaction.atomic():
+      # Checked again under the delete: a reference may have been taken meanwhile
+      deleted, _ = unreferenced.filter(sha256=sha256).delete()
+      if deleted:
+        default_storage.delete(blob_name(sha256))
+        removed += 1
+  return removed
+
+
+def move_file_to_blob(old_name):
+  """
+    Move a dataset file stored under the old datasets/%Y/%m/%d/ layout into
+    a blob. Every dataset using the old file is pointed at the blob, and
+    the old file is deleted. Returns the blob name.
+  """
+  sharing = Dataset.objects.filter(file=old_name)
+  with default_storage.open(old_name, 'rb') as old_file:
+    sha256, size = hash_file(old_file)
+    if _local_path(old_name):
+      # Hard link: the old file stays readable until every row points at the blob
+      name = put_blob(LocalFile(old_file), sha256, size, refs=sharing.count(), keep=True)
+    else:
+      name = put_blob(old_file, sha256, size, refs=sharing.count())
+
+  sharing.update(file=name, file_hash=sha256, size=size)
+  default_storage.delete(old_name)
+  return name
+
+
+@receiver(post_delete, sender=Dataset)
+def release_dataset_blob(sender, instance, **kwargs):
+  sha256 = blob_hash(instance.file.name)
+  if sha256:
+    drop_refs([sha256])
+
+
+@receiver(post_delete, sender=Job)
+def release_job_artifacts(sender, instance, **kwargs):
+  if instance.artifacts:
+    drop_refs(instance.artifacts)
+
+
+@receiver(post_delete, sender=JobResultCache)
+def release_cached_artifacts(sender, instance, **kwargs):
+  if instance.artifacts:
+    drop_refs(instance.artifacts)
@@ -0,0 +1,425 @@
+"""
+Columnar binary cache of CSV datasets
+
+What it does:
+- Parses a Dataset's CSV once and writes every column to its own files
+- Keyed by Dataset.file_hash, so identical uploads share one cache
+- Later tasks memory-map the columns instead of re-parsing text
+
+Layout (Arrow-style buffers, all little-endian):
+  COLUMNAR_CACHE_ROOT/<file_hash>/
+    schema.json      headers, row count, column types, validation summary
+    c<i>.offsets     int64[row_count + 1], where each value starts in c<i>.data
+    c<i>.data        the UTF-8 text of every value, back to back
+    c<i>.values      int64 / float64 / bool[row_count] for typed columns
+    c<i>.valid       bool[row_count], False where the value is blank
+
+Missing trailing fields are stored as empty values; extra fields are dropped
+(they are reported as malformed rows in the schema).
+"""
+
+import csv
+import json
+import os
+import shutil
+import uuid
+from array import array
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .profiling import DatasetProfile, infer_type
+from .row_index import RowIndexWriter
+from .utils import iter_csv_lines, current_memory_kb, file_lock
+
+SCHEMA_VERSION = 2 # 2: whitespace-only values are stored as they are
+
+# Rows handled per batch when reading columns back
+ROW_BATCH_SIZE = 10000
+
+# Bytes of values and offsets buffered across all columns while writing,
+# and the least any one column gets (wide CSVs go over the total)
+WRITE_BUFFER_BYTES = 32 * 1024 * 1024
+MIN_COLUMN_BUFFER_BYTES = 64 * 1024
+
+# How many malformed row numbers to keep in the schema
+MAX_REPORTED_BAD_ROWS = 20
+
+NUMPY_DTYPES = {
+  'integer': '<i8',
+  'float': '<f8',
+  'boolean': '?',
+}
+
+
+def cache_dir(file_hash):
+  return Path(settings.COLUMNAR_CACHE_ROOT) / file_hash
+
+
+def can_cache(dataset):
+  # Caches are keyed by file_hash, so a dataset without one never gets a cache
+  # (cache_dir('') would be the cache root itself)
+  return settings.COLUMNAR_CACHE_ENABLED and bool(dataset.file_hash)
+
+
+def _build_lock(file_hash):
+  # One builder per file_hash across all worker processes on this machine
+  return file_lock(settings.COLUMNAR_CACHE_ROOT, file_hash)
+
+
+class _ColumnWriter:
+  # Buffers one column's values and appends them to its offsets and data files
+  # The files are only open while a buffer is flushed, so a CSV with
+  # thousands of columns doesn't run out of file descriptors
+
+  def __init__(self, directory, index, buffer_bytes):
+    self.data_path = directory / f"c{index}.data"
+    self.offsets_path = directory / f"c{index}.offsets"
+    self.buffer_bytes = buffer_bytes
+    self.data = bytearray()
+    self.offsets = array('q', [0])
+    self.position = 0
+    self.type_counts = {'integer': 0, 'float': 0, 'boolean': 0, 'string': 0}
+    self.null_count = 0
+
+  def add(self, value):
+    # The text is kept as it is (whitespace too); only typing treats blank as null
+    if value and value.strip():
+      self.type_counts[infer_type(value)] += 1
+    else:
+      self.null_count += 1
+    if value:
+      encoded = value.encode('utf-8')
+      self.data += encoded
+      self.position += len(encoded)
+    self.offsets.append(self.position)
+    if len(self.data) + len(self.offsets) * self.offsets.itemsize >= self.buffer_bytes:
+      self.flush()
+
+  def flush(self):
+    # Also creates the files, so an empty column still has them
+    with open(self.data_path, 'ab') as data_file:
+      data_file.write(self.data)
+    with open(self.offsets_path, 'ab') as offsets_file:
+      self.offsets.tofile(offsets_file)
+    self.data = bytearray()
+    self.offsets = array('q')
+
+  @property
+  def inferred_type(self):
+    # Same rules as profiling.ColumnProfile.inferred_type
+    counts = self.type_counts
+    non_null = sum(counts.values())
+    if not non_null:
+      return 'empty'
+    if counts['string']:
+      return 'string'
+    if counts['boolean']:
+      return 'boolean' if counts['boolean'] == non_null else 'string'
+    if counts['float']:
+      return 'float'
+    return 'integer'
+
+
+class ColumnarWriter:
+  """
+  Streams CSV rows into a new cache directory.
+
+  Rows are written to a temporary directory that is renamed into place
+  by finish(), so readers never see a half-written cache.
+  """
+
+  def __init__(self, file_hash, headers):
+    self.file_hash = file_hash
+    self.headers = list(headers)
+    self.final_dir = cache_dir(file_hash)
+    self.temp_dir = self.final_dir.parent / f".{file_hash}.{uuid.uuid4().hex}"
+    self.temp_dir.mkdir(parents=True)
+    try:
+      buffer_bytes = max(WRITE_BUFFER_BYTES // max(len(self.headers), 1), MIN_COLUMN_BUFFER_BYTES)
+      self.columns = [_ColumnWriter(self.temp_dir, i, buffer_bytes) for i in range(len(self.headers))]
+    except BaseException:
+      shutil.rmtree(self.temp_dir, ignore_errors=True)
+      raise
+    self.row_count = 0
+    self.malformed_rows = 0
+    self.malformed_row_lines = []
+
+  def add_row(self, row, line_number=None):
+    self.row_count += 1
+    width = len(row)
+    if width != len(self.columns):
+      self.malformed_rows += 1
+      if line_number is not None and len(self.malformed_row_lines) < MAX_REPORTED_BAD_ROWS:
+        self.malformed_row_lines.append(line_number)
+    for index, column in enumerate(self.columns):
+      column.add(row[index] if index < width else '')
+
+  def abort(self):
+    shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+  def finish(self):
+    try:
+      return self._finish()
+    except BaseException:
+      self.abort()
+      raise
+
+  def _finish(self):
+    for column in self.columns:
+      column.flush()
+
+    column_schemas = []
+    for index, column in enumerate(self.columns):
+      column_type = column.inferred_type
+      if column_type in NUMPY_DTYPES:
+        column_type = self._write_typed_values(index, column_type)
+      column_schemas.append({
+        'name': self.headers[index],
+        'type': column_type,
+        'null_count': column.null_count,
+        'type_counts': column.type_counts,
+      })
+
+    schema = {
+      'version': SCHEMA_VERSION,
+      'file_hash': self.file_hash,
+      'row_count': self.row_count,
+      'headers': self.headers,
+      'columns': column_schemas,
+      'malformed_rows': self.malformed_rows,
+      'malformed_row_lines': self.malformed_row_lines,
+    }
+    with open(self.temp_dir / 'schema.json', 'w') as schema_file:
+      json.dump(schema, schema_file)
+
+    try:
+      os.replace(self.temp_dir, self.final_dir)
+    except OSError:
+      # Someone else finished the same cache first; theirs is identical
+      shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    return ColumnarDataset(self.final_dir)
+
+  def _write_typed_values(self, index, column_type):
+    # Second pass over one column's text to store it as numbers / booleans
+    column = _Column(self.temp_dir, index, {'type': 'string'}, self.row_count)
+    values_path = self.temp_dir / f"c{index}.values"
+    valid_path = self.temp_dir / f"c{index}.valid"
+
+    with open(values_path, 'wb') as values_file, open(valid_path, 'wb') as valid_file:
+      for batch in column.iter_strings():
+        valid = np.fromiter((_is_present(value) for value in batch), dtype='?', count=len(batch))
+        try:
+          values = _parse_batch(batch, column_type)
+        except OverflowError:
+          # Integers past int64: store the column as float instead
+          values_file.close()
+          valid_file.close()
+          return self._write_typed_values(index, 'float')
+        values.tofile(values_file)
+        valid.tofile(valid_file)
+
+    return column_type
+
+
+def _is_present(value):
+  # Blank (empty or whitespace-only) values are nulls once typed
+  return bool(value) and not value.isspace()
+
+
+def _parse_batch(batch, column_type):
+  if column_type == 'integer':
+    return np.array([int(value) if _is_present(value) else 0 for value in batch], dtype='<i8')
+  if column_type == 'float':
+    return np.array([float(value) if _is_present(value) else 0.0 for value in batch], dtype='<f8')
+  return np.array([value.strip().lower() == 'true' for value in batch], dtype='?')
+
+
+def _map(path, dtype, count):
+  # np.memmap refuses empty files, so hand back an empty array instead
+  if count == 0:
+    return np.empty(0, dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+
+class _Column:
+  # Read-only view of one cached column
+
+  def __init__(self, directory, index, schema, row_count):
+    self.name = schema.get('name')
+    self.type = schema['type']
+    self.schema = schema
+    self.row_count = row_count
+    self.offsets = _map(directory / f"c{index}.offsets", '<i8', row_count + 1)
+    data_path = directory / f"c{index}.data"
+    self.data = _map(data_path, 'u1', data_path.stat().st_size)
+
+    self.values = None
+    self.valid = None
+    if self.type in NUMPY_DTYPES:
+      self.values = _map(directory / f"c{index}.values", NUMPY_DTYPES[self.type], row_count)
+      self.valid = _map(directory / f"c{index}.valid", '?', row_count)
+
+  def iter_strings(self, batch_size=ROW_BATCH_SIZE):
+    # Yields lists of str, one batch of rows at a time
+    for start in range(0, self.row_count, batch_size):
+      yield self.strings(start, min(start + batch_size, self.row_count))
+
+  def iter_values(self, batch_size=ROW_BATCH_SIZE):
+    # Yields lists of typed Python values (None for empty), one batch at a time
+    for start in range(0, self.row_count, batch_size):
+      yield self.typed_values(start, min(start + batch_size, self.row_count))
+
+  def strings(self, start, stop):
+    # Rows start..stop as a list of str
+    offsets = self.offsets[start:stop + 1].tolist()
+    base = offsets[0]
+    chunk = self.data[base:offsets[-1]].tobytes()
+    return [
+      chunk[offsets[i] - base:offsets[i + 1] - base].decode('utf-8')
+      for i in range(stop - start)
+    ]
+
+  def typed_values(self, start, stop):
+    # Rows start..stop as a list of typed Python values (None for empty)
+    if self.values is None:
+      return [value if _is_present(value) else None for value in self.strings(start, stop)]
+    values = self.values[start:stop].tolist()
+    valid = self.valid[start:stop].tolist()
+    return [value if ok else None for value, ok in zip(values, valid)]
+
+
+class ColumnarDataset:
+  """
+  A built cache, opened read-only. Columns are memory-mapped on demand.
+  """
+
+  def __init__(self, directory):
+    self.directory = Path(directory)
+    with open(self.directory / 'schema.json') as schema_file:
+      self.schema = json.load(schema_file)
+    self.headers = self.schema['headers']
+    self.row_count = self.schema['row_count']
+
+  def column(self, index):
+    return _Column(self.directory, index, self.schema['columns'][index], self.row_count)
+
+  def iter_rows(self, typed=False, batch_size=ROW_BATCH_SIZE):
+    # Rebuild rows from the columns, a batch at a time
+    # typed=False gives the original strings, typed=True gives ints/floats/bools/None
+    # Columns are mapped one at a time for each batch: every np.memmap holds
+    # a file descriptor, so mapping all of a wide cache at once runs out of them
+    for start in range(0, self.row_count, batch_size):
+      stop = min(start + batch_size, self.row_count)
+      batches = []
+      for index in range(len(self.headers)):
+        column = self.column(index)
+        batches.append(column.typed_values(start, stop) if typed else column.strings(start, stop))
+      yield from zip(*batches)
+
+
+def load_columnar(dataset):
+  # Returns the ColumnarDataset for this dataset, or None if it isn't built yet
+  if not can_cache(dataset):
+    return None
+  directory = cache_dir(dataset.file_hash)
+  schema_path = directory / 'schema.json'
+  if not schema_path.exists():
+    return None
+  columnar = ColumnarDataset(directory)
+  if columnar.schema.get('version') != SCHEMA_VERSION:
+    return None
+  return columnar
+
+
+def build_columnar(dataset, on_progress=None):
+  """
+  Parse the dataset's CSV once and write its columnar cache.
+
+  on_progress(fraction) is called now and then with how much of the
+  file has been read. Returns (ColumnarDataset, peak_memory_kb).
+  """
+  if not dataset.file_hash:
+    raise ValueError(f"Dataset {dataset.id} has no file_hash to key its columnar cache by")
+  with _build_lock(dataset.file_hash):
+    # Another worker may have built it while we waited for the lock
+    existing = load_columnar(dataset)
+    if existing:
+      return existing, current_memory_kb()
+    # A cache from an older SCHEMA_VERSION would keep the new one from being renamed into place
+    shutil.rmtree(cache_dir(dataset.file_hash), ignore_errors=True)
+
+    file_path = dataset.file.name
+    total_bytes = dataset.size or default_storage.size(file_path) or 1
+    peak_memory_kb = current_memory_kb()
+
+    with default_storage.open(file_path, 'rb') as csv_file:
+      lines = iter_csv_lines(csv_file)
+      csv_reader = csv.reader(lines)
+      headers = next(csv_reader, None) or []
+      writer = ColumnarWriter(dataset.file_hash, headers)
+      try:
+        row_index = RowIndexWriter(lines) # the same pass indexes the CSV (core.row_index)
+        for row in csv_reader:
+          if not row:
+            continue
+          writer.add_row(row, csv_reader.line_num)
+          row_index.add_row()
+          if writer.row_count % ROW_BATCH_SIZE == 0:
+            peak_memory_kb = max(peak_memory_kb, current_memory_kb())
+            if on_progress:
+              on_progress(min(csv_file.tell() / total_bytes, 1))
+      except Exception:
+        writer.abort()
+        raise
+
+    columnar = writer.finish()
+    row_index.save(dataset.file_hash)
+    return columnar, max(peak_memory_kb, current_memory_kb())
+
+
+def get_or_build_columnar(dataset, on_progress=None):
+  # The cache if it exists, otherwise build it now (once per file_hash)
+  # Returns None when the cache is turned off or the dataset has no file_hash
+  if not can_cache(dataset):
+    return None
+  columnar = load_columnar(dataset)
+  if columnar:
+    return columnar
+  columnar, _ = build_columnar(dataset, on_progress)
+  return columnar
+
+
+def profile_columnar(columnar, on_progress=None, start=0, stop=None):
+  # Build a DatasetProfile of rows start..stop by scanning the cached columns
+  # one at a time; numeric stats are computed with numpy a batch at a time
+  # Types and null counts come straight from the schema. They cover whole
+  # columns, so only the range starting at row 0 carries them: profiles of
+  # the other ranges merge onto it without counting them twice
+  stop = columnar.row_count if stop is None else min(stop, columnar.row_count)
+  profile = DatasetProfile(columnar.headers)
+  profile.row_count = max(stop - start, 0)
+
+  for index, column_profile in enumerate(profile.columns):
+    column = columnar.column(index)
+    if start == 0:
+      column_profile.null_count = column.schema['null_count']
+      column_profile.type_counts = dict(column.schema['type_counts'])
+
+    for batch_start in range(start, stop, ROW_BATCH_SIZE):
+      batch_stop = min(batch_start + ROW_BATCH_SIZE, stop)
+      if column.type in ('integer', 'float'):
+        values = column.values[batch_start:batch_stop][column.valid[batch_start:batch_stop]]
+        column_profile.add_numbers(values.astype('<f8'))
+      for value in column.strings(batch_start, batch_stop):
+        if _is_present(value):
+          column_profile.distinct.add(value)
+          column_profile.top_values.add(value)
+
+    if on_progress:
+      on_progress((index + 1) / max(len(profile.columns), 1))
+
+  return profile
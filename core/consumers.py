@@ -18,22 +18,29 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 
+
+def user_jobs_group(user_id):
+  # Group that receives every job event for one user
+  # Tasks publish here through core.progress.ProgressReporter
+  return f"user_{user_id}_jobs"
+
+
 class JobConsumer(AsyncWebsocketConsumer):
   # Handles websockt connections for job status updates
 
   # Each user gets their own instance of this consumer
 
   async def connect(self):
-    self.user = self.scope['user']
+    self.user = self.scope.get('user') or AnonymousUser()
 
     # Check if user is authenticated
-    if isinstance(self, AnonymousUser):
+    if not self.user.is_authenticated:
       await self.close() # Dont allow unauthenticated users
       return 
 
     # Create group name based on user ID
     # This ensures each user only sees their own job updates
-    self.group_name = f"user_{self.user.id}_jobs"
+    self.group_name = user_jobs_group(self.user.id)
 
     # Add this connection to the group
     # Now this consumer will get all messages sent to this group
@@ -54,6 +61,9 @@ class JobConsumer(AsyncWebsocketConsumer):
 
   async def disconnect(self, close_code):
     # Remove from group so we dont send messages to offline users
+    # (rejected connections never joined one)
+    if not hasattr(self, 'group_name'):
+      return
     await self.channel_layer.group_discard(
       self.group_name,
       self.channel_name
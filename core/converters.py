@@ -0,0 +1,274 @@
+"""
+Streaming writers for convert_file_format
+
+Each writer takes the headers, an iterator of rows (lists of values)
+and a binary file handle, and writes rows as they arrive. Nothing is
+collected in memory, so peak memory does not depend on the file size.
+
+Every writer returns the number of rows it wrote (write_excel also
+returns the sheet count and rows per second).
+"""
+
+import json
+import time
+
+from .profiling import infer_type
+
+# Flush the text buffer to the file once it holds about this many characters
+WRITE_BUFFER_SIZE = 1024 * 1024 # 1 MB
+
+# Excel's hard limit per sheet (the header takes one of them on every sheet)
+EXCEL_MAX_ROWS = 1048576
+
+# Rows per Parquet row group / Arrow record batch
+ROW_GROUP_SIZE = 65536
+
+# Compression codecs each columnar format accepts (first one is the default)
+PARQUET_CODECS = ['snappy', 'zstd', 'gzip', 'lz4', 'brotli', 'none']
+FEATHER_CODECS = ['lz4', 'zstd', 'none']
+
+# Column types (as inferred by profiling / the columnar cache) -> Arrow type names
+ARROW_TYPES = {
+  'integer': 'int64',
+  'float': 'float64',
+  'boolean': 'bool_',
+  'string': 'string',
+  'empty': 'string',
+}
+
+# Integers outside this range don't fit an int64 column
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+
+def coerce_value(value):
+  # Turn one CSV string into int / float / bool / None (typed output without a cache)
+  if value is None or not value.strip():
+    return None
+  value_type = infer_type(value)
+  if value_type == 'integer':
+    return int(value)
+  if value_type == 'float':
+    return float(value)
+  if value_type == 'boolean':
+    return value.strip().lower() == 'true'
+  return value
+
+
+class _BufferedWriter:
+  # Collects small strings and writes them to the binary file in big UTF-8 chunks
+
+  def __init__(self, output_file):
+    self.output_file = output_file
+    self.parts = []
+    self.size = 0
+
+  def write(self, text):
+    self.parts.append(text)
+    self.size += len(text)
+    if self.size >= WRITE_BUFFER_SIZE:
+      self.flush()
+
+  def flush(self):
+    if self.parts:
+      self.output_file.write(''.join(self.parts).encode('utf-8'))
+      self.parts = []
+      self.size = 0
+
+
+def write_json(headers, rows, output_file):
+  # A JSON array of objects, laid out exactly like json.dumps(rows, indent=2)
+  writer = _BufferedWriter(output_file)
+  row_count = 0
+
+  writer.write('[')
+  for row in rows:
+    document = json.dumps(dict(zip(headers, row)), indent=2)
+    writer.write(',\n  ' if row_count else '\n  ')
+    writer.write(document.replace('\n', '\n  '))
+    row_count += 1
+  writer.write('\n]' if row_count else ']')
+
+  writer.flush()
+  return row_count
+
+
+def write_ndjson(headers, rows, output_file):
+  # Newline-delimited JSON: one compact object per line
+  writer = _BufferedWriter(output_file)
+  row_count = 0
+
+  for row in rows:
+    writer.write(json.dumps(dict(zip(headers, row)), separators=(',', ':')))
+    writer.write('\n')
+    row_count += 1
+
+  writer.flush()
+  return row_count
+
+
+def write_excel(headers, rows, output_file, max_rows_per_sheet=EXCEL_MAX_ROWS):
+  # Write-only workbook: rows are appended and streamed to a temp XML file
+  # by openpyxl instead of living in memory as cell objects
+  # Starts a new sheet (Sheet1, Sheet2, ...) when one reaches max_rows_per_sheet
+  # Returns (row_count, sheet_count, rows_per_second)
+  try:
+    import openpyxl
+  except ImportError:
+    raise ImportError("openpyxl not installed. Install with: pip install openpyxl")
+
+  started = time.monotonic()
+  workbook = openpyxl.Workbook(write_only=True)
+  sheet = None
+  sheet_count = 0
+  rows_in_sheet = max_rows_per_sheet # forces a sheet for the first row
+  row_count = 0
+
+  for row in rows:
+    if rows_in_sheet >= max_rows_per_sheet:
+      sheet_count += 1
+      sheet = workbook.create_sheet(title=f"Sheet{sheet_count}")
+      sheet.append(headers)
+      rows_in_sheet = 1
+    sheet.append(row)
+    rows_in_sheet += 1
+    row_count += 1
+
+  if sheet is None:
+    # Empty dataset: still produce a valid workbook with the headers
+    workbook.create_sheet(title='Sheet1').append(headers)
+    sheet_count = 1
+
+  workbook.save(output_file)
+
+  elapsed = time.monotonic() - started
+  rows_per_second = round(row_count / elapsed) if elapsed > 0 else row_count
+  return row_count, sheet_count, rows_per_second
+
+
+def _parse_typed(value, column_type):
+  if value is None or not value.strip():
+    return None
+  if column_type == 'integer':
+    return int(value)
+  if column_type == 'float':
+    return float(value)
+  if column_type == 'boolean':
+    return value.strip().lower() == 'true'
+  return value
+
+
+def infer_column_types(headers, rows):
+  # One streaming pass to find each column's type (used when there is no columnar cache)
+  type_sets = [set() for _ in headers]
+  for row in rows:
+    for index, value in enumerate(row[:len(headers)]):
+      if value and value.strip():
+        value_type = infer_type(value)
+        if value_type == 'integer' and len(value) > 18 and not INT64_MIN <= int(value) <= INT64_MAX:
+          value_type = 'float' # past int64: a float column, like the columnar cache does
+        type_sets[index].add(value_type)
+
+  column_types = []
+  for types in type_sets:
+    if not types:
+      column_types.append('empty')
+    elif types == {'integer'}:
+      column_types.append('integer')
+    elif types <= {'integer', 'float'}:
+      column_types.append('float')
+    elif types == {'boolean'}:
+      column_types.append('boolean')
+    else:
+      column_types.append('string')
+  return column_types
+
+
+def coerce_rows(rows, column_types):
+  # Convert string rows to the given column types, one row at a time
+  width = len(column_types)
+  for row in rows:
+    row = list(row[:width]) + [None] * (width - len(row))
+    yield [_parse_typed(value, column_types[i]) for i, value in enumerate(row)]
+
+
+def _arrow_batches(headers, rows, column_types, batch_size):
+  # Group typed rows into Arrow record batches of batch_size rows
+  import pyarrow as pa
+
+  schema = pa.schema([
+    pa.field(name, getattr(pa, ARROW_TYPES[column_type])())
+    for name, column_type in zip(headers, column_types)
+  ])
+
+  def batches():
+    buffer = []
+    for row in rows:
+      buffer.append(row)
+      if len(buffer) >= batch_size:
+        yield _to_batch(buffer, schema)
+        buffer = []
+    if buffer:
+      yield _to_batch(buffer, schema)
+
+  return schema, batches()
+
+
+def _to_batch(rows, schema):
+  import pyarrow as pa
+
+  columns = list(zip(*rows)) if rows else [[] for _ in schema]
+  arrays = [
+    pa.array(column, type=field.type)
+    for column, field in zip(columns, schema)
+  ]
+  return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _import_pyarrow():
+  try:
+    import pyarrow
+  except ImportError:
+    raise ImportError("pyarrow not installed. Install with: pip install pyarrow")
+  return pyarrow
+
+
+def write_parquet(headers, rows, output_file, column_types, compression=None,
+                  row_group_size=ROW_GROUP_SIZE):
+  # Parquet, written one row group at a time as rows stream in
+  # rows must already be typed to match column_types
+  _import_pyarrow()
+  import pyarrow.parquet as pq
+
+  compression = compression or PARQUET_CODECS[0]
+  if compression not in PARQUET_CODECS:
+    raise ValueError(f"Unsupported Parquet compression: {compression}")
+
+  schema, batches = _arrow_batches(headers, rows, column_types, row_group_size)
+  row_count = 0
+  with pq.ParquetWriter(output_file, schema, compression=compression) as writer:
+    for batch in batches:
+      writer.write_batch(batch, row_group_size=row_group_size)
+      row_count += batch.num_rows
+  return row_count
+
+
+def write_feather(headers, rows, output_file, column_types, compression=None,
+                  row_group_size=ROW_GROUP_SIZE):
+  # Feather v2 (Arrow IPC file), written one record batch at a time
+  # rows must already be typed to match column_types
+  pa = _import_pyarrow()
+
+  compression = compression or FEATHER_CODECS[0]
+  if compression not in FEATHER_CODECS:
+    raise ValueError(f"Unsupported Feather compression: {compression}")
+
+  options = pa.ipc.IpcWriteOptions(
+    compression=None if compression == 'none' else compression
+  )
+  schema, batches = _arrow_batches(headers, rows, column_types, row_group_size)
+  row_count = 0
+  with pa.ipc.new_file(output_file, schema, options=options) as writer:
+    for batch in batches:
+      writer.write_batch(batch)
+      row_count += batch.num_rows
+  return row_count
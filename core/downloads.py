@@ -0,0 +1,214 @@
+"""
+File downloads: dataset files and job outputs
+
+  GET /api/datasets/<id>/download/
+  GET /api/jobs/<id>/download/[?blob=<sha256>]  (?blob= when it has several)
+
+What it does:
+- Strong ETags: every stored file is a blob named by its SHA-256
+  (core.blobs), so the hash is the ETag. If-None-Match gets a 304,
+  If-Match a 412
+- Range requests (a single bytes=a-b / a- / -n range) get a 206 with just
+  those bytes, so clients can resume or fetch parts of large exports;
+  If-Range falls back to the whole file when the client's copy is stale
+- With DOWNLOAD_OFFLOAD set, only the headers are produced here and the
+  web server sends the bytes (and handles Range itself):
+  - 'x-accel-redirect': nginx, from an internal location at
+    DOWNLOAD_ACCEL_PREFIX that serves MEDIA_ROOT
+  - 'x-sendfile': Apache mod_xsendfile / lighttpd, from the file's path
+  so a large export doesn't keep a Python worker busy copying bytes
+- Otherwise the file is streamed in DOWNLOAD_CHUNK_SIZE reads
+
+Job outputs are the blobs the job holds (Job.artifacts), except the
+compressed payload of an offloaded result (core.result_store).
+"""
+
+import mimetypes
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header
+
+from .blobs import blob_hash, blob_name
+from .result_store import is_offloaded
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# File extension of an output format, where it isn't the format's own name
+OUTPUT_EXTENSIONS = {'excel': 'xlsx', 'feather': 'arrow', 'jpeg': 'jpg'}
+
+
+class RangeNotSatisfiable(Exception):
+  pass
+
+
+def parse_range(header, size):
+  """
+    (first, last) byte positions (inclusive) asked for by a Range header,
+    or None to send the whole file (no header, a syntax we don't handle or
+    several ranges). Raises RangeNotSatisfiable when it asks for nothing
+    inside the file.
+  """
+  match = RANGE_RE.match((header or '').strip())
+  if not match:
+    return None
+  first, last = match.groups()
+  if not first and not last:
+    return None
+
+  if not first:
+    # bytes=-n: the last n bytes
+    length = int(last)
+    if length == 0 or size == 0:
+      raise RangeNotSatisfiable()
+    return max(0, size - length), size - 1
+
+  first = int(first)
+  if last and int(last) < first:
+    return None # invalid, so ignored
+  if first >= size:
+    raise RangeNotSatisfiable()
+  return first, min(int(last), size - 1) if last else size - 1
+
+
+def _read_range(name, first, length):
+  with default_storage.open(name, 'rb') as stored:
+    stored.seek(first)
+    while length > 0:
+      chunk = stored.read(min(DOWNLOAD_CHUNK_SIZE, length))
+      if not chunk:
+        return
+      length -= len(chunk)
+      yield chunk
+
+
+def _offload_response(name):
+  # Headers-only response the web server fills in, or None to stream it here
+  mode = settings.DOWNLOAD_OFFLOAD
+  if mode == 'x-accel-redirect':
+    response = HttpResponse()
+    response['X-Accel-Redirect'] = settings.DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' + quote(name)
+    return response
+  if mode == 'x-sendfile':
+    try:
+      path = default_storage.path(name)
+    except NotImplementedError:
+      return None # not on local disk: nothing to hand over
+    response = HttpResponse()
+    response['X-Sendfile'] = path
+    return response
+  return None
+
+
+def serve_file(request, name, etag, filename, content_type=None):
+  """
+    Response that sends the storage file name to the client (see module
+    docstring). etag is the file's strong ETag (quoted) or None; filename
+    is what the client saves it as. Raises FileNotFoundError if the file
+    isn't in storage.
+  """
+  size = default_storage.size(name)
+  content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+  response = get_conditional_response(request, etag=etag) if etag else None
+  if response is None:
+    response = _offload_response(name)
+  if response is None:
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    # A Range only applies to the copy the client has (If-Range), if it says which
+    if not if_range or (etag and if_range == etag):
+      try:
+        byte_range = parse_range(request.headers.get('Range'), size)
+      except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    if byte_range is None:
+      response = FileResponse(default_storage.open(name, 'rb'), content_type=content_type)
+      response['Content-Length'] = size
+    else:
+      first, last = byte_range
+      response = StreamingHttpResponse(
+        _read_range(name, first, last - first + 1), status=206, content_type=content_type
+      )
+      response['Content-Range'] = f"bytes {first}-{last}/{size}"
+      response['Content-Length'] = last - first + 1
+    response['Accept-Ranges'] = 'bytes'
+
+  if response.status_code != 304:
+    response['Content-Type'] = content_type
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+  if etag:
+    response['ETag'] = etag
+  response['Cache-Control'] = 'private, no-cache'
+  return response
+
+
+def dataset_download(dataset):
+  # (storage name, ETag, filename) of a dataset's file
+  name = dataset.file.name
+  sha256 = blob_hash(name) or dataset.file_hash
+  filename = dataset.original_name or dataset.name or Path(name).name
+  return name, f'"{sha256}"' if sha256 else None, filename
+
+
+def _described_outputs(job, data, label='output', found=None):
+  # {sha256: filename} for the blobs result data names, with a file extension
+  # from the format next to them (convert: target_format, renditions: format)
+  found = {} if found is None else found
+  if isinstance(data, dict):
+    output_format = data.get('target_format') or data.get('format')
+    for key, value in data.items():
+      sha256 = blob_hash(value) if isinstance(value, str) else None
+      if sha256:
+        filename = f"job-{job.id}-{label}"
+        if isinstance(output_format, str):
+          output_format = output_format.lower()
+          filename += f".{OUTPUT_EXTENSIONS.get(output_format, output_format)}"
+        found.setdefault(sha256, filename)
+      else:
+        _described_outputs(job, value, key if isinstance(value, dict) else label, found)
+  elif isinstance(data, list):
+    for value in data:
+      _described_outputs(job, value, label, found)
+  return found
+
+
+def job_outputs(job):
+  """
+    {sha256: filename} of the files a job produced: the blobs it holds,
+    named after what its result says about them where it says something.
+  """
+  result_data = job.result_data
+  payload = None
+  if is_offloaded(result_data):
+    payload = blob_hash(result_data['offloaded']['path'])
+    result_data = result_data.get('summary')
+
+  described = _described_outputs(job, result_data)
+  return {
+    sha256: described.get(sha256, f"job-{job.id}-{sha256[:12]}")
+    for sha256 in job.artifacts or []
+    if sha256 != payload
+  }
+
+
+def job_download(job, sha256=None):
+  # (storage name, ETag, filename) of one of a job's outputs, or None if it has
+  # no such output. Without sha256 only a job with a single output has a default
+  outputs = job_outputs(job)
+  if sha256 is None and len(outputs) == 1:
+    sha256 = next(iter(outputs))
+  if sha256 not in outputs:
+    return None
+  return blob_name(sha256), f'"{sha256}"', outputs[sha256]
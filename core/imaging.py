@@ -0,0 +1,138 @@
+"""
+Image renditions for process_image
+
+The source image is decoded once and every rendition (size, format,
+quality) in settings.IMAGE_RENDITIONS is made from that one decode:
+
+- JPEGs are decoded with draft mode, so libjpeg scales them down by
+  1/2, 1/4 or 1/8 while decoding instead of producing the full-size
+  bitmap (a 24 MP photo needs ~70 MB as RGB; its 1/4 draft ~4 MB)
+- Renditions are made largest first, each one resized from the previous
+  one instead of from the original
+- Each rendition is encoded into an in-memory buffer and saved to
+  storage as a blob (see core.blobs), so identical renditions are
+  stored once
+"""
+
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from .blobs import put_blob
+
+# Decode at least this many times the biggest rendition before resizing
+# (same trade-off as Pillow's Image.thumbnail: keeps LANCZOS output sharp)
+DRAFT_REDUCING_GAP = 2
+
+# File extension and encoder options per output format
+FORMAT_OPTIONS = {
+  'JPEG': ('jpg', {'optimize': True}),
+  'WEBP': ('webp', {'method': 4}),
+  'PNG': ('png', {'optimize': True}),
+}
+
+# Modes each format can store as-is (others are converted to RGB first)
+FORMAT_MODES = {
+  'JPEG': ('RGB', 'L'),
+  'WEBP': ('RGB', 'RGBA'),
+  'PNG': ('RGB', 'RGBA', 'L', 'LA', 'P'),
+}
+
+
+def fit_size(size, box):
+  # Size of an image scaled down to fit inside box, keeping its aspect ratio
+  # (never scaled up, same rounding as Image.thumbnail)
+  width, height = size
+  max_width, max_height = box
+  scale = min(max_width / width, max_height / height, 1)
+  return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode_image(image, image_format, quality=None, progressive=False):
+  # Encode an image into bytes in the given format
+  image_format = image_format.upper()
+  if image_format not in FORMAT_OPTIONS:
+    raise ValueError(f"Unsupported rendition format: {image_format}")
+
+  extension, options = FORMAT_OPTIONS[image_format]
+  options = dict(options)
+  if quality is not None and image_format != 'PNG':
+    options['quality'] = quality
+  if progressive and image_format == 'JPEG':
+    options['progressive'] = True
+
+  if image.mode not in FORMAT_MODES[image_format]:
+    keep_alpha = 'A' in image.getbands() and 'RGBA' in FORMAT_MODES[image_format]
+    image = image.convert('RGBA' if keep_alpha else 'RGB')
+
+  buffer = io.BytesIO()
+  image.save(buffer, format=image_format, **options)
+  return buffer.getvalue(), extension
+
+
+def render_image(file_obj, renditions=None):
+  """
+    Decode an image once and save every rendition to storage as a blob.
+
+    Returns a dict:
+    {
+      'original_size': (w, h), 'decoded_size': (w, h), 'format': 'JPEG',
+      'renditions': {name: {'path', 'width', 'height', 'format', 'bytes'}}
+    }
+  """
+  from PIL import Image
+
+  renditions = renditions if renditions is not None else settings.IMAGE_RENDITIONS
+
+  image = Image.open(file_obj)
+  original_size = image.size
+  original_format = image.format
+
+  # Biggest first, so each rendition can be resized from the one before it
+  planned = sorted(
+    ((fit_size(original_size, rendition['size']), rendition) for rendition in renditions),
+    key=lambda item: item[0][0] * item[0][1],
+    reverse=True,
+  )
+
+  # JPEG: let the decoder scale down (only has an effect before load())
+  if planned and original_format == 'JPEG':
+    largest_width, largest_height = planned[0][0]
+    image.draft(None, (largest_width * DRAFT_REDUCING_GAP, largest_height * DRAFT_REDUCING_GAP))
+  image.load()
+  decoded_size = image.size
+
+  # Palette / 1-bit images would be resized with NEAREST, so expand them first
+  current = image
+  if current.mode in ('1', 'P'):
+    current = current.convert('RGBA' if 'transparency' in current.info else 'RGB')
+
+  results = {}
+  for target_size, rendition in planned:
+    if current.size != target_size:
+      current = current.resize(target_size, Image.Resampling.LANCZOS)
+
+    data, _ = encode_image(
+      current,
+      rendition.get('format', 'JPEG'),
+      quality = rendition.get('quality'),
+      progressive = rendition.get('progressive', False),
+    )
+    path = put_blob(ContentFile(data), hashlib.sha256(data).hexdigest(), len(data))
+    results[rendition['name']] = {
+      'path': path,
+      'width': target_size[0],
+      'height': target_size[1],
+      'format': rendition.get('format', 'JPEG').upper(),
+      'bytes': len(data),
+    }
+
+  image.close()
+  return {
+    'original_size': original_size,
+    'decoded_size': decoded_size,
+    'format': original_format,
+    'renditions': results,
+  }
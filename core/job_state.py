@@ -0,0 +1,246 @@
+"""
+Hot job state: live progress of running jobs, kept in Redis
+
+What it does:
+- ProgressReporter writes progress here instead of to Postgres (and
+  instead of the Celery result backend); Postgres is only written at
+  state changes: start, checkpoints, completion, failure, cancel
+- Each running task has one small hash, keyed by its Celery task id, which
+  the jobs coalesced into it share (Job.task_id), so they all read the
+  same one, even after the job that started the task is cancelled or deleted:
+    jobstate:<task id>  {progress, seq}
+  seq goes up on every write, so the status endpoint's ETag changes
+  with progress (see job_validators in core.views)
+- The status, retrieve and list endpoints lay the live progress over
+  what Postgres has (live_progress)
+- Written tasks are remembered in a "dirty" set; the flush_job_state task
+  copies their progress to their jobs in Postgres every JOB_STATE_FLUSH_SECONDS
+  (write-behind), so Postgres is never far behind if Redis is lost
+- If Redis can't be reached, progress goes straight to Postgres as before
+
+Backends (settings.JOB_STATE_URL):
+- redis://...  the Redis the broker and channel layer already use
+- memory://    a dict in this process, for tests and single-process setups
+Tests can also plug in any redis-py compatible client, e.g.
+set_store(RedisJobState(fakeredis.FakeRedis())).
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'jobstate:'
+DIRTY_KEY = 'jobstate:dirty'
+
+# Jobs written back to Postgres per flush round
+FLUSH_BATCH_SIZE = 1000
+
+# Statuses whose progress can still move (others are final in Postgres)
+LIVE_STATUSES = ('PENDING', 'PROCESSING')
+
+
+class MemoryJobState:
+  # Hot state in this process only (the same interface as RedisJobState)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._states = {}
+    self._dirty = set()
+
+  def set_progress(self, task_id, progress):
+    with self._lock:
+      state = self._states.setdefault(task_id, {'progress': 0, 'seq': 0})
+      state['progress'] = progress
+      state['seq'] += 1
+      self._dirty.add(task_id)
+
+  def add_progress(self, task_id, delta):
+    with self._lock:
+      state = self._states.setdefault(task_id, {'progress': 0, 'seq': 0})
+      state['progress'] += delta
+      state['seq'] += 1
+      self._dirty.add(task_id)
+
+  def read(self, task_ids):
+    with self._lock:
+      return {task_id: dict(self._states[task_id]) for task_id in task_ids if task_id in self._states}
+
+  def clear(self, task_id):
+    with self._lock:
+      self._states.pop(task_id, None)
+      self._dirty.discard(task_id)
+
+  def pop_dirty(self, count):
+    with self._lock:
+      popped = [self._dirty.pop() for _ in range(min(count, len(self._dirty)))]
+    return popped
+
+
+class RedisJobState:
+  # Hot state in Redis; client is a redis-py client (or anything compatible)
+
+  def __init__(self, client, ttl=None):
+    self.client = client
+    # Keys of jobs that stopped reporting (worker killed) don't stay forever
+    self.ttl = ttl or settings.JOB_STATE_TTL_SECONDS
+
+  def _write(self, task_id, field_op):
+    key = f"{KEY_PREFIX}{task_id}"
+    pipe = self.client.pipeline()
+    field_op(pipe, key)
+    pipe.hincrby(key, 'seq', 1)
+    pipe.expire(key, self.ttl)
+    pipe.sadd(DIRTY_KEY, task_id)
+    pipe.execute()
+
+  def set_progress(self, task_id, progress):
+    self._write(task_id, lambda pipe, key: pipe.hset(key, 'progress', progress))
+
+  def add_progress(self, task_id, delta):
+    self._write(task_id, lambda pipe, key: pipe.hincrby(key, 'progress', delta))
+
+  def read(self, task_ids):
+    task_ids = list(task_ids)
+    pipe = self.client.pipeline()
+    for task_id in task_ids:
+      pipe.hmget(f"{KEY_PREFIX}{task_id}", 'progress', 'seq')
+    states = {}
+    for task_id, (progress, seq) in zip(task_ids, pipe.execute()):
+      if progress is not None:
+        states[task_id] = {'progress': int(progress), 'seq': int(seq or 0)}
+    return states
+
+  def clear(self, task_id):
+    pipe = self.client.pipeline()
+    pipe.delete(f"{KEY_PREFIX}{task_id}")
+    pipe.srem(DIRTY_KEY, task_id)
+    pipe.execute()
+
+  def pop_dirty(self, count):
+    # SPOP is atomic: a task written again afterwards is simply dirty again
+    popped = self.client.spop(DIRTY_KEY, count) or []
+    return [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in popped]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+  global _store
+  with _store_lock:
+    if _store is None:
+      url = settings.JOB_STATE_URL
+      if url.startswith('memory://'):
+        _store = MemoryJobState()
+      else:
+        import redis
+        _store = RedisJobState(redis.Redis.from_url(url, socket_timeout=1))
+    return _store
+
+
+def set_store(store):
+  # Swap the backend (tests); None goes back to settings.JOB_STATE_URL
+  global _store
+  with _store_lock:
+    _store = store
+
+
+# ---- Used by ProgressReporter and the views ----
+# Errors are only logged: a broken Redis must never fail a task or a request
+# (the writers return False so the caller can write to Postgres instead)
+
+def write_progress(task_id, progress):
+  try:
+    get_store().set_progress(task_id, progress)
+    return True
+  except Exception as exc:
+    logger.warning(f"Could not write live progress for task {task_id}: {str(exc)}")
+    return False
+
+
+def add_progress(task_id, delta):
+  try:
+    get_store().add_progress(task_id, delta)
+    return True
+  except Exception as exc:
+    logger.warning(f"Could not add live progress for task {task_id}: {str(exc)}")
+    return False
+
+
+def clear_state(task_id):
+  try:
+    get_store().clear(task_id)
+  except Exception as exc:
+    logger.warning(f"Could not clear live state of task {task_id}: {str(exc)}")
+
+
+def read_states(task_ids):
+  # {task id: {'progress', 'seq'}} for the given running tasks
+  task_ids = set(task_ids)
+  if not task_ids:
+    return {}
+  try:
+    return get_store().read(task_ids)
+  except Exception as exc:
+    logger.warning(f"Could not read live job state: {str(exc)}")
+    return {}
+
+
+def state_key(job):
+  # The key of a job's hot state: the task it runs on (its own, or the
+  # one it is coalesced into). Empty for jobs without a task
+  if isinstance(job, dict):
+    return job.get('task_id')
+  return job.task_id
+
+
+def live_states(jobs):
+  # {job id: {'progress', 'seq'}} for jobs (Job objects or value dicts) still running
+  running = [
+    job for job in jobs
+    if (job['status'] if isinstance(job, dict) else job.status) in LIVE_STATUSES and state_key(job)
+  ]
+  states = read_states(state_key(job) for job in running)
+  live = {}
+  for job in running:
+    state = states.get(state_key(job))
+    if state:
+      live[job['id'] if isinstance(job, dict) else job.id] = state
+  return live
+
+
+def live_progress(jobs):
+  # {job id: progress} to show instead of Job.progress
+  return {job_id: state['progress'] for job_id, state in live_states(jobs).items()}
+
+
+def flush_progress():
+  """
+    Write-behind: copy the live progress of recently written tasks to
+    their jobs in Postgres. Only PROCESSING jobs are touched and progress
+    never moves backwards, so a job that finished meanwhile keeps its
+    final row. Returns how many tasks were flushed.
+  """
+  from .models import Job
+
+  store = get_store()
+  flushed = 0
+  while True:
+    task_ids = store.pop_dirty(FLUSH_BATCH_SIZE)
+    if not task_ids:
+      return flushed
+
+    by_progress = {}
+    for task_id, state in store.read(task_ids).items():
+      by_progress.setdefault(min(state['progress'], 100), []).append(task_id)
+
+    # A plain update(): the new progress was already visible, so no version bump
+    for progress, ids in by_progress.items():
+      Job.objects.filter(
+        task_id__in=ids, status='PROCESSING', progress__lt=progress,
+      ).update(progress=progress)
+    flushed += len(task_ids)
@@ -0,0 +1,40 @@
+"""
+WebSocket authentication with the same JWT access tokens the REST API uses
+
+Browsers can't set an Authorization header on a WebSocket, so the token
+is passed in the query string instead:
+
+  ws://server/ws/jobs/?token=<access token>
+
+If there is no valid token the user set by AuthMiddlewareStack
+(session login, or AnonymousUser) is left as it is.
+"""
+
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+
+@database_sync_to_async
+def get_user_from_token(raw_token):
+  authentication = JWTAuthentication()
+  try:
+    return authentication.get_user(authentication.get_validated_token(raw_token))
+  except (InvalidToken, TokenError, AuthenticationFailed):
+    return None
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+
+  async def __call__(self, scope, receive, send):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    token = query.get('token', [None])[0]
+    if token:
+      user = await get_user_from_token(token)
+      if user is not None:
+        scope['user'] = user
+    return await super().__call__(scope, receive, send)
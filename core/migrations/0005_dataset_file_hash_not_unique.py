@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-16 23:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dataset',
+            name='file_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-16 23:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_job_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='task_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+    ]
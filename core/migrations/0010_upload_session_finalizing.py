@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-16 23:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_job_task_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='ingest',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('ACTIVE', 'Active'), ('FINALIZING', 'Finalizing'), ('COMPLETED', 'Completed')], default='ACTIVE', max_length=20),
+        ),
+    ]
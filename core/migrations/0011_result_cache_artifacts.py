@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-16 23:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_upload_session_finalizing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobresultcache',
+            name='artifacts',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
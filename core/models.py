@@ -1,4 +1,10 @@
+import uuid
+
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 # Create your models here.
@@ -19,16 +25,35 @@ class Dataset(models.Model):
   original_name = models.CharField(max_length=512, blank=True)
   content_type = models.CharField(max_length=100, blank=True)
   size = models.PositiveBigIntegerField(null=True, blank=True)
-  file_hash = models.CharField(max_length=64, unique=True, blank=True)  # SHA-256 hex
+  # SHA-256 hex; new files are stored as the blob of that hash (see core.blobs)
+  file_hash = models.CharField(max_length=64, blank=True, db_index=True)
   image_width = models.PositiveIntegerField(null=True, blank=True)
   image_height = models.PositiveIntegerField(null=True, blank=True)
   uploaded_at = models.DateTimeField(auto_now_add=True)
   project = models.ForeignKey(Project, on_delete=models.CASCADE)
 
+  class Meta:
+    indexes = [
+      # Listing order (DatasetCursorPagination), per project
+      models.Index(fields=['project', '-uploaded_at', '-id'], name='dataset_project_uploaded_idx'),
+    ]
+
   def __str__(self):
     return self.name
   
 
+# Jobs whose task may still be running
+LIVE_STATUSES = ('PENDING', 'PROCESSING')
+
+
+class JobQuerySet(models.QuerySet):
+
+  def update_versioned(self, **fields):
+    # update() that also moves version / updated_at on, so clients polling
+    # the status endpoint see the change (its ETag / Last-Modified)
+    return self.update(version=F('version') + 1, updated_at=timezone.now(), **fields)
+
+
 class Job(models.Model):
   STATUS_CHOICES = [
     ('PENDING', 'Pending'),
@@ -42,10 +67,31 @@ class Job(models.Model):
   created_at = models.DateTimeField(auto_now_add=True)
   result_data = models.JSONField(null=True, blank=True)
   progress = models.IntegerField(default=0)  # percentage from 0 to 100
-  task_id = models.CharField(max_length=255, blank=True)
+  # The Celery task running the job; jobs coalesced into one share it (see core.job_state)
+  task_id = models.CharField(max_length=255, blank=True, db_index=True)
   error_message = models.TextField(blank=True)
+  job_type = models.CharField(max_length=50, blank=True)
+  params = models.JSONField(default=dict, blank=True)  # job options (target_format, ...)
+  # Identical jobs (same file content, type and params) share this key, see core.result_cache
+  cache_key = models.CharField(max_length=64, blank=True, db_index=True)
+  # Set when this job rides along on an identical job that was already running
+  coalesced_into = models.ForeignKey(
+    'self', null=True, blank=True, on_delete=models.SET_NULL, related_name='followers'
+  )
+  # SHA-256 of the blobs result_data points at; each one holds a reference (see core.blobs)
+  artifacts = models.JSONField(default=list, blank=True)
+  # Bumped on every state change (JobQuerySet.update_versioned), used for status ETags
+  version = models.PositiveIntegerField(default=0)
+  updated_at = models.DateTimeField(auto_now=True)
 
+  objects = JobQuerySet.as_manager()
 
+  class Meta:
+    indexes = [
+      # Listing order (JobCursorPagination), per project and per project + status
+      models.Index(fields=['project', '-created_at', '-id'], name='job_project_created_idx'),
+      models.Index(fields=['project', 'status', '-created_at', '-id'], name='job_project_status_idx'),
+    ]
 
   def __str__(self):
     return self.name
@@ -58,25 +104,130 @@ class Job(models.Model):
     
     1. Checks if job has task_id (was submitted to Celery)
     2. Checks if job is still PROCESSING
-    3. Gets the celery task using task_id
-    4. Kills it immediately with terminate=True
-    5. Updates job status to CANCELLED
+    3. Updates job status to CANCELLED
+    4. If other jobs (possibly other users') are coalesced onto the same task,
+       leaves the task running for them and makes one of them the leader
+    5. Otherwise gets the celery task using task_id and kills it
+       immediately with terminate=True
 
     Returns: True if  cancelled, False if couldnt cancel
     """
 
-    if self.task_id and self.status == 'PROCESSING':
+    if not self.task_id or self.status != 'PROCESSING':
+      return False
+
+    Job.objects.filter(id=self.id).update_versioned(status='CANCELLED')
+    self.status = 'CANCELLED'
+    if self.coalesced_into_id is None:
+      self.hand_over_task()
+
+    riders = Job.objects.filter(task_id=self.task_id, status__in=LIVE_STATUSES)
+    if not riders.exists():
       from mlplatform.celery import app
       celery_task = app.AsyncResult(self.task_id)
       celery_task.revoke(terminate=True)
-      self.status = 'CANCELLED'
-      self.save()
-      return True
-    return False
-  
-  
+    return True
 
-  
+  def hand_over_task(self):
+    # Make the oldest live job coalesced into this one the leader of the task
+    # (new identical jobs attach to leaders), before this job is cancelled or deleted.
+    # The task itself reports to every job with its task_id, so nothing else moves
+    followers = self.followers.filter(status__in=LIVE_STATUSES)
+    leader = followers.order_by('created_at', 'id').first()
+    if leader is None:
+      return None
+    followers.exclude(id=leader.id).update(coalesced_into=leader)
+    Job.objects.filter(id=leader.id).update(coalesced_into=None)
+    return leader
 
-  
 
+@receiver(pre_delete, sender=Job)
+def hand_over_deleted_task(sender, instance, **kwargs):
+  if instance.coalesced_into_id is None and instance.status in LIVE_STATUSES:
+    instance.hand_over_task()
+
+
+class Blob(models.Model):
+  """
+    A stored file content, saved once under blobs/<ab>/<cd>/<sha256>.
+    ref_count is the number of Datasets and Jobs using it; blobs left at
+    zero are deleted by collect_blobs. See core.blobs.
+  """
+  sha256 = models.CharField(max_length=64, primary_key=True)
+  size = models.PositiveBigIntegerField()
+  ref_count = models.PositiveIntegerField(default=0)
+  created_at = models.DateTimeField(auto_now_add=True)
+  updated_at = models.DateTimeField(auto_now_add=True, db_index=True)  # last reference change
+
+  def __str__(self):
+    return f"{self.sha256[:12]} ({self.ref_count} refs)"
+
+
+class JobResultCache(models.Model):
+  """
+    A finished job's result_data, keyed by what produced it:
+    sha256 of (file content hash, job type, normalized params, code version).
+    Looked up before a job is queued; see core.result_cache.
+  """
+  key = models.CharField(max_length=64, primary_key=True)
+  job_type = models.CharField(max_length=50)
+  result_data = models.JSONField()
+  size = models.PositiveIntegerField(default=0)  # bytes of result_data as JSON
+  hit_count = models.PositiveIntegerField(default=0)
+  created_at = models.DateTimeField(auto_now_add=True)
+  last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+  # SHA-256 of the blobs the result points at; the entry holds a reference on each (see core.blobs)
+  artifacts = models.JSONField(default=list, blank=True)
+
+  def __str__(self):
+    return f"{self.job_type} {self.key[:12]}"
+
+
+class UploadSession(models.Model):
+  """
+    A resumable upload: the client PUTs numbered chunks (in any order, in
+    parallel) into one part file, then finalizes it into a Dataset.
+    See core.uploads and UploadSessionViewSet.
+  """
+  STATUS_CHOICES = [
+    ('ACTIVE', 'Active'),
+    ('FINALIZING', 'Finalizing'), # claimed by one finalize request
+    ('COMPLETED', 'Completed'),
+  ]
+  id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+  owner = models.ForeignKey(User, on_delete=models.CASCADE)
+  project = models.ForeignKey(Project, on_delete=models.CASCADE)
+  name = models.CharField(max_length=255)
+  filename = models.CharField(max_length=512)
+  content_type = models.CharField(max_length=100, blank=True)
+  size = models.PositiveBigIntegerField()  # total bytes of the finished file
+  chunk_size = models.PositiveIntegerField()
+  sha256 = models.CharField(max_length=64, blank=True)  # expected hash, checked on finalize if given
+  status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='ACTIVE')
+  dataset = models.ForeignKey(Dataset, null=True, blank=True, on_delete=models.SET_NULL)
+  created_at = models.DateTimeField(auto_now_add=True)
+  # Ingest result of the whole file, saved by the process that hashed the chunks in order
+  ingest = models.JSONField(null=True, blank=True)
+
+  @property
+  def chunk_count(self):
+    return max(1, -(-self.size // self.chunk_size))
+
+  def chunk_length(self, index):
+    # Bytes chunk <index> must have (only the last one can be shorter)
+    return min(self.chunk_size, self.size - index * self.chunk_size)
+
+  def __str__(self):
+    return f"{self.filename} ({self.status})"
+
+
+class UploadChunk(models.Model):
+  # One received chunk of an UploadSession
+  session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='chunks')
+  index = models.PositiveIntegerField()
+  received_at = models.DateTimeField(auto_now_add=True)
+
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['session', 'index'], name='unique_upload_chunk'),
+    ]
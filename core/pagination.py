@@ -0,0 +1,54 @@
+"""
+Listing helpers for the job and dataset endpoints
+
+What it does:
+- Cursor (keyset) pagination newest first: each page is fetched with
+  WHERE created_at < <cursor> ORDER BY created_at DESC LIMIT n, which the
+  (project, ..., created_at, id) indexes answer without counting or
+  skipping rows, so page 1000 costs the same as page 1
+- Limit/offset pages of a dataset's CSV rows, read through its row-offset
+  index (core.row_index) so any page costs the same to fetch
+- ?fields=id,status,progress sparse fieldsets: the serializer only
+  returns those fields and the queryset only loads those columns, so
+  large ones like Job.result_data stay in the database
+"""
+
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class JobCursorPagination(CursorPagination):
+  ordering = ('-created_at', '-id')
+  page_size = 50
+  page_size_query_param = 'page_size'
+  max_page_size = 500
+
+
+class DatasetCursorPagination(JobCursorPagination):
+  ordering = ('-uploaded_at', '-id')
+
+
+class DatasetRowPagination(LimitOffsetPagination):
+  # ?offset=1000000&limit=100 over a RowIndex
+  default_limit = 100
+  max_limit = 1000
+
+
+def requested_fields(request):
+  # Field names asked for with ?fields=a,b on a GET, or None for all of them
+  if request is None or request.method != 'GET':
+    return None
+  value = request.query_params.get('fields')
+  if not value:
+    return None
+  return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def only_requested(queryset, request, ordering=(), always=()):
+  # Load only the requested columns (plus the primary key, the ordering
+  # fields and the always columns the view itself needs)
+  requested = requested_fields(request)
+  if requested is None:
+    return queryset
+  columns = {field.name for field in queryset.model._meta.concrete_fields}
+  ordering = {name.lstrip('-') for name in ordering}
+  return queryset.only(*((requested & columns) | ordering | set(always) | {'id'}))
@@ -0,0 +1,139 @@
+"""
+Long-poll mode of the job status endpoint
+
+  GET /api/jobs/<id>/status/?wait=<seconds>
+  If-None-Match: <ETag from the previous response>
+
+What it does:
+- Answers straight away (through JobViewSet.status) when the client has
+  no ETag yet or its ETag is already out of date
+- Otherwise holds the request until the job changes (its version, or its
+  live progress in core.job_state), or the wait (at most
+  JOB_STATUS_MAX_WAIT_SECONDS) runs out:
+  - listens on the job owner's channel layer group, where
+    ProgressReporter publishes every job event (core.consumers.user_jobs_group)
+  - re-reads the version every JOB_STATUS_RECHECK_SECONDS as well, for
+    changes that aren't published (e.g. cancel) or a missing channel layer
+- Then returns the new status (200), or 304 if nothing changed
+
+This is an async Django view, so under ASGI (daphne) a waiting client
+doesn't hold a worker thread. DRF views can't be async, so the user is
+authenticated here with the REST_FRAMEWORK authentication classes, and
+every request without ?wait is handed to JobViewSet.status unchanged.
+"""
+
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .consumers import user_jobs_group
+from .models import Job
+from .views import JobViewSet, job_status_state, job_validators
+
+status_view = JobViewSet.as_view({'get': 'status'})
+
+
+def _wait_seconds(request):
+  try:
+    wait = float(request.GET.get('wait', 0))
+  except ValueError:
+    return 0
+  return max(0, min(wait, settings.JOB_STATUS_MAX_WAIT_SECONDS))
+
+
+def _authenticate(request):
+  # The API user, or None (JobViewSet.status then gives the proper 401)
+  drf_request = Request(
+    request, authenticators=[authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+  )
+  try:
+    user = drf_request.user
+  except APIException:
+    return None
+  return user if user and user.is_authenticated else None
+
+
+def _job_state(user, pk):
+  return job_status_state(Job.objects.filter(project__owner=user), pk)
+
+
+def _changed(latest, state):
+  # Deleted, moved to a new state in Postgres, or live progress written
+  return latest is None or (latest['version'], latest['seq']) != (state['version'], state['seq'])
+
+
+async def _next_event(channel_layer, channel, job_id):
+  # Events about the user's other jobs arrive here too: skip them
+  while True:
+    event = await channel_layer.receive(channel)
+    if event.get('message', {}).get('job_id') == job_id:
+      return event
+
+
+async def _wait_for_change(user, state, wait):
+  """
+    The job's state once it differs from state (see _changed), or its
+    unchanged state when wait seconds have passed (None if it was deleted).
+  """
+  deadline = time.monotonic() + wait
+  group_name = user_jobs_group(user.id)
+  channel_layer = get_channel_layer()
+  channel = None
+  if channel_layer is not None:
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add(group_name, channel)
+
+  try:
+    while True:
+      # Read after subscribing, so a change in between isn't missed
+      latest = await sync_to_async(_job_state)(user, state['id'])
+      if _changed(latest, state):
+        return latest
+
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return latest
+      timeout = min(remaining, settings.JOB_STATUS_RECHECK_SECONDS)
+
+      if channel is None:
+        await asyncio.sleep(timeout)
+        continue
+      try:
+        await asyncio.wait_for(_next_event(channel_layer, channel, state['id']), timeout)
+      except asyncio.TimeoutError:
+        pass
+  finally:
+    if channel is not None:
+      await channel_layer.group_discard(group_name, channel)
+
+
+async def job_status(request, pk):
+  wait = _wait_seconds(request)
+  if not wait or request.method != 'GET':
+    return await sync_to_async(status_view)(request, pk=pk)
+
+  user = await sync_to_async(_authenticate)(request)
+  state = await sync_to_async(_job_state)(user, pk) if user else None
+  # Unknown job, no valid login or a client that is behind: answer normally
+  if state is None or get_conditional_response(request, etag=job_validators(state)[0]) is None:
+    return await sync_to_async(status_view)(request, pk=pk)
+
+  latest = await _wait_for_change(user, state, wait)
+  if _changed(latest, state):
+    return await sync_to_async(status_view)(request, pk=pk)
+
+  # Nothing changed while we waited
+  etag, last_modified = job_validators(latest)
+  response = get_conditional_response(request, etag=etag)
+  response['ETag'] = etag
+  response['Last-Modified'] = http_date(last_modified)
+  response['Cache-Control'] = 'private, no-cache'
+  return response
@@ -0,0 +1,167 @@
+"""
+Throttled job progress reporting shared by the tasks in core/tasks.py
+
+What it does:
+- Writes progress to the hot job-state store (core.job_state, Redis)
+  rather than to Postgres; Postgres gets it from the write-behind flush
+- Writes Postgres only at state changes (start, checkpoints, completion,
+  failure), and only the fields that changed (UPDATE ... SET status = ...)
+  instead of job.save(), which rewrites the whole row including result_data
+- Rate-limits progress writes per job: at most one every
+  JOB_PROGRESS_MIN_INTERVAL_MS, and only once progress has moved by
+  JOB_PROGRESS_MIN_DELTA percent
+- Every Postgres write bumps Job.version, which the status endpoint's
+  ETag and long-poll mode watch (live progress moves the ETag too)
+- Pushes every write to the job owner's WebSocket group
+  (job_update / job_completed / job_failed, see core.consumers)
+- Applies every write to identical jobs coalesced into this one (every
+  job with the task's Job.task_id, whoever owns it, except cancelled
+  ones), and caches the final result (core.result_cache)
+- Stores big results compressed outside the job row (core.result_store)
+- Takes a reference for each job on the blobs its results point at
+  (core.blobs), so they aren't collected while the job exists
+
+Tasks can call update() as often as they like (every few thousand rows);
+the database only sees a handful of writes per job.
+"""
+
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Q
+
+from .blobs import hold_artifacts
+from .consumers import user_jobs_group
+from .job_state import clear_state, write_progress
+from .models import Job
+from .result_cache import store_result
+from .result_store import pack_result
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressReporter:
+
+  def __init__(self, task, job_id, task_id=None):
+    # task is the bound Celery task (for its task id), or None; tasks that
+    # work for another task's job (chord steps) pass that task's id instead
+    self.task = task
+    self.job_id = job_id
+    if task_id is None and task is not None:
+      task_id = task.request.id
+    if task_id is None:
+      task_id = Job.objects.filter(id=job_id).values_list('task_id', flat=True).first()
+    self.task_id = task_id or None
+    self.progress = 0
+    self._written_progress = 0
+    self._written_at = 0.0
+    self.min_interval = settings.JOB_PROGRESS_MIN_INTERVAL_MS / 1000
+    self.min_delta = settings.JOB_PROGRESS_MIN_DELTA
+
+  def jobs(self):
+    # This job plus the identical jobs riding along on its task (unless they
+    # were cancelled, this one included: the task may run on for the others)
+    jobs = Q(id=self.job_id)
+    if self.task_id:
+      jobs |= Q(task_id=self.task_id)
+    return Job.objects.filter(jobs).exclude(status='CANCELLED')
+
+  def _write(self, **fields):
+    if not self.jobs().update_versioned(**fields):
+      raise Job.DoesNotExist(f"Job {self.job_id} does not exist")
+
+  def _publish(self, event_type, **message):
+    # Push an event to each job owner's WebSocket group
+    # A broken channel layer must never fail the task, so errors are only logged
+    try:
+      channel_layer = get_channel_layer()
+      if channel_layer is None:
+        return
+      # Looked up every time: followers can attach while the task runs
+      for job_id, owner_id in self.jobs().values_list('id', 'project__owner_id'):
+        async_to_sync(channel_layer.group_send)(
+          user_jobs_group(owner_id),
+          {'type': event_type, 'message': {'job_id': job_id, **message}},
+        )
+    except Exception as exc:
+      logger.warning(f"Could not publish {event_type} for job {self.job_id}: {str(exc)}")
+
+  def _clear_state(self):
+    if self.task_id:
+      clear_state(self.task_id)
+
+  def start(self):
+    # Mark the job PROCESSING and remember which Celery task is running it
+    fields = {'status': 'PROCESSING', 'progress': 0}
+    if self.task is not None:
+      fields['task_id'] = self.task.request.id
+    self._write(**fields)
+    if self.task_id:
+      write_progress(self.task_id, 0) # also resets what a failed earlier try left behind
+    self.progress = self._written_progress = 0
+    self._written_at = time.monotonic()
+    self._publish('job_update', status='PROCESSING', progress=0)
+
+  def update(self, progress, force=False):
+    # Record new progress; it is only written if the throttle allows it
+    progress = int(progress)
+    if progress <= self.progress:
+      return # never move backwards
+    self.progress = progress
+
+    if not force:
+      too_soon = time.monotonic() - self._written_at < self.min_interval
+      too_small = progress - self._written_progress < self.min_delta
+      if too_soon or too_small:
+        return
+    self.flush()
+
+  def flush(self):
+    # Write pending progress now, if there is any
+    if self.progress == self._written_progress:
+      return
+    if not self.task_id or not write_progress(self.task_id, self.progress):
+      self._write(progress=self.progress) # Redis is down: Postgres it is
+    self._written_progress = self.progress
+    self._written_at = time.monotonic()
+    self._publish('job_update', status='PROCESSING', progress=self.progress)
+
+  def callback(self, start, end):
+    # on_progress(fraction) for helpers that report 0..1, mapped onto start..end%
+    def on_progress(fraction):
+      self.update(start + (end - start) * fraction)
+    return on_progress
+
+  def checkpoint(self, progress, result_data):
+    # Save partial results (e.g. finished pipeline steps) while the job keeps running
+    self.progress = max(self.progress, int(progress))
+    packed = pack_result(result_data)
+    self._write(progress=self.progress, result_data=packed)
+    if self.task_id:
+      write_progress(self.task_id, self.progress)
+    # The blobs inside an offloaded result too, not just the payload itself
+    hold_artifacts(self.jobs(), [result_data, packed])
+    self._written_progress = self.progress
+    self._written_at = time.monotonic()
+    self._publish('job_update', status='PROCESSING', progress=self.progress)
+
+  def complete(self, result_data):
+    self.progress = 100
+    packed = pack_result(result_data)
+    self._write(status='COMPLETED', progress=100, result_data=packed)
+    self._clear_state()
+    hold_artifacts(self.jobs(), [result_data, packed])
+    self._publish('job_completed', status='COMPLETED', progress=100)
+
+    # Any of the jobs will do (this one may have been cancelled or deleted meanwhile)
+    job = self.jobs().exclude(cache_key='').values('cache_key', 'job_type').first()
+    if job and job['cache_key']:
+      store_result(job['cache_key'], job['job_type'], result_data, packed)
+
+  def fail(self, message):
+    self.jobs().update_versioned(status='FAILED', error_message=message)
+    self._clear_state()
+    self._publish('job_failed', status='FAILED', progress=self.progress, error_message=message)
@@ -0,0 +1,170 @@
+"""
+Job result cache and in-flight coalescing
+
+What it does:
+- Gives every job a cache key: sha256 of (dataset file_hash, job type,
+  normalized params, code version). Two jobs with the same key would
+  produce the same result, whichever dataset row they were submitted on.
+- Remembers finished results in JobResultCache, so a repeat submission
+  completes immediately without reparsing the file
+- Lets JobViewSet attach a repeat submission to an identical job that is
+  still PENDING / PROCESSING instead of running it twice (Job.coalesced_into)
+- Evicts entries older than RESULT_CACHE_MAX_AGE_DAYS, then the least
+  recently used ones until the cache fits in RESULT_CACHE_MAX_BYTES
+- Every entry holds a reference on the blobs its result points at
+  (JobResultCache.artifacts), so collect_blobs() can't delete them from
+  under a cache hit; evicting the entry drops them
+
+Bump a job type's version in CACHEABLE_JOB_TYPES whenever its task
+starts producing different results, so old entries stop matching.
+"""
+
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .blobs import hold_artifacts, result_blobs
+from .converters import FEATHER_CODECS, PARQUET_CODECS
+from .models import Blob, JobResultCache
+from .result_store import pack_result, result_exists
+
+logger = logging.getLogger(__name__)
+
+# Job types whose results are cached -> code version of their task
+CACHEABLE_JOB_TYPES = {
+  'generate_statistics': 1,
+  'convert_file_format': 1,
+}
+
+# Default codec per columnar target format (same as the task uses)
+DEFAULT_CODECS = {
+  'parquet': PARQUET_CODECS[0],
+  'feather': FEATHER_CODECS[0],
+}
+
+
+def normalize_params(job_type, params):
+  # Only the options that change the result, with defaults filled in,
+  # so {"target_format": "parquet"} and {..., "compression": "snappy"} match
+  if job_type != 'convert_file_format':
+    return {}
+
+  target_format = params.get('target_format')
+  normalized = {
+    'target_format': target_format,
+    'typed_values': bool(params.get('typed_values', False)),
+  }
+  if target_format in DEFAULT_CODECS:
+    normalized['compression'] = params.get('compression') or DEFAULT_CODECS[target_format]
+  return normalized
+
+
+def result_cache_key(file_hash, job_type, params):
+  # None when the job can't be cached (unknown content or job type)
+  if not settings.RESULT_CACHE_ENABLED:
+    return None
+  if not file_hash or job_type not in CACHEABLE_JOB_TYPES:
+    return None
+
+  identity = [file_hash, job_type, normalize_params(job_type, params), CACHEABLE_JOB_TYPES[job_type]]
+  return hashlib.sha256(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _still_valid(result_data):
+  # A conversion result is only useful while its output file exists,
+  # an offloaded result while its payload does
+  output_path = result_data.get('output_path') if isinstance(result_data, dict) else None
+  if output_path and not default_storage.exists(output_path):
+    return False
+  return result_exists(result_data)
+
+
+def lookup_results(keys):
+  # {key: result_data} for every key that has a usable cached result
+  keys = [key for key in keys if key]
+  if not keys:
+    return {}
+
+  entries = [
+    (entry, result_blobs(entry.result_data)) for entry in JobResultCache.objects.filter(key__in=keys)
+  ]
+  # A hit takes references on its blobs, which is a no-op for blobs that are gone
+  stored = set(Blob.objects.filter(
+    sha256__in={sha256 for _, hashes in entries for sha256 in hashes}
+  ).values_list('sha256', flat=True))
+
+  hits = {}
+  stale = []
+  for entry, hashes in entries:
+    if hashes <= stored and _still_valid(entry.result_data):
+      hits[entry.key] = entry.result_data
+    else:
+      stale.append(entry.key)
+
+  if stale:
+    JobResultCache.objects.filter(key__in=stale).delete()
+  if hits:
+    JobResultCache.objects.filter(key__in=list(hits)).update(
+      hit_count=F('hit_count') + 1, last_used_at=timezone.now()
+    )
+  return hits
+
+
+def store_result(key, job_type, result_data, packed=None):
+  # Remember a finished job's result (errors are only logged: caching is best effort)
+  # packed: result_data already through pack_result, if the caller has it
+  if not key or not settings.RESULT_CACHE_ENABLED:
+    return
+  try:
+    if packed is None:
+      packed = pack_result(result_data) # big results are cached as a pointer
+    size = len(json.dumps(packed).encode('utf-8'))
+    if size > settings.RESULT_CACHE_MAX_BYTES:
+      return # would evict everything else
+    with transaction.atomic():
+      JobResultCache.objects.update_or_create(
+        key=key,
+        defaults={
+          'job_type': job_type,
+          'result_data': packed,
+          'size': size,
+          'last_used_at': timezone.now(),
+        },
+      )
+      # The blobs inside an offloaded result too, not just the payload itself
+      hold_artifacts(JobResultCache.objects.select_for_update().filter(key=key), [result_data, packed])
+  except Exception as exc:
+    logger.warning(f"Could not cache result for key {key}: {str(exc)}")
+
+
+def evict_results(max_bytes=None, max_age_days=None):
+  # Drop expired entries, then least recently used ones until under max_bytes
+  # Returns how many entries were removed
+  max_bytes = settings.RESULT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+  max_age_days = settings.RESULT_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+
+  cutoff = timezone.now() - timedelta(days=max_age_days)
+  removed, _ = JobResultCache.objects.filter(last_used_at__lt=cutoff).delete()
+
+  total = JobResultCache.objects.aggregate(total=Sum('size'))['total'] or 0
+  if total <= max_bytes:
+    return removed
+
+  evict = []
+  for key, size in JobResultCache.objects.order_by('last_used_at').values_list('key', 'size').iterator():
+    if total <= max_bytes:
+      break
+    evict.append(key)
+    total -= size
+
+  for start in range(0, len(evict), 500):
+    deleted, _ = JobResultCache.objects.filter(key__in=evict[start:start + 500]).delete()
+    removed += deleted
+  return removed
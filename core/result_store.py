@@ -0,0 +1,131 @@
+"""
+Large job results, stored compressed outside the Job row
+
+What it does:
+- A result whose JSON is bigger than RESULT_OFFLOAD_BYTES (statistics of
+  wide datasets, batch image rows, ...) is compressed (RESULT_OFFLOAD_COMPRESSION:
+  gzip, or zstd when zstandard is installed) and saved as a blob (core.blobs)
+- Job.result_data then only holds a summary (the small top-level values,
+  like row_count) and a pointer:
+    {
+      "summary": {"row_count": 1000000, "column_count": 2400, ...},
+      "offloaded": {"path": "blobs/ab/cd/...", "encoding": "gzip",
+                    "bytes": 48213377, "stored_bytes": 5120331}
+    }
+  so job rows stay small to write, list and cache
+- JobViewSet.results streams the payload back, decompressed on the fly
+  (iter_result_json), without loading it all into memory
+
+Smaller results are stored in result_data as they are.
+"""
+
+import gzip
+import json
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .blobs import put_blob
+
+# Summary values bigger than this (as JSON) are left out of the summary
+SUMMARY_VALUE_BYTES = 256
+
+# Read size when streaming a payload back
+STREAM_CHUNK_SIZE = 256 * 1024
+
+logger = logging.getLogger(__name__)
+
+# Whether the "zstd configured but not installed" warning was logged already
+_zstd_warned = False
+
+
+def _import_zstandard():
+  try:
+    import zstandard
+  except ImportError:
+    raise ImportError("zstandard not installed. Install with: pip install zstandard")
+  return zstandard
+
+
+def _compress(data):
+  # (compressed bytes, encoding name)
+  global _zstd_warned
+  if settings.RESULT_OFFLOAD_COMPRESSION == 'zstd':
+    try:
+      zstandard = _import_zstandard()
+    except ImportError as exc:
+      if not _zstd_warned:
+        logger.warning(f"RESULT_OFFLOAD_COMPRESSION is 'zstd' but {exc}; using gzip")
+        _zstd_warned = True
+    else:
+      return zstandard.ZstdCompressor(level=3).compress(data), 'zstd'
+  return gzip.compress(data, compresslevel=6), 'gzip'
+
+
+def is_offloaded(result_data):
+  return isinstance(result_data, dict) and isinstance(result_data.get('offloaded'), dict)
+
+
+def summarize(result_data):
+  # The small top-level values of a result (counts, flags, formats)
+  summary = {}
+  if isinstance(result_data, dict):
+    for key, value in result_data.items():
+      if isinstance(value, (dict, list)):
+        continue
+      if len(json.dumps(value)) <= SUMMARY_VALUE_BYTES:
+        summary[key] = value
+  return summary
+
+
+def pack_result(result_data):
+  # What to store in Job.result_data: the result itself, or summary + pointer if it is big
+  if result_data is None or is_offloaded(result_data):
+    return result_data
+  data = json.dumps(result_data).encode('utf-8')
+  if len(data) <= settings.RESULT_OFFLOAD_BYTES:
+    return result_data
+
+  compressed, encoding = _compress(data)
+  return {
+    'summary': summarize(result_data),
+    'offloaded': {
+      'path': put_blob(ContentFile(compressed)),
+      'encoding': encoding,
+      'bytes': len(data),
+      'stored_bytes': len(compressed),
+    },
+  }
+
+
+def iter_result_json(result_data):
+  # The full result as JSON bytes, in chunks (decompressed from storage if offloaded)
+  if not is_offloaded(result_data):
+    yield json.dumps(result_data).encode('utf-8')
+    return
+
+  pointer = result_data['offloaded']
+  with default_storage.open(pointer['path'], 'rb') as stored:
+    if pointer['encoding'] == 'zstd':
+      yield from _import_zstandard().ZstdDecompressor().read_to_iter(stored, read_size=STREAM_CHUNK_SIZE)
+      return
+    with gzip.GzipFile(fileobj=stored) as decompressed:
+      while True:
+        chunk = decompressed.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+          return
+        yield chunk
+
+
+def unpack_result(result_data):
+  # The full result as a dict (loads an offloaded payload into memory)
+  if not is_offloaded(result_data):
+    return result_data
+  return json.loads(b''.join(iter_result_json(result_data)))
+
+
+def result_exists(result_data):
+  # False when an offloaded payload has been removed from storage
+  return not is_offloaded(result_data) or default_storage.exists(result_data['offloaded']['path'])
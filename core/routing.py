@@ -13,7 +13,7 @@ from . import consumers
 websocket_urlpatterns = [
   # When user connects to ws://server/ws/jobs/
   # Send them To JobConsumer
-  re_path(r'ws/job/$', consumers.JobConsumer.as_asgi()),
+  re_path(r'ws/jobs/$', consumers.JobConsumer.as_asgi()),
 ]
 
 # re_path(r'ws/jobs/$', consumers.JobConsumer.as_asgi())
@@ -0,0 +1,150 @@
+"""
+Row-offset index of CSV datasets, for reading any page of rows directly
+
+What it does:
+- Records the byte offset in the CSV of every ROW_INDEX_INTERVAL-th row,
+  while validate_csv (or the columnar cache build) reads the file anyway.
+  Offsets come from where csv.reader starts each record (CsvLines.position),
+  so quoted fields with newlines in them are handled
+- Keyed by Dataset.file_hash, like the columnar cache:
+    ROW_INDEX_ROOT/<file_hash>.idx   int64[3 + blocks]:
+                                     version, interval, row_count, offsets...
+- Reading rows [a, b) seeks to the offset of row a // interval and parses
+  at most interval + (b - a) rows, wherever a is in the file
+- Rows are counted like validate_csv counts them: after the header row,
+  blank lines skipped
+
+DatasetViewSet.rows pages through it (DatasetRowPagination).
+"""
+
+import csv
+import os
+import uuid
+from array import array
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .utils import CsvLines, iter_csv_lines
+
+INDEX_VERSION = 1
+HEADER_SIZE = 3
+
+# Read size when fetching a page of rows (pages are small, files may not be)
+ROW_READ_CHUNK_SIZE = 64 * 1024
+
+
+def index_path(file_hash):
+  return Path(settings.ROW_INDEX_ROOT) / f"{file_hash}.idx"
+
+
+class RowIndexWriter:
+  """
+  Collects row offsets while a csv.reader reads lines (a CsvLines).
+  Call add_row() for every row the reader returns (not the header, not
+  blank lines), then save().
+  """
+
+  def __init__(self, lines, interval=None):
+    self.lines = lines
+    self.interval = interval or settings.ROW_INDEX_INTERVAL
+    self.offsets = array('q')
+    self.row_count = 0
+    self._start = lines.position # the header has been read
+
+  def add_row(self):
+    if self.row_count % self.interval == 0:
+      self.offsets.append(self._start)
+    self.row_count += 1
+    self._start = self.lines.position
+
+  def save(self, file_hash):
+    # Written under a temp name and renamed into place, so readers never see half of it
+    path = index_path(file_hash)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.parent / f".{path.name}.{uuid.uuid4().hex}"
+    with open(temp_path, 'wb') as index_file:
+      array('q', [INDEX_VERSION, self.interval, self.row_count]).tofile(index_file)
+      self.offsets.tofile(index_file)
+    os.replace(temp_path, path)
+
+
+def build_row_index(dataset):
+  # One pass over the CSV just for the index (datasets validated before it existed)
+  with default_storage.open(dataset.file.name, 'rb') as csv_file:
+    lines = iter_csv_lines(csv_file)
+    csv_reader = csv.reader(lines)
+    next(csv_reader, None)
+    writer = RowIndexWriter(lines)
+    for row in csv_reader:
+      if row:
+        writer.add_row()
+  writer.save(dataset.file_hash)
+  return load_row_index(dataset)
+
+
+class RowIndex:
+  """
+  A dataset's rows, read through its index. Sliceable and has a len(),
+  so DRF's LimitOffsetPagination can page through it like a queryset.
+  """
+
+  def __init__(self, dataset, path):
+    self.file_name = dataset.file.name
+    self._index = np.memmap(path, dtype='<i8', mode='r')
+    self.interval = int(self._index[1])
+    self.row_count = int(self._index[2])
+
+  def __len__(self):
+    return self.row_count
+
+  def __getitem__(self, key):
+    if not isinstance(key, slice) or key.step not in (None, 1):
+      raise TypeError("RowIndex only supports [start:stop] slices")
+    start, stop, _ = key.indices(self.row_count)
+    return self.read(start, stop)
+
+  def _open_at(self, offset):
+    csv_file = default_storage.open(self.file_name, 'rb')
+    csv_file.seek(offset)
+    return csv_file
+
+  def read(self, start, stop):
+    # Rows [start, stop) as lists of strings
+    if start >= stop:
+      return []
+    block = start // self.interval
+    skip = start - block * self.interval
+
+    rows = []
+    with self._open_at(int(self._index[HEADER_SIZE + block])) as csv_file:
+      for row in csv.reader(CsvLines(csv_file, ROW_READ_CHUNK_SIZE)):
+        if not row:
+          continue
+        if skip:
+          skip -= 1
+          continue
+        rows.append(row)
+        if len(rows) == stop - start:
+          break
+    return rows
+
+  def headers(self):
+    with self._open_at(0) as csv_file:
+      return next(csv.reader(CsvLines(csv_file, ROW_READ_CHUNK_SIZE)), [])
+
+
+def load_row_index(dataset):
+  # The dataset's RowIndex, or None if it hasn't been built (or is outdated)
+  if not dataset.file_hash:
+    return None
+  path = index_path(dataset.file_hash)
+  try:
+    header = np.fromfile(path, dtype='<i8', count=HEADER_SIZE)
+  except FileNotFoundError:
+    return None
+  if len(header) != HEADER_SIZE or header[0] != INDEX_VERSION:
+    return None
+  return RowIndex(dataset, path)
@@ -1,9 +1,25 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
 from rest_framework import serializers
 
-from mlplatform.core.utils import check_magic_number
-from .models import Project, Dataset, Job
-from .utils import generate_file_hash, mock_virus_scan
-from .utils import sanitize_filename, generate_unique_filename, extract_image_metadata
+from .blobs import add_refs, blob_hash, drop_refs, put_blob
+from .models import Project, Dataset, Job, UploadSession
+from .pagination import requested_fields
+from .uploads import ingest_file
+from .utils import mock_virus_scan
+from .utils import sanitize_filename
+
+
+class SparseFieldsMixin:
+  # Keeps only the fields asked for with ?fields=a,b (see core.pagination)
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    requested = requested_fields(self.context.get('request'))
+    if requested:
+      for name in set(self.fields) - requested:
+        self.fields.pop(name)
 
 
 class ProjectSerializer(serializers.ModelSerializer):
@@ -12,7 +28,7 @@ class ProjectSerializer(serializers.ModelSerializer):
     fields = '__all__'
 
 
-class DatasetSerializer(serializers.ModelSerializer):
+class DatasetSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
   # Write-only file field to accept uploads
 
@@ -22,117 +38,327 @@ class DatasetSerializer(serializers.ModelSerializer):
   class Meta:
     model = Dataset
     fields = '__all__'
-    read_only_fields = ['file_path', 'size', 'uploaded_at'] 
+    read_only_fields = ['file_path', 'size', 'file_hash', 'image_width', 'image_height', 'uploaded_at'] 
 
   def validate(self, path):
     uploaded_file = path.get('file')
+    if not uploaded_file and self.partial:
+      return path # PATCH without a new file: the stored one stays
     if not uploaded_file:
       raise serializers.ValidationError({"file": "No file provided"})
     
+    # Hash, size, magic number and image header, all from one read of the file
+    # (done while the upload streamed in, see core.uploads.IngestUploadHandler)
+    ingest = getattr(uploaded_file, 'ingest', None) or ingest_file(uploaded_file)
+
     max_size = 100 * 1024 * 1024 # 100 MB
-    if uploaded_file > max_size:
+    if ingest['size'] > max_size:
       raise serializers.ValidationError({"File": "File size exceeds 100 MB limit."})
 
-    is_valid_magic, detected_type = check_magic_number(uploaded_file)
-    
-    # Accept CSV and images and common Excel types
-    content_type = getattr(uploaded_file, 'content_type', '') or ''
-    allowed = False
-    if content_type:
-      if content_type == 'text/csv' or content_type.startswith('images/'):
-        allowed = True
-      if content_type in ('application/vnd.ms-excel', 
-                            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'):
-        allowed = True
-      
-    # Fallback to extension check if MIME not present or uncertain
-    if not allowed:
-      name = uploaded_file.name.lower()
-      if name.endswith(('.csv', '.png', '.jpg', '.jpeg', '.gif', '.xls', '.xlsx')):
-        allowed = True
-
-    if not allowed:
-      raise serializers.ValidationError({"file": "Unsupported file type. Only CSV and iamge files are allowed"})
-    
-
-    # Magic number validation for images (warn if mismatch, but dont block CSV)
-    if is_valid_magic and detected_type and detected_type.startswith('image/'):
-      if not content_type.startswith('image/'):
-        pass # Log warning but allow; file is actually an image
-
-    elif not uploaded_file.name.lower().endswith('.csv'):
-      if not (content_type.startswith('image/') or is_valid_magic):
-        raise serializers.ValidationError({"file": "File content does not match its type."})
-      
-    if not mock_virus_scan(uploaded_file):
-      raise serializers.ValidationError({"file": "File failed virus scan."})
-    
-    # Generate and check file hash for duplicates
-    file_hash = generate_file_hash(uploaded_file)
-    if Dataset.objects.filter(file_hash=file_hash).exists():
-      raise serializers.ValidationError({"file": "A file with identical content has already been uploaded."})
+    check_upload(uploaded_file, uploaded_file.name, getattr(uploaded_file, 'content_type', '') or '', ingest)
     
-    path['file_hash'] = file_hash
+    path['ingest'] = ingest
 
     return path
   
 
   def create(self, validated_data):
     uploaded_file = validated_data.pop('file')
-    file_hash = validated_data.pop('file_hash', '')
-
-    # Sanitize and generate unique filename
-    safe_original_name = sanitize_filename(uploaded_file.name)
-    unique_name = generate_unique_filename(safe_original_name)
-
-    # Extract unage netadata uf applicable
-    image_data = extract_image_metadata(uploaded_file)
-
-    # Create dataset without saving file yet so we can attach metadata
-    dataset = Dataset.objects.create(**validated_data)
-    dataset.file.save(uploaded_file.name, uploaded_file, save=False)
-    dataset.original_name = uploaded_file.name
-    dataset.content_type = getattr(uploaded_file, 'content_type', '')
-    dataset.size = uploaded_file.size
-    dataset.file_hash = file_hash
-    if image_data:
-      dataset.image_width = image_data.get('width')
-      dataset.image_height = image_data.get('height')
-      
+    ingest = validated_data.pop('ingest')
+    return create_dataset(
+      uploaded_file, uploaded_file.name, getattr(uploaded_file, 'content_type', ''), ingest,
+      **validated_data
+    )
+
+  def update(self, instance, validated_data):
+    uploaded_file = validated_data.pop('file', None)
+    ingest = validated_data.pop('ingest', None)
+    if uploaded_file is None:
+      return super().update(instance, validated_data)
+    return replace_dataset_file(
+      instance, uploaded_file, uploaded_file.name, getattr(uploaded_file, 'content_type', ''), ingest,
+      **validated_data
+    )
+
+
+def check_upload(file_obj, filename, content_type, ingest):
+  # Type, content and duplicate checks shared by normal and resumable uploads
+  # ingest is the result from core.uploads (hash, size, detected type, image header)
+  detected_type = ingest['detected_type']
+  is_valid_magic = detected_type is not None
+
+  # Accept CSV and images and common Excel types
+  allowed = False
+  if content_type:
+    if content_type == 'text/csv' or content_type.startswith('image/'):
+      allowed = True
+    if content_type in ('application/vnd.ms-excel', 
+                          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'):
+      allowed = True
+    
+  # Fallback to extension check if MIME not present or uncertain
+  if not allowed:
+    name = filename.lower()
+    if name.endswith(('.csv', '.png', '.jpg', '.jpeg', '.gif', '.xls', '.xlsx')):
+      allowed = True
+
+  if not allowed:
+    raise serializers.ValidationError({"file": "Unsupported file type. Only CSV and iamge files are allowed"})
+  
+
+  # Magic number validation for images (warn if mismatch, but dont block CSV)
+  if is_valid_magic and detected_type and detected_type.startswith('image/'):
+    if not content_type.startswith('image/'):
+      pass # Log warning but allow; file is actually an image
+
+  elif not filename.lower().endswith('.csv'):
+    if not (content_type.startswith('image/') or is_valid_magic):
+      raise serializers.ValidationError({"file": "File content does not match its type."})
+    
+  if not mock_virus_scan(file_obj):
+    raise serializers.ValidationError({"file": "File failed virus scan."})
+
+
+def find_stored_content(file_hash, size=None, user=None):
+  # A dataset whose stored file has this content, or None
+  # user limits the search to that user's own datasets
+  datasets = Dataset.objects.filter(file_hash=file_hash).exclude(file='')
+  if size is not None:
+    datasets = datasets.filter(size=size)
+  if user is not None:
+    datasets = datasets.filter(project__owner=user)
+  for dataset in datasets.order_by('id')[:5]:
+    if default_storage.exists(dataset.file.name):
+      return dataset
+  return None
+
+
+def reference_dataset(source, **fields):
+  # New dataset pointing at source's stored file: no bytes copied
+  dataset = Dataset(
+    original_name = source.original_name,
+    content_type = source.content_type,
+    size = source.size,
+    file_hash = source.file_hash,
+    image_width = source.image_width,
+    image_height = source.image_height,
+  )
+  for name, value in fields.items():
+    setattr(dataset, name, value)
+  dataset.file.name = source.file.name
+  with transaction.atomic():
+    dataset.save()
+    add_refs([blob_hash(dataset.file.name)])
+  return dataset
+
+
+def create_dataset(file_obj, filename, content_type, ingest, **fields):
+  # Save a checked upload as a Dataset: file and row in one go
+  # The content is stored as a blob (see core.blobs): a file with a
+  # temporary_file_path is moved into place, not copied, and content
+  # that is already stored isn't stored again
+
+  dataset = Dataset(**fields)
+  _set_file(dataset, file_obj, filename, content_type, ingest)
+  return dataset
+
+
+def replace_dataset_file(dataset, file_obj, filename, content_type, ingest, **fields):
+  # Give an existing Dataset new content, stored like create_dataset does
+  # The old blob loses the dataset's reference once the row points elsewhere
+  old_hash = blob_hash(dataset.file.name)
+  for name, value in fields.items():
+    setattr(dataset, name, value)
+  _set_file(dataset, file_obj, filename, content_type, ingest, old_hash)
+  return dataset
+
+
+def _set_file(dataset, file_obj, filename, content_type, ingest, old_hash=None):
+  # Image metadata was read from the header during upload
+  image_data = ingest['image'] or {}
+
+  dataset.original_name = filename
+  dataset.content_type = content_type
+  dataset.size = ingest['size']
+  dataset.file_hash = ingest['sha256']
+  dataset.image_width = image_data.get('width')
+  dataset.image_height = image_data.get('height')
+
+  with transaction.atomic():
+    dataset.file.name = put_blob(file_obj, ingest['sha256'], ingest['size'], refs=1)
     dataset.save()
-    return dataset
+    if old_hash:
+      drop_refs([old_hash])
+
+
+class ContentHashSerializer(serializers.Serializer):
+  """
+    Pre-flight check before uploading (POST /api/datasets/preflight/).
+
+    Expected input from user:
+    {
+        "sha256": "9f86d08...",  (hex SHA-256 of the whole file)
+        "size": 5368709120
+    }
+  """
+
+  sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+  size = serializers.IntegerField(min_value=0)
+
+  def validate_sha256(self, value):
+    return value.lower()
 
 
-class JobSerializer(serializers.ModelSerializer):
+class DatasetFromHashSerializer(ContentHashSerializer):
+  """
+    Create a dataset from content the user already uploaded, without
+    sending it again (POST /api/datasets/from_hash/).
+
+    Expected input from user:
+    {
+        "sha256": "9f86d08...",
+        "size": 5368709120,
+        "project": 1,
+        "name": "Survey 2024 (copy)",
+        "original_name": "survey.csv"  (optional)
+    }
+  """
+
+  project = serializers.PrimaryKeyRelatedField(queryset=Project.objects.all())
+  name = serializers.CharField(max_length=255)
+  original_name = serializers.CharField(max_length=512, required=False)
+
+  def validate_project(self, project):
+    if project.owner != self.context['request'].user:
+      raise serializers.ValidationError("Cannot upload to a project you do not own")
+    return project
+
+
+class JobSerializer(SparseFieldsMixin, serializers.ModelSerializer):
   class Meta:
     model = Job
     fields = '__all__'
-    read_only_fields = ['status', 'created_at', 'result_data', 'progress', 'task_id', 'error_message']
+    read_only_fields = [
+      'status', 'created_at', 'result_data', 'progress', 'task_id', 'error_message',
+      'job_type', 'params', 'cache_key', 'coalesced_into', 'artifacts', 'version', 'updated_at',
+    ]
 
+  def to_representation(self, instance):
+    # Running jobs: progress from the hot store, passed in by JobViewSet (core.job_state)
+    data = super().to_representation(instance)
+    live = self.context.get('live_progress') or {}
+    if 'progress' in data and instance.id in live:
+      data['progress'] = live[instance.id]
+    return data
 
-class JobSubmitSerializer(serializers.Serializer):
+
+class JobOptionsSerializer(serializers.Serializer):
   """
-    Serializer for submitting a new job.
-    
+    Options shared by jobs and pipeline steps.
+
     What it does:
-    - Validates user input when creating a job
-    - Checks that dataset_id exists
-    - Checks that job_type is valid
     - Checks that target_format is provided for format conversion
-    
+    - Checks the compression codec fits the target format
+  """
+
+  TARGET_FORMATS = ['json', 'ndjson', 'excel', 'parquet', 'feather']
+
+  # Fields passed on to the task as job options
+  PARAM_FIELDS = ['target_format', 'typed_values', 'compression']
+
+  target_format = serializers.CharField(required=False, allow_blank=True)
+  typed_values = serializers.BooleanField(required=False, default=False)
+  compression = serializers.ChoiceField(
+    choices = ['snappy', 'zstd', 'gzip', 'lz4', 'brotli', 'none'], required=False
+  )
+
+  def validate_target_format(self, value):
+    if value and value not in self.TARGET_FORMATS:
+      raise serializers.ValidationError(
+        f"Unsupported target format. Choose one of: {', '.join(self.TARGET_FORMATS)}"
+      )
+    return value
+
+  def validate(self, attrs):
+    if attrs['job_type'] == 'convert_file_format' and not attrs.get('target_format'):
+      raise serializers.ValidationError(
+        {"target_format": "target_format is required for convert_file_format job type."}
+      )
+    compression = attrs.get('compression')
+    if compression and attrs.get('target_format') == 'feather':
+      if compression not in ('lz4', 'zstd', 'none'):
+        raise serializers.ValidationError({"compression": "Feather supports lz4, zstd or none."})
+    return attrs
+
+  @classmethod
+  def job_params(cls, validated_data):
+    # The options part of a validated job, as passed to tasks.job_signature
+    return {field: validated_data[field] for field in cls.PARAM_FIELDS if field in validated_data}
+
+
+class PipelineStepSerializer(JobOptionsSerializer):
+  """
+    One step of a run_pipeline job, e.g.
+    {"job_type": "convert_file_format", "target_format": "parquet"}
+  """
+
+  job_type = serializers.ChoiceField(
+    choices = ['validate_csv', 'generate_statistics', 'convert_file_format']
+  )
+
+  def to_internal_value(self, data):
+    # Plain dict (not OrderedDict) with only the options this step uses
+    attrs = super().to_internal_value(data)
+    return {'job_type': attrs['job_type'], **self.job_params(attrs)}
+
+
+class JobSpecSerializer(JobOptionsSerializer):
+  """
+    One job to submit: a dataset, a job type and its options.
+
+    What it does:
+    - Checks that job_type is valid
+    - Checks the options (see JobOptionsSerializer)
+    - Checks that a pipeline has steps
+    - Doesn't touch the database (bulk submission checks all
+      datasets in one query instead)
+
     Expected input from user:
     {
         "dataset_id": 5,
         "job_type": "validate_csv",
-        "target_format": ""  (optional)
+        "target_format": "",  (optional)
+        "typed_values": false,  (optional, JSON / NDJSON only)
+        "compression": "zstd",  (optional, Parquet / Feather only)
+        "steps": [...]  (run_pipeline only, see PipelineStepSerializer)
     }
   """
 
+  MAX_PIPELINE_STEPS = 10
+
+  PARAM_FIELDS = JobOptionsSerializer.PARAM_FIELDS + ['steps']
+
   dataset_id = serializers.IntegerField()
   job_type = serializers.ChoiceField(
-    choices = ['validate_csv', 'process_image', 'generate_statistics', 'convert_file_format']
+    choices = [
+      'validate_csv', 'process_image', 'generate_statistics', 'convert_file_format',
+      'run_pipeline', 'build_tile_pyramid',
+    ]
   )
-  target_format = serializers.CharField(required=False, allow_blank=True)
+  steps = PipelineStepSerializer(many=True, required=False, allow_empty=False, max_length=MAX_PIPELINE_STEPS)
+
+  def validate(self, attrs):
+    attrs = super().validate(attrs)
+    if attrs['job_type'] == 'run_pipeline' and not attrs.get('steps'):
+      raise serializers.ValidationError({"steps": "steps are required for run_pipeline job type."})
+    return attrs
+
+
+class JobSubmitSerializer(JobSpecSerializer):
+  """
+    Serializer for submitting a single job (POST /api/jobs/).
+    Same input as JobSpecSerializer, plus a check that dataset_id exists.
+  """
 
   def validate_dataset_id(self, value):
     try:
@@ -141,8 +367,88 @@ class JobSubmitSerializer(serializers.Serializer):
       raise serializers.ValidationError("Dataset with given ID does not exist.")
   
     return value
-  
 
 
+class JobBulkSubmitSerializer(serializers.Serializer):
+  """
+    Serializer for submitting many jobs at once (POST /api/jobs/bulk/).
+
+    Expected input from user:
+    {
+        "jobs": [
+            {"dataset_id": 5, "job_type": "validate_csv"},
+            {"dataset_id": 6, "job_type": "convert_file_format", "target_format": "parquet"}
+        ]
+    }
+  """
+
+  jobs = JobSpecSerializer(many=True, allow_empty=False, max_length=settings.JOB_BULK_MAX_JOBS)
+
+
+class ImageBatchSerializer(serializers.Serializer):
+  """
+    Options for a project's batch image job (POST /api/projects/{id}/process_images/).
+
+    Expected input from user:
+    {
+        "dataset_ids": [3, 4, 9]  (optional, default: every image in the project)
+    }
+  """
+
+  dataset_ids = serializers.ListField(
+    child=serializers.IntegerField(), required=False, allow_empty=False
+  )
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+  """
+    Resumable upload session (POST /api/uploads/).
+
+    Expected input from user:
+    {
+        "project": 1,
+        "name": "Survey 2024",
+        "filename": "survey.csv",
+        "size": 5368709120,
+        "content_type": "text/csv",  (optional)
+        "chunk_size": 8388608,  (optional, default UPLOAD_CHUNK_SIZE)
+        "sha256": "..."  (optional, checked when the upload is finalized)
+    }
+  """
+
+  chunk_count = serializers.IntegerField(read_only=True)
+  received_chunks = serializers.SerializerMethodField()
+
+  class Meta:
+    model = UploadSession
+    fields = [
+      'id', 'project', 'name', 'filename', 'content_type', 'size', 'chunk_size',
+      'sha256', 'status', 'dataset', 'created_at', 'chunk_count', 'received_chunks',
+    ]
+    read_only_fields = ['status', 'dataset', 'created_at']
+    extra_kwargs = {'chunk_size': {'required': False}}
+
+  def get_received_chunks(self, session):
+    return sorted(session.chunks.values_list('index', flat=True))
+
+  def validate_project(self, project):
+    if project.owner != self.context['request'].user:
+      raise serializers.ValidationError("Cannot upload to a project you do not own")
+    return project
+
+  def validate_size(self, size):
+    if size > settings.UPLOAD_SESSION_MAX_SIZE:
+      raise serializers.ValidationError(
+        f"File size exceeds the {settings.UPLOAD_SESSION_MAX_SIZE // 1024 ** 3} GB limit."
+      )
+    return size
 
+  def validate_chunk_size(self, chunk_size):
+    if not 1024 * 1024 <= chunk_size <= settings.UPLOAD_CHUNK_MAX_SIZE:
+      raise serializers.ValidationError(
+        f"chunk_size must be between 1 MB and {settings.UPLOAD_CHUNK_MAX_SIZE // 1024 ** 2} MB."
+      )
+    return chunk_size
 
+  def validate_filename(self, filename):
+    return sanitize_filename(filename)
@@ -1,78 +1,227 @@
 import csv
-import json
 import logging
-from io import StringIO
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
 from django.core.files.storage import default_storage
-from celery import shared_task
-from core.models import Job, Dataset
+from django.db import connection
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+from celery import shared_task, group, chord
+from core.models import Job, Dataset, UploadSession
+from core.blobs import BlobOutput, collect_blobs, move_file_to_blob
+from core.columnar import build_columnar, can_cache, get_or_build_columnar, load_columnar, profile_columnar
+from core.converters import (
+    FEATHER_CODECS, PARQUET_CODECS, coerce_rows, coerce_value, infer_column_types,
+    write_excel, write_feather, write_json, write_ndjson, write_parquet,
+)
+from core.imaging import render_image
+from core.profiling import DatasetProfile
+from core.tiles import ImageTooLarge, build_pyramid
+from core.uploads import discard_part_file
+from core.progress import ProgressReporter
+from core.job_state import add_progress, flush_progress
+from core.result_cache import evict_results, lookup_results, result_cache_key, store_result
+from core.result_store import unpack_result
+from core.row_index import RowIndexWriter, build_row_index, load_row_index
+from core.utils import iter_csv_lines, current_memory_kb, ByteRangeReader, split_csv_records
 
 logger = logging.getLogger(__name__)
 
 
+# ============ SHARED HELPERS ============
+def iter_dataset_rows(dataset, on_progress=None, typed=False):
+    """
+    Returns (headers, rows, row_count) for a CSV dataset.
+    rows is an iterator of lists; row_count is None when it isn't known yet.
+
+    Reads the columnar cache (building it on first use) when it is enabled,
+    otherwise streams the CSV text. typed=True gives ints, floats, bools
+    and None instead of strings.
+    """
+    columnar = get_or_build_columnar(dataset, on_progress)
+    if columnar:
+        return columnar.headers, columnar.iter_rows(typed=typed), columnar.row_count
+
+    csv_file = default_storage.open(dataset.file.name, 'rb')
+    csv_reader = csv.reader(iter_csv_lines(csv_file))
+    headers = next(csv_reader, None) or []
+
+    def rows():
+        with csv_file:
+            for row in csv_reader:
+                if not row:
+                    continue
+                yield [coerce_value(value) for value in row] if typed else row
+    return headers, rows(), None
+
+
+def iter_typed_rows(dataset, on_progress=None):
+    """
+    Returns (headers, rows, row_count, column_types) with every value in a
+    column converted to that column's type, as Parquet / Arrow need.
+    Types come from the columnar cache; without it they are inferred
+    by one extra streaming pass over the CSV.
+    """
+    columnar = get_or_build_columnar(dataset, on_progress)
+    if columnar:
+        column_types = [column['type'] for column in columnar.schema['columns']]
+        return columnar.headers, columnar.iter_rows(typed=True), columnar.row_count, column_types
+
+    headers, rows, _ = iter_dataset_rows(dataset)
+    column_types = infer_column_types(headers, rows)
+    headers, rows, row_count = iter_dataset_rows(dataset)
+    return headers, coerce_rows(rows, column_types), row_count, column_types
+
+
+def track_progress(rows, row_count, on_progress):
+    # Pass rows through, reporting progress every PROGRESS_CHECK_ROWS rows
+    for index, row in enumerate(rows, 1):
+        if row_count and index % PROGRESS_CHECK_ROWS == 0:
+            on_progress(index / row_count)
+        yield row
+
+
 # ============ CSV VALIDATION TASK ============
+# How many malformed row numbers to keep in the report (the count is always exact)
+MAX_REPORTED_BAD_ROWS = 20
+
+# How often (in rows) to check progress and memory while streaming
+PROGRESS_CHECK_ROWS = 10000
+
+
+def validate_csv_stream(file_path, total_bytes, on_progress, file_hash=None):
+    """
+    Stream a CSV file in bounded chunks and check it row by row.
+    Used when the columnar cache is turned off.
+    With file_hash, the row-offset index is saved for it (core.row_index).
+    """
+    peak_memory_kb = current_memory_kb()
+    row_count = 0
+    malformed_rows = 0
+    bad_row_numbers = []
+    
+    with default_storage.open(file_path, 'rb') as csv_file:
+        lines = iter_csv_lines(csv_file)
+        csv_reader = csv.reader(lines)
+        
+        # First row holds the column headers
+        headers = next(csv_reader, None) or []
+        header_count = len(headers)
+        row_index = RowIndexWriter(lines)
+        
+        for row in csv_reader:
+            if not row:
+                continue  # skip blank lines like DictReader does
+            row_count += 1
+            row_index.add_row()
+            
+            # Every row should have exactly one field per header
+            if len(row) != header_count:
+                malformed_rows += 1
+                if len(bad_row_numbers) < MAX_REPORTED_BAD_ROWS:
+                    bad_row_numbers.append(csv_reader.line_num)
+            
+            if row_count % PROGRESS_CHECK_ROWS == 0:
+                peak_memory_kb = max(peak_memory_kb, current_memory_kb())
+                on_progress(min(csv_file.tell() / total_bytes, 1))
+    
+    if file_hash:
+        row_index.save(file_hash)
+    
+    return {
+        'row_count': row_count,
+        'headers': headers,
+        'malformed_rows': malformed_rows,
+        'malformed_row_lines': bad_row_numbers,
+        'peak_memory_kb': max(peak_memory_kb, current_memory_kb()),
+    }
+
+
+def build_validation_report(dataset, on_progress):
+    """
+    Check every row of a CSV dataset and return the validation report.
+    Reads the summary from the columnar cache, building it if needed,
+    or streams the CSV when the cache is turned off.
+    """
+    file_path = dataset.file.name
+    total_bytes = dataset.size or default_storage.size(file_path) or 1
+    
+    if can_cache(dataset):
+        columnar = load_columnar(dataset)
+        source = 'columnar_cache'
+        peak_memory_kb = current_memory_kb()
+        if columnar is None:
+            columnar, peak_memory_kb = build_columnar(dataset, on_progress)
+            source = 'csv'
+        elif load_row_index(dataset) is None:
+            # Cache built before row indexes existed: index the CSV now
+            build_row_index(dataset)
+        summary = {
+            'row_count': columnar.row_count,
+            'headers': columnar.headers,
+            'malformed_rows': columnar.schema['malformed_rows'],
+            'malformed_row_lines': columnar.schema['malformed_row_lines'],
+            'peak_memory_kb': peak_memory_kb,
+        }
+    else:
+        source = 'csv'
+        summary = validate_csv_stream(file_path, total_bytes, on_progress, dataset.file_hash)
+    
+    row_count = summary['row_count']
+    return {
+        'is_valid': row_count > 0 and summary['malformed_rows'] == 0,
+        'row_count': row_count,
+        'headers': summary['headers'],
+        'header_count': len(summary['headers']),
+        'malformed_rows': summary['malformed_rows'],
+        'malformed_row_lines': summary['malformed_row_lines'],
+        'peak_memory_kb': summary['peak_memory_kb'],
+        'source': source,
+    }
+
+
 @shared_task(bind=True, max_retries=3)
 def validate_csv(self, dataset_id, job_id):
     """
     Validate CSV file and count rows.
     Updates Job progress from 0-100%.
+
+    The file is streamed in bounded chunks and checked row by row,
+    so worker memory stays flat no matter how big the upload is.
+    The same pass builds the dataset's columnar cache; once that exists,
+    validation just reads the summary stored in its schema.
+    It also builds the row-offset index the rows endpoint reads pages
+    through (core.row_index).
     
     Retry logic: waits 3s, then 9s, then 27s before giving up
     """
+    reporter = ProgressReporter(self, job_id)
     try:
-        # Get the Job and Dataset from database
-        job = Job.objects.get(id=job_id)
+        # Mark job as PROCESSING and store the Celery task ID
+        reporter.start()
         dataset = Dataset.objects.get(id=dataset_id)
         
-        # Mark job as PROCESSING and store the Celery task ID
-        job.status = 'PROCESSING'
-        job.task_id = self.request.id  # Store task ID for tracking
-        job.save()
+        # 25% - Starting
+        reporter.update(25)
         
-        # Read the CSV file from storage
-        file_path = dataset.file.name
-        file_content = default_storage.open(file_path, 'r').read()
-        
-        # 25% - File loaded
-        job.progress = 25
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 25})
-        
-        # Parse CSV and convert to list of rows
-        csv_reader = csv.DictReader(StringIO(file_content))
-        rows = list(csv_reader)
-        
-        # 75% - Parsed successfully
-        job.progress = 75
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 75})
-        
-        # Get column headers from CSV
-        headers = csv_reader.fieldnames or []
-        
-        # Create validation report
-        validation_report = {
-            'is_valid': len(rows) > 0,
-            'row_count': len(rows),
-            'headers': headers,
-            'header_count': len(headers),
-        }
+        # 25% -> 95% - Streaming through the file
+        validation_report = build_validation_report(dataset, reporter.callback(25, 95))
+        row_count = validation_report['row_count']
         
         # 100% - COMPLETE
-        job.progress = 100
-        job.status = 'COMPLETED'
-        job.result_data = validation_report
-        job.save()
+        reporter.complete(validation_report)
         
-        logger.info(f"CSV validation completed for job {job_id}: {len(rows)} rows")
+        logger.info(f"CSV validation completed for job {job_id}: {row_count} rows")
         return validation_report
         
     except Exception as exc:
         # Something went wrong - log it and mark job as FAILED
         logger.error(f"CSV validation failed for job {job_id}: {str(exc)}")
-        job = Job.objects.get(id=job_id)
-        job.status = 'FAILED'
-        job.error_message = str(exc)
-        job.save()
+        reporter.fail(str(exc))
         
         # Retry with exponential backoff: 3^1=3s, 3^2=9s, 3^3=27s
         raise self.retry(exc=exc, countdown=3 ** self.request.retries)
@@ -84,241 +233,714 @@ def validate_csv(self, dataset_id, job_id):
 @shared_task(bind=True, max_retries=3)
 def process_image(self, dataset_id, job_id):
     """
-    Process image: resize and generate thumbnail.
+    Process image: save every rendition in settings.IMAGE_RENDITIONS
+    (by default an 800x600 JPEG and WebP and a 200x200 thumbnail).
     Updates Job progress from 0-100%.
+
+    The image is decoded once, JPEGs at a reduced scale (draft mode),
+    and each rendition is resized from the previous, larger one.
     """
+    reporter = ProgressReporter(self, job_id)
     try:
-        from PIL import Image
-        
-        job = Job.objects.get(id=job_id)
+        reporter.start()
         dataset = Dataset.objects.get(id=dataset_id)
         
-        job.status = 'PROCESSING'
-        job.task_id = self.request.id
-        job.save()
+        # 10% - Starting
+        reporter.update(10)
         
-        # Open original image file
-        file_path = dataset.file.name
-        image = Image.open(default_storage.open(file_path, 'rb'))
-        
-        # 30% - Image loaded
-        job.progress = 30
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 30})
-        
-        # Get original dimensions before any changes
-        original_size = image.size
-        
-        # 50% - Creating resized version
-        job.progress = 50
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 50})
-        
-        # Create a resized copy (800x600 max)
-        resized = image.copy()
-        resized.thumbnail((800, 600), Image.Resampling.LANCZOS)
-        resized_path = f"processed/{dataset.id}_resized.jpg"
-        default_storage.save(resized_path, resized)
-        
-        # 75% - Creating thumbnail
-        job.progress = 75
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 75})
-        
-        # Create a thumbnail (200x200 max)
-        thumb = image.copy()
-        thumb.thumbnail((200, 200), Image.Resampling.LANCZOS)
-        thumb_path = f"processed/{dataset.id}_thumb.jpg"
-        default_storage.save(thumb_path, thumb)
+        # Decode once and save every rendition (see core.imaging)
+        with default_storage.open(dataset.file.name, 'rb') as image_file:
+            rendered = render_image(image_file)
         
         # 100% - COMPLETE
-        job.progress = 100
-        job.status = 'COMPLETED'
-        job.result_data = {
-            'original_size': original_size,
-            'resized_path': resized_path,
-            'thumbnail_path': thumb_path,
-            'format': image.format,
+        result_data = {
+            'original_size': rendered['original_size'],
+            'decoded_size': rendered['decoded_size'],
+            'format': rendered['format'],
+            'renditions': rendered['renditions'],
         }
-        job.save()
+        # Shortcuts like resized_path / thumbnail_path for each rendition
+        for name, rendition in rendered['renditions'].items():
+            result_data[f"{name}_path"] = rendition['path']
+        reporter.complete(result_data)
         
         logger.info(f"Image processing completed for job {job_id}")
-        return job.result_data
+        return result_data
         
     except Exception as exc:
         logger.error(f"Image processing failed for job {job_id}: {str(exc)}")
-        job = Job.objects.get(id=job_id)
-        job.status = 'FAILED'
-        job.error_message = str(exc)
-        job.save()
+        reporter.fail(str(exc))
+        raise self.retry(exc=exc, countdown=3 ** self.request.retries)
+
+# ============ BATCH IMAGE PROCESSING TASK ============
+# How many failed images to list in the result (the count is always exact)
+MAX_REPORTED_FAILURES = 100
+
+
+def render_dataset_image(file_name):
+    # Worker-thread job: renditions for one image dataset
+    try:
+        with default_storage.open(file_name, 'rb') as image_file:
+            return render_image(image_file)
+    finally:
+        # Saving blobs opened a database connection for this thread: don't leave it behind
+        connection.close()
+
+
+@shared_task(bind=True, max_retries=3)
+def process_image_batch(self, project_id, job_id, dataset_ids=None):
+    """
+    Make the IMAGE_RENDITIONS of every image in a project (or of the
+    given dataset_ids in it) as one Job.
+    Updates Job progress from 0-100%.
+
+    Images are rendered IMAGE_BATCH_WORKERS at a time on a thread pool
+    (Pillow releases the GIL while decoding, resizing and encoding),
+    IMAGE_BATCH_CHUNK_SIZE per chunk so only one chunk is in flight.
+    result_data holds one compact row per image:
+        columns: ["dataset_id", "width", "height", <rendition names>...]
+        rows:    [[12, 4000, 3000, "blobs/3f/a2/3fa2...", ...], ...]
+    plus throughput and the failed images.
+    """
+    reporter = ProgressReporter(self, job_id)
+    try:
+        reporter.start()
+        
+        images = Dataset.objects.filter(project_id=project_id, image_width__isnull=False)
+        if dataset_ids:
+            images = images.filter(id__in=dataset_ids)
+        images = list(images.order_by('id').values_list('id', 'file'))
+        total = len(images)
+        
+        rendition_names = [rendition['name'] for rendition in settings.IMAGE_RENDITIONS]
+        rows = []
+        failures = []
+        failed_count = 0
+        started = time.monotonic()
+        
+        chunk_size = settings.IMAGE_BATCH_CHUNK_SIZE
+        # One thread per CPU by default (the executor's own default is cpu + 4)
+        workers = settings.IMAGE_BATCH_WORKERS or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for chunk_start in range(0, total, chunk_size):
+                chunk = images[chunk_start:chunk_start + chunk_size]
+                futures = [
+                    (dataset_id, pool.submit(render_dataset_image, file_name))
+                    for dataset_id, file_name in chunk
+                ]
+                for dataset_id, future in futures:
+                    try:
+                        rendered = future.result()
+                    except Exception as exc:
+                        # One bad image doesn't stop the batch
+                        failed_count += 1
+                        if len(failures) < MAX_REPORTED_FAILURES:
+                            failures.append([dataset_id, str(exc)])
+                        continue
+                    width, height = rendered['original_size']
+                    renditions = rendered['renditions']
+                    rows.append([dataset_id, width, height] + [renditions[name]['path'] for name in rendition_names])
+                
+                # 0% -> 95% - one step per finished chunk
+                reporter.update(95 * min(chunk_start + chunk_size, total) / total)
+        
+        elapsed = time.monotonic() - started
+        
+        # 100% - COMPLETE
+        result_data = {
+            'total': total,
+            'processed': len(rows),
+            'failed': failed_count,
+            'elapsed_seconds': round(elapsed, 3),
+            'images_per_second': round(len(rows) / elapsed, 2) if elapsed > 0 else len(rows),
+            'columns': ['dataset_id', 'width', 'height'] + rendition_names,
+            'rows': rows,
+            'failures': failures,
+        }
+        reporter.complete(result_data)
+        
+        logger.info(f"Batch image processing completed for job {job_id}: {len(rows)}/{total} images")
+        return {key: value for key, value in result_data.items() if key != 'rows'}
+        
+    except Exception as exc:
+        logger.error(f"Batch image processing failed for job {job_id}: {str(exc)}")
+        reporter.fail(str(exc))
+        raise self.retry(exc=exc, countdown=3 ** self.request.retries)
+
+# ============ TILE PYRAMID TASK ============
+@shared_task(bind=True, max_retries=3)
+def build_tile_pyramid(self, dataset_id, job_id):
+    """
+    Build a Deep Zoom (DZI) tile pyramid of an image dataset, so it can be
+    viewed at full resolution one TILE_SIZE tile at a time.
+    Updates Job progress from 0-100%.
+
+    Levels are built from full resolution down, each one halved from
+    the level above; tiles are written on a thread pool (see core.tiles).
+    The pyramid is keyed by file_hash, so identical images build it once.
+    """
+    reporter = ProgressReporter(self, job_id)
+    try:
+        reporter.start()
+        dataset = Dataset.objects.get(id=dataset_id)
+        
+        # 10% - Starting, 10% -> 95% - writing tiles
+        reporter.update(10)
+        descriptor = build_pyramid(dataset, reporter.callback(10, 95))
+        
+        # 100% - COMPLETE
+        result_data = {
+            'dzi_url': reverse('dataset-dzi', args=[dataset.id]),
+            'width': descriptor['width'],
+            'height': descriptor['height'],
+            'tile_size': descriptor['tile_size'],
+            'overlap': descriptor['overlap'],
+            'format': descriptor['format'],
+            'levels': descriptor['levels'],
+            'tile_count': descriptor['tile_count'],
+        }
+        reporter.complete(result_data)
+        
+        logger.info(f"Tile pyramid built for job {job_id}: {descriptor['tile_count']} tiles")
+        return result_data
+        
+    except ImageTooLarge as exc:
+        # Retrying won't make it any smaller
+        logger.error(f"Tile pyramid failed for job {job_id}: {str(exc)}")
+        reporter.fail(str(exc))
+        
+    except Exception as exc:
+        logger.error(f"Tile pyramid failed for job {job_id}: {str(exc)}")
+        reporter.fail(str(exc))
         raise self.retry(exc=exc, countdown=3 ** self.request.retries)
 
   
 
 
 # ============ STATISTICS GENERATION TASK ============
+def profile_csv_range(file_path, headers, start, end):
+    """
+    Profile the rows stored in bytes [start, end) of a CSV file.
+    The range must start and end on record boundaries (see split_csv_records).
+    """
+    profile = DatasetProfile(headers)
+    with default_storage.open(file_path, 'rb') as csv_file:
+        for row in csv.reader(iter_csv_lines(ByteRangeReader(csv_file, start, end))):
+            if row:
+                profile.add_row(row)
+    return profile
+
+
 @shared_task(bind=True, max_retries=3)
 def generate_statistics(self, dataset_id, job_id):
     """
     Generate dataset statistics and quality metrics.
     Updates Job progress from 0-100%.
+
+    Every value goes into per-column accumulators (see core.profiling):
+    inferred type, null count, min/max/mean/variance, approximate
+    distinct count, quantiles and top values.
+
+    Files bigger than STATS_CHUNK_SIZE are split into byte ranges on
+    record boundaries and profiled in parallel as a Celery chord: one
+    profile_statistics_chunk task per range, then merge_statistics
+    combines the partial profiles into result_data.
+
+    If the dataset's columnar cache exists, the cached columns are
+    scanned instead of parsing the CSV, split the same way into row
+    ranges of STATS_CHUNK_ROWS (profile_columnar_chunk tasks).
     """
+    reporter = ProgressReporter(self, job_id)
     try:
-        job = Job.objects.get(id=job_id)
+        reporter.start()
         dataset = Dataset.objects.get(id=dataset_id)
         
-        job.status = 'PROCESSING'
-        job.task_id = self.request.id
-        job.save()
-        
-        # Read CSV file
+        # Fast path: column scans over the cache built by an earlier job
+        columnar = load_columnar(dataset)
+        if columnar:
+            row_count = columnar.row_count
+            chunk_rows = settings.STATS_CHUNK_ROWS
+            if row_count <= chunk_rows:
+                profile = profile_columnar(columnar, reporter.callback(10, 90))
+                return finish_statistics(reporter, profile, source='columnar_cache')
+            
+            reporter.update(10, force=True)
+            row_ranges = [(start, min(start + chunk_rows, row_count)) for start in range(0, row_count, chunk_rows)]
+            return fan_out_statistics(reporter, job_id, [
+                profile_columnar_chunk.s(dataset.id, job_id, start, stop, task_id=reporter.task_id)
+                for start, stop in row_ranges
+            ], source='columnar_cache')
+        
+        # Find the header row and cut the rest into record-aligned ranges
         file_path = dataset.file.name
-        file_content = default_storage.open(file_path, 'r').read()
-        
-        # 25% - File loaded
-        job.progress = 25
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 25})
-        
-        # Parse CSV into rows
-        csv_reader = csv.DictReader(StringIO(file_content))
-        rows = list(csv_reader)
-        
-        # 50% - Parsed
-        job.progress = 50
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 50})
-        
-        # Get column names
-        headers = csv_reader.fieldnames or []
-        
-        # Calculate statistics
-        stats = {
-            'total_rows': len(rows),
-            'total_columns': len(headers),
-            'column_names': headers,
-            'null_counts': {},
+        with default_storage.open(file_path, 'rb') as csv_file:
+            header_end, ranges = split_csv_records(csv_file, settings.STATS_CHUNK_SIZE)
+            csv_file.seek(0)
+            header_line = csv_file.read(header_end).decode('utf-8', errors='replace')
+        headers = next(csv.reader([header_line.lstrip('\ufeff')]), [])
+        
+        # 10% - File split into chunks
+        # Forced, since the chunk tasks below add their shares on top of it
+        reporter.update(10, force=True)
+        
+        # Small file: profile it right here, no fan-out needed
+        if len(ranges) <= 1:
+            profile = DatasetProfile(headers)
+            if ranges:
+                profile = profile_csv_range(file_path, headers, *ranges[0])
+            return finish_statistics(reporter, profile, source='csv', chunk_count=len(ranges))
+        
+        # Big file: one task per chunk
+        return fan_out_statistics(reporter, job_id, [
+            profile_statistics_chunk.s(dataset.id, job_id, headers, start, end, task_id=reporter.task_id)
+            for start, end in ranges
+        ], source='csv')
+        
+    except Exception as exc:
+        logger.error(f"Statistics generation failed for job {job_id}: {str(exc)}")
+        reporter.fail(str(exc))
+        raise self.retry(exc=exc, countdown=3 ** self.request.retries)
+
+
+def fan_out_statistics(reporter, job_id, chunk_signatures, source):
+    """
+    Run the chunk tasks as a chord whose callback is merge_statistics.
+    Each chunk moves progress forward by its share of 80%; the shares add
+    up to exactly 80, so the job reaches 90% when every chunk is done.
+    """
+    chunk_count = len(chunk_signatures)
+    shares = [
+        (80 * (i + 1)) // chunk_count - (80 * i) // chunk_count
+        for i in range(chunk_count)
+    ]
+    # The steps report under this task's id, which every coalesced job shares
+    chunk_tasks = group(
+        signature.clone(kwargs={'progress_share': share})
+        for signature, share in zip(chunk_signatures, shares)
+    )
+    callback = merge_statistics.s(job_id, task_id=reporter.task_id, source=source).on_error(
+        statistics_failed.s(job_id=job_id, task_id=reporter.task_id)
+    )
+    chord(chunk_tasks)(callback)
+    
+    logger.info(f"Statistics for job {job_id} split into {chunk_count} chunks")
+    return {'chunk_count': chunk_count}
+
+
+def add_chunk_progress(job_id, task_id, progress_share):
+    # Atomic increment, so chunks finishing at the same time don't overwrite each other
+    reporter = ProgressReporter(None, job_id, task_id)
+    if not reporter.task_id or not add_progress(reporter.task_id, progress_share):
+        reporter.jobs().update_versioned(progress=F('progress') + progress_share)
+
+
+@shared_task(bind=True, max_retries=3)
+def profile_statistics_chunk(self, dataset_id, job_id, headers, start, end, progress_share=0, task_id=None):
+    """
+    Map step: profile one byte range of the dataset.
+    Returns the partial profile as JSON state for merge_statistics.
+    """
+    try:
+        dataset = Dataset.objects.get(id=dataset_id)
+        profile = profile_csv_range(dataset.file.name, headers, start, end)
+        add_chunk_progress(job_id, task_id, progress_share)
+        return profile.to_state()
+    
+    except Exception as exc:
+        logger.error(f"Statistics chunk {start}-{end} failed for job {job_id}: {str(exc)}")
+        raise self.retry(exc=exc, countdown=3 ** self.request.retries)
+
+
+@shared_task(bind=True, max_retries=3)
+def profile_columnar_chunk(self, dataset_id, job_id, start, stop, progress_share=0, task_id=None):
+    """
+    Map step: profile rows start..stop of the dataset's columnar cache.
+    Returns the partial profile as JSON state for merge_statistics.
+    """
+    try:
+        dataset = Dataset.objects.get(id=dataset_id)
+        # Built before the chord was sent; rebuilt if it was evicted since
+        columnar = get_or_build_columnar(dataset)
+        profile = profile_columnar(columnar, start=start, stop=stop)
+        add_chunk_progress(job_id, task_id, progress_share)
+        return profile.to_state()
+    
+    except Exception as exc:
+        logger.error(f"Statistics rows {start}-{stop} failed for job {job_id}: {str(exc)}")
+        raise self.retry(exc=exc, countdown=3 ** self.request.retries)
+
+
+@shared_task
+def merge_statistics(chunk_states, job_id, task_id=None, source='csv'):
+    """
+    Reduce step: merge the partial profiles and complete the Job.
+    """
+    profile = DatasetProfile.from_state(chunk_states[0])
+    for state in chunk_states[1:]:
+        profile.merge(DatasetProfile.from_state(state))
+    
+    reporter = ProgressReporter(None, job_id, task_id)
+    return finish_statistics(reporter, profile, source=source, chunk_count=len(chunk_states))
+
+
+@shared_task
+def statistics_failed(request, exc, traceback, job_id, task_id=None):
+    """
+    Error callback for the statistics chord: mark the Job as FAILED.
+    """
+    logger.error(f"Statistics generation failed for job {job_id}: {str(exc)}")
+    ProgressReporter(None, job_id, task_id).fail(str(exc))
+
+
+def finish_statistics(reporter, profile, **details):
+    # Turn the accumulators into the final report and complete the job
+    stats = profile.to_dict()
+    stats.update(details)
+    
+    # 100% - COMPLETE
+    reporter.complete(stats)
+    
+    logger.info(f"Statistics generated for job {reporter.job_id}: {profile.row_count} rows analyzed")
+    return stats
+
+
+
+# ============ FILE FORMAT CONVERSION TASK ============
+# Writers for formats that are plain text streams
+STREAM_WRITERS = {
+    'json': ('json', write_json),
+    'ndjson': ('ndjson', write_ndjson),
+}
+
+# Writers for typed columnar formats (one type per column, row groups, compression)
+COLUMNAR_WRITERS = {
+    'parquet': ('parquet', write_parquet, PARQUET_CODECS[0]),
+    'feather': ('arrow', write_feather, FEATHER_CODECS[0]),
+}
+
+
+def convert_dataset(dataset, target_format, typed_values, compression, read_progress, write_progress):
+    """
+    Convert a CSV dataset into target_format and save it to storage.
+    Returns the conversion result (output_path, row_count, ...).
+    read_progress / write_progress are on_progress callbacks for the two phases.
+    """
+    # Rows come from the columnar cache (or the CSV if the cache is off)
+    if target_format in COLUMNAR_WRITERS:
+        headers, rows, row_count, column_types = iter_typed_rows(dataset, read_progress)
+    else:
+        headers, rows, row_count = iter_dataset_rows(dataset, read_progress, typed=typed_values)
+    
+    # Rows ready, start writing
+    read_progress(1)
+    rows = track_progress(rows, row_count, write_progress)
+    
+    # Convert based on target format
+    if target_format in STREAM_WRITERS:
+        extension, write_rows = STREAM_WRITERS[target_format]
+        with BlobOutput(f".{extension}") as output:
+            written = write_rows(headers, rows, output.file)
+        extra_details = {}
+    
+    elif target_format in COLUMNAR_WRITERS:
+        extension, write_columns, default_codec = COLUMNAR_WRITERS[target_format]
+        compression = compression or default_codec
+        with BlobOutput(f".{extension}") as output:
+            written = write_columns(headers, rows, output.file, column_types, compression)
+        extra_details = {
+            'compression': compression,
+            'column_types': dict(zip(headers, column_types)),
         }
+    
+    elif target_format == 'excel':
+        # Write-only workbook, one row at a time, new sheet every 1,048,576 rows
+        with BlobOutput(".xlsx") as output:
+            written, sheet_count, rows_per_second = write_excel(headers, rows, output.file)
+        extra_details = {'sheet_count': sheet_count, 'rows_per_second': rows_per_second}
+    
+    else:
+        raise ValueError(f"Unsupported target format: {target_format}")
+    
+    return {
+        'original_format': 'csv',
+        'target_format': target_format,
+        'output_path': output.name,
+        'row_count': written,
+        'typed_values': typed_values,
+        **extra_details,
+    }
+
+
+@shared_task(bind=True, max_retries=3)
+def convert_file_format(self, dataset_id, job_id, target_format, typed_values=False, compression=None):
+    """
+    Convert file to target format (json, ndjson, excel, parquet, feather).
+    Updates Job progress from 0-100%.
+    
+    target_format: 'json', 'ndjson', 'excel', 'parquet' or 'feather'
+    typed_values: write numbers and booleans as JSON types instead of strings
+    compression: codec for parquet (snappy, zstd, gzip, lz4, brotli, none)
+                 or feather (lz4, zstd, none)
+
+    Every format is written row by row straight into the output file,
+    so memory doesn't grow with the size of the dataset. Excel output
+    uses openpyxl's write-only mode and rolls over to a new sheet at
+    Excel's row limit. Parquet and Feather are written one row group
+    at a time with a fixed type per column.
+    """
+    reporter = ProgressReporter(self, job_id)
+    try:
+        reporter.start()
+        dataset = Dataset.objects.get(id=dataset_id)
         
-        # Count missing/null values per column
-        for header in headers:
-            null_count = sum(1 for row in rows if not row.get(header))
-            stats['null_counts'][header] = null_count
+        # 10% - Starting
+        reporter.update(10)
         
-        # 75% - Analyzed
-        job.progress = 75
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 75})
+        # 10% -> 40% reading rows, 40% -> 95% writing them
+        result_data = convert_dataset(
+            dataset, target_format, typed_values, compression,
+            reporter.callback(10, 40), reporter.callback(40, 95),
+        )
         
         # 100% - COMPLETE
-        job.progress = 100
-        job.status = 'COMPLETED'
-        job.result_data = stats
-        job.save()
+        reporter.complete(result_data)
         
-        logger.info(f"Statistics generated for job {job_id}: {len(rows)} rows analyzed")
-        return stats
+        logger.info(f"File conversion completed for job {job_id}: {target_format}")
+        return result_data
         
     except Exception as exc:
-        logger.error(f"Statistics generation failed for job {job_id}: {str(exc)}")
-        job = Job.objects.get(id=job_id)
-        job.status = 'FAILED'
-        job.error_message = str(exc)
-        job.save()
+        logger.error(f"File conversion failed for job {job_id}: {str(exc)}")
+        reporter.fail(str(exc))
         raise self.retry(exc=exc, countdown=3 ** self.request.retries)
 
 
+# ============ PIPELINE TASK ============
+# Step types a pipeline can run, in any order
+PIPELINE_STEPS = ['validate_csv', 'generate_statistics', 'convert_file_format']
+
+
+def build_statistics(dataset, on_progress):
+    """
+    Profile a whole CSV dataset in this worker (no chunk fan-out).
+    Scans the columnar cache when it exists, otherwise streams the rows.
+    """
+    columnar = load_columnar(dataset)
+    if columnar:
+        profile = profile_columnar(columnar, on_progress)
+        source = 'columnar_cache'
+    else:
+        headers, rows, row_count = iter_dataset_rows(dataset)
+        profile = DatasetProfile(headers)
+        for row in track_progress(rows, row_count, on_progress):
+            profile.add_row(row)
+        source = 'csv'
+    
+    stats = profile.to_dict()
+    stats['source'] = source
+    return stats
+
+
+def run_pipeline_step(dataset, step, reporter, start, end):
+    # Run one pipeline step, moving job progress from start% to end%
+    # Results shared with single jobs through the result cache
+    job_type = step['job_type']
+    params = {name: value for name, value in step.items() if name != 'job_type'}
+    
+    key = result_cache_key(dataset.file_hash, job_type, params)
+    cached = lookup_results([key])
+    if key in cached:
+        # Expanded, so the pipeline's result is the same whether or not it was cached
+        return {'status': 'COMPLETED', 'cached': True, 'result': unpack_result(cached[key])}
+    
+    if job_type == 'validate_csv':
+        result = build_validation_report(dataset, reporter.callback(start, end))
+    elif job_type == 'generate_statistics':
+        result = build_statistics(dataset, reporter.callback(start, end))
+    elif job_type == 'convert_file_format':
+        middle = (start + end) / 2
+        result = convert_dataset(
+            dataset, params['target_format'], params.get('typed_values', False),
+            params.get('compression'), reporter.callback(start, middle), reporter.callback(middle, end),
+        )
+    else:
+        raise ValueError(f"Unsupported pipeline step: {job_type}")
+    
+    store_result(key, job_type, result)
+    return {'status': 'COMPLETED', 'cached': False, 'result': result}
+
 
-# ============ FILE FORMAT CONVERSION TASK ============
 @shared_task(bind=True, max_retries=3)
-def convert_file_format(self, dataset_id, job_id, target_format):
+def run_pipeline(self, dataset_id, job_id, steps):
     """
-    Convert file to target format (json, excel).
+    Run several steps on one dataset as a single Job.
     Updates Job progress from 0-100%.
     
-    target_format: 'json' or 'excel'
+    steps: ordered list like
+        [{"job_type": "validate_csv"},
+         {"job_type": "generate_statistics"},
+         {"job_type": "convert_file_format", "target_format": "parquet"}]
+    
+    The CSV is parsed once, into the dataset's columnar cache, and every
+    step reads that. Each finished step's result is saved in result_data
+    right away, so the status endpoint shows them while later steps run.
+    If a validate_csv step finds the file invalid, the remaining steps
+    are skipped.
     """
+    reporter = ProgressReporter(self, job_id)
     try:
-        job = Job.objects.get(id=job_id)
+        reporter.start()
         dataset = Dataset.objects.get(id=dataset_id)
         
-        job.status = 'PROCESSING'
-        job.task_id = self.request.id
-        job.save()
+        # 0% -> 20% - Parse the CSV into the columnar cache (unless an earlier job did)
+        # With the cache turned off, each step streams the CSV itself
+        parsed_from = 'columnar_cache' if load_columnar(dataset) else 'csv'
+        get_or_build_columnar(dataset, reporter.callback(0, 20))
         
-        # Read CSV file
-        file_path = dataset.file.name
-        file_content = default_storage.open(file_path, 'r').read()
-        
-        # 25% - File loaded
-        job.progress = 25
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 25})
-        
-        # Parse CSV into rows
-        csv_reader = csv.DictReader(StringIO(file_content))
-        rows = list(csv_reader)
-        headers = csv_reader.fieldnames or []
-        
-        # 50% - Parsed
-        job.progress = 50
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 50})
-        
-        # Convert based on target format
-        if target_format == 'json':
-            # Convert to JSON format
-            json_content = json.dumps(rows, indent=2)
-            output_path = f"converted/{dataset.id}_converted.json"
-            default_storage.save(output_path, StringIO(json_content))
-        
-        elif target_format == 'excel':
-            # Convert to Excel format
+        results = {
+            'parsed_from': parsed_from,
+            'stopped_early': False,
+            'steps': [{'job_type': step['job_type'], 'status': 'PENDING'} for step in steps],
+        }
+        
+        # 20% -> 100% - Steps share the rest equally
+        step_share = 80 / len(steps)
+        for index, step in enumerate(steps):
+            start = 20 + step_share * index
+            entry = results['steps'][index]
             try:
-                import openpyxl
-            except ImportError:
-                raise ImportError("openpyxl not installed. Install with: pip install openpyxl")
-            
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            
-            # Write headers in first row
-            for col, header in enumerate(headers, 1):
-                ws.cell(1, col, header)
-            
-            # Write data rows
-            for row_idx, row in enumerate(rows, 2):
-                for col_idx, header in enumerate(headers, 1):
-                    ws.cell(row_idx, col_idx, row.get(header))
+                entry.update(run_pipeline_step(dataset, step, reporter, start, start + step_share))
+            except Exception as exc:
+                # The failed job keeps the finished steps and shows which one broke
+                entry.update(status='FAILED', error=str(exc))
+                reporter.checkpoint(start, results)
+                raise
+            reporter.checkpoint(start + step_share, results)
             
-            output_path = f"converted/{dataset.id}_converted.xlsx"
-            wb.save(default_storage.open(output_path, 'wb'))
-        
-        # 75% - Converted
-        job.progress = 75
-        job.save()
-        self.update_state(state='PROGRESS', meta={'progress': 75})
+            # Invalid file: no point profiling or converting it
+            if step['job_type'] == 'validate_csv' and not entry['result']['is_valid']:
+                for skipped in results['steps'][index + 1:]:
+                    skipped['status'] = 'SKIPPED'
+                results['stopped_early'] = True
+                break
         
         # 100% - COMPLETE
-        job.progress = 100
-        job.status = 'COMPLETED'
-        job.result_data = {
-            'original_format': 'csv',
-            'target_format': target_format,
-            'output_path': output_path,
-            'row_count': len(rows),
-        }
-        job.save()
+        reporter.complete(results)
         
-        logger.info(f"File conversion completed for job {job_id}: {target_format}")
-        return job.result_data
+        logger.info(f"Pipeline completed for job {job_id}: {len(steps)} steps")
+        return results
         
     except Exception as exc:
-        logger.error(f"File conversion failed for job {job_id}: {str(exc)}")
-        job = Job.objects.get(id=job_id)
-        job.status = 'FAILED'
-        job.error_message = str(exc)
-        job.save()
+        logger.error(f"Pipeline failed for job {job_id}: {str(exc)}")
+        reporter.fail(str(exc))
         raise self.retry(exc=exc, countdown=3 ** self.request.retries)
 
-  
\ No newline at end of file
+
+# ============ RESULT CACHE EVICTION TASK ============
+
+@shared_task
+def evict_result_cache():
+    """
+    Periodic: drop old and least recently used cached job results
+    (limits in RESULT_CACHE_MAX_AGE_DAYS / RESULT_CACHE_MAX_BYTES).
+    """
+    removed = evict_results()
+    logger.info(f"Evicted {removed} cached job results")
+    return removed
+
+
+# ============ UPLOAD SESSION CLEANUP TASK ============
+
+@shared_task
+def expire_upload_sessions():
+    """
+    Periodic: delete resumable uploads that were never finalized
+    (older than UPLOAD_SESSION_TTL_HOURS) and their part files.
+    """
+    cutoff = timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    # (a FINALIZING one that old had its finalize request die half way)
+    expired = UploadSession.objects.filter(status__in=['ACTIVE', 'FINALIZING'], created_at__lt=cutoff)
+    count = 0
+    for session in expired.iterator():
+        discard_part_file(session)
+        session.delete()
+        count += 1
+    logger.info(f"Expired {count} upload sessions")
+    return count
+
+
+# ============ JOB STATE FLUSH TASK ============
+
+@shared_task
+def flush_job_state():
+    """
+    Periodic (every JOB_STATE_FLUSH_SECONDS): write the live progress of
+    running jobs from the hot store back to Postgres (see core.job_state).
+    """
+    return flush_progress()
+
+
+# ============ BLOB STORAGE TASKS ============
+
+@shared_task
+def collect_unreferenced_blobs():
+    """
+    Periodic: delete stored blobs no dataset or job has referenced
+    for BLOB_GC_GRACE_HOURS (see core.blobs).
+    """
+    removed = collect_blobs()
+    logger.info(f"Collected {removed} unreferenced blobs")
+    return removed
+
+
+@shared_task
+def move_datasets_to_blobs(after='', batch_size=500):
+    """
+    One-off: move dataset files saved under the old datasets/%Y/%m/%d/ layout
+    into blob storage, batch_size files per run (it queues the next batch
+    itself). Old files are hard-linked into place, not copied.
+    """
+    legacy = Dataset.objects.exclude(file='').exclude(file__startswith='blobs/')
+    names = list(
+        legacy.filter(file__gt=after).order_by('file').values_list('file', flat=True).distinct()[:batch_size]
+    )
+    moved = 0
+    for name in names:
+        try:
+            move_file_to_blob(name)
+            moved += 1
+        except FileNotFoundError:
+            logger.warning(f"Dataset file {name} is missing, not moved to blob storage")
+    logger.info(f"Moved {moved} dataset files to blob storage")
+    if len(names) == batch_size:
+        move_datasets_to_blobs.delay(names[-1], batch_size)
+    return moved
+
+
+# ============ JOB DISPATCH ============
+
+def job_signature(job_type, dataset_id, job_id, params=None):
+    """
+    Build the Celery signature for one job.
+    params holds the job-type options (target_format, typed_values, compression,
+    or steps for a pipeline).
+    Used by JobViewSet for single and bulk submission.
+    """
+    params = params or {}
+    if job_type == 'validate_csv':
+        return validate_csv.s(dataset_id, job_id)
+    if job_type == 'process_image':
+        return process_image.s(dataset_id, job_id)
+    if job_type == 'generate_statistics':
+        return generate_statistics.s(dataset_id, job_id)
+    if job_type == 'build_tile_pyramid':
+        return build_tile_pyramid.s(dataset_id, job_id)
+    if job_type == 'convert_file_format':
+        return convert_file_format.s(
+            dataset_id, job_id,
+            params['target_format'],
+            params.get('typed_values', False),
+            params.get('compression'),
+        )
+    if job_type == 'run_pipeline':
+        return run_pipeline.s(dataset_id, job_id, params['steps'])
+    raise ValueError(f"Unknown job type: {job_type}")
@@ -1,3 +1,1053 @@
-from django.test import TestCase
+import csv
+import hashlib
+import importlib.util
+import io
+import json
+import resource
+import shutil
+import tempfile
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from . import job_state
+from .blobs import blob_name, hold_artifacts, put_blob
+from .columnar import build_columnar, get_or_build_columnar, load_columnar, profile_columnar
+from .converters import coerce_rows, infer_column_types, write_excel, write_parquet
+from .downloads import RangeNotSatisfiable, parse_range
+from . import result_store, tasks, uploads
+from .models import Blob, Dataset, Job, JobResultCache, Project, UploadSession
+from .profiling import DatasetProfile, HyperLogLog, KLLSketch, TopK
+from .progress import ProgressReporter
+from .result_cache import evict_results, lookup_results
+from .row_index import build_row_index
+from .tasks import (
+  build_tile_pyramid, convert_file_format, generate_statistics, iter_typed_rows, merge_statistics,
+  run_pipeline, validate_csv,
+)
+from .tiles import build_pyramid
+from .utils import CsvLines, iter_csv_lines
+
+User = get_user_model()
+
+CSV_CONTENT = b'a,b\n1,2\n3,4\n'
+
+
+@override_settings(
+  CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+  JOB_STATE_URL='memory://',
+)
+class CoreTestCase(TestCase):
+  # Files go to a temp MEDIA_ROOT, live job state to an in-memory store
+
+  def setUp(self):
+    media_root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    media = override_settings(
+      MEDIA_ROOT=media_root,
+      FILE_UPLOAD_TEMP_DIR=f"{media_root}/tmp",
+      COLUMNAR_CACHE_ROOT=f"{media_root}/columnar",
+      ROW_INDEX_ROOT=f"{media_root}/rowindex",
+      TILE_ROOT=f"{media_root}/tiles",
+      UPLOAD_SESSION_ROOT=f"{media_root}/uploads",
+    )
+    media.enable()
+    self.addCleanup(media.disable)
+
+    self.store = job_state.MemoryJobState()
+    job_state.set_store(self.store)
+    self.addCleanup(job_state.set_store, None)
+
+  def make_user(self, username):
+    user = User.objects.create_user(username, f"{username}@example.com", 'password')
+    client = APIClient()
+    client.force_authenticate(user)
+    project = Project.objects.create(name=f"{username}'s project", owner=user)
+    return user, client, project
+
+  def make_dataset(self, project, content=CSV_CONTENT, name='data.csv'):
+    dataset = Dataset(
+      name=name, project=project, size=len(content), file_hash=hashlib.sha256(content).hexdigest()
+    )
+    dataset.file.save(name, ContentFile(content), save=False)
+    dataset.save()
+    return dataset
+
+
+# ============ Job coalescing ============
+
+@mock.patch('core.views.group') # tasks are queued, never run
+class CoalescedJobTests(CoreTestCase):
+  # Two users submit the same content: the second job rides on the first one's task
+
+  def setUp(self):
+    super().setUp()
+    _, self.client_a, project_a = self.make_user('alice')
+    _, self.client_b, project_b = self.make_user('bob')
+    self.dataset_a = self.make_dataset(project_a)
+    self.dataset_b = self.make_dataset(project_b)
+
+  def submit(self, client, dataset):
+    response = client.post('/api/jobs/', {'dataset_id': dataset.id, 'job_type': 'generate_statistics'}, format='json')
+    self.assertEqual(response.status_code, 201)
+    return Job.objects.get(id=response.data['id'])
+
+  def start_shared_task(self):
+    job_a = self.submit(self.client_a, self.dataset_a)
+    job_b = self.submit(self.client_b, self.dataset_b)
+    self.assertEqual(job_b.coalesced_into_id, job_a.id)
+    self.assertEqual(job_b.task_id, job_a.task_id)
+    reporter = ProgressReporter(None, job_a.id)
+    reporter.start()
+    return job_a, job_b, reporter
+
+  @mock.patch('mlplatform.celery.app.AsyncResult')
+  def test_cancelling_leader_keeps_task_running_for_other_user(self, async_result, _):
+    job_a, job_b, reporter = self.start_shared_task()
+
+    response = self.client_a.post(f'/api/jobs/{job_a.id}/cancel/')
+    self.assertEqual(response.status_code, 200)
+    async_result.return_value.revoke.assert_not_called()
+
+    job_a.refresh_from_db()
+    job_b.refresh_from_db()
+    self.assertEqual(job_a.status, 'CANCELLED')
+    self.assertEqual(job_b.status, 'PROCESSING')
+    self.assertIsNone(job_b.coalesced_into_id) # bob's job leads the task now
+
+    reporter.update(60, force=True)
+    self.assertEqual(self.client_b.get(f'/api/jobs/{job_b.id}/').data['progress'], 60)
+    reporter.complete({'row_count': 2})
+    job_a.refresh_from_db()
+    job_b.refresh_from_db()
+    self.assertEqual(job_a.status, 'CANCELLED')
+    self.assertEqual((job_b.status, job_b.result_data), ('COMPLETED', {'row_count': 2}))
+
+  @mock.patch('mlplatform.celery.app.AsyncResult')
+  def test_task_is_revoked_once_nobody_rides_on_it(self, async_result, _):
+    job_a, job_b, _ = self.start_shared_task()
+
+    self.client_a.post(f'/api/jobs/{job_a.id}/cancel/')
+    self.client_b.post(f'/api/jobs/{job_b.id}/cancel/')
+    async_result.assert_called_once_with(job_a.task_id)
+    async_result.return_value.revoke.assert_called_once_with(terminate=True)
+
+  def test_deleting_leader_hands_task_over(self, _):
+    job_a, job_b, reporter = self.start_shared_task()
+    job_c = self.submit(self.client_b, self.dataset_b)
+
+    self.assertEqual(self.client_a.delete(f'/api/jobs/{job_a.id}/').status_code, 204)
+    job_b.refresh_from_db()
+    job_c.refresh_from_db()
+    self.assertIsNone(job_b.coalesced_into_id)
+    self.assertEqual(job_c.coalesced_into_id, job_b.id)
+
+    reporter.complete({'row_count': 2})
+    self.assertEqual(
+      set(Job.objects.filter(id__in=[job_b.id, job_c.id]).values_list('status', flat=True)), {'COMPLETED'}
+    )
+
+
+
+# ============ Bulk submission ============
+
+@mock.patch('core.views.group') # tasks are queued, never run
+class BulkJobTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, self.client, project = self.make_user('alice')
+    _, _, other_project = self.make_user('bob')
+    self.dataset = self.make_dataset(project)
+    self.other_dataset = self.make_dataset(project, b'x\n1\n', 'other.csv')
+    self.bobs_dataset = self.make_dataset(other_project)
+
+  def submit(self, *jobs):
+    return self.client.post('/api/jobs/bulk/', {'jobs': list(jobs)}, format='json')
+
+  def test_jobs_are_sent_as_one_group(self, group):
+    response = self.submit(
+      {'dataset_id': self.dataset.id, 'job_type': 'validate_csv'},
+      {'dataset_id': self.other_dataset.id, 'job_type': 'generate_statistics'},
+      {'dataset_id': self.dataset.id, 'job_type': 'convert_file_format', 'target_format': 'json'},
+    )
+    self.assertEqual(response.status_code, 201)
+    self.assertEqual(response.data['count'], 3)
+
+    group.assert_called_once()
+    group.return_value.apply_async.assert_called_once_with()
+    signatures = list(group.call_args.args[0])
+    jobs = Job.objects.filter(id__in=response.data['job_ids'])
+    self.assertEqual(
+      sorted(signature.options['task_id'] for signature in signatures),
+      sorted(jobs.values_list('task_id', flat=True)),
+    )
+    self.assertEqual(
+      sorted(signature.task for signature in signatures),
+      ['core.tasks.convert_file_format', 'core.tasks.generate_statistics', 'core.tasks.validate_csv'],
+    )
+
+  def test_other_users_and_missing_datasets_reject_the_whole_batch(self, group):
+    for dataset_id in (self.bobs_dataset.id, 999999):
+      with self.subTest(dataset_id=dataset_id):
+        response = self.submit(
+          {'dataset_id': self.dataset.id, 'job_type': 'validate_csv'},
+          {'dataset_id': dataset_id, 'job_type': 'validate_csv'},
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['dataset_ids'], [dataset_id])
+    self.assertFalse(Job.objects.exists())
+    group.assert_not_called()
+
+  def test_invalid_job_spec_rejects_the_whole_batch(self, group):
+    response = self.submit(
+      {'dataset_id': self.dataset.id, 'job_type': 'validate_csv'},
+      {'dataset_id': self.dataset.id, 'job_type': 'not_a_job'},
+    )
+    self.assertEqual(response.status_code, 400)
+    self.assertIn('jobs', response.data)
+    self.assertFalse(Job.objects.exists())
+    group.assert_not_called()
+
+  def test_jobs_fail_when_the_group_cannot_be_sent(self, group):
+    group.return_value.apply_async.side_effect = ConnectionError('broker down')
+    response = self.submit(
+      {'dataset_id': self.dataset.id, 'job_type': 'validate_csv'},
+      {'dataset_id': self.other_dataset.id, 'job_type': 'validate_csv'},
+    )
+    self.assertEqual(response.status_code, 400)
+    self.assertEqual(set(Job.objects.values_list('status', flat=True)), {'FAILED'})
+
+
+# ============ Live job state ============
+
+class JobStateTests(CoreTestCase):
+  # Progress goes to the hot store (core.job_state), Postgres only at state changes
+
+  def make_store(self):
+    return job_state.MemoryJobState()
+
+  def setUp(self):
+    super().setUp()
+    self.store = self.make_store()
+    job_state.set_store(self.store)
+    _, self.client, project = self.make_user('alice')
+    self.job = Job.objects.create(
+      name='validate', project=project, job_type='validate_csv', status='PENDING', task_id='task-1'
+    )
+    self.reporter = ProgressReporter(None, self.job.id)
+    self.reporter.start()
+
+  def db_progress(self):
+    return Job.objects.values_list('status', 'progress').get(id=self.job.id)
+
+  def test_progress_is_live_without_postgres_writes(self):
+    self.reporter.update(40, force=True)
+
+    self.assertEqual(self.db_progress(), ('PROCESSING', 0))
+    self.assertEqual(self.store.read(['task-1'])['task-1']['progress'], 40)
+    self.assertEqual(self.client.get(f'/api/jobs/{self.job.id}/').data['progress'], 40)
+
+  def test_flush_writes_progress_back(self):
+    self.reporter.update(40, force=True)
+    self.assertEqual(job_state.flush_progress(), 1)
+    self.assertEqual(self.db_progress(), ('PROCESSING', 40))
+    self.assertEqual(job_state.flush_progress(), 0) # nothing written since
+
+  def test_flush_never_moves_progress_backwards(self):
+    self.reporter.checkpoint(70, {'steps': []}) # Postgres is at 70
+    job_state.write_progress('task-1', 50) # a late write from an earlier try
+    job_state.flush_progress()
+    self.assertEqual(self.db_progress(), ('PROCESSING', 70))
+
+    self.reporter.complete({'is_valid': True})
+    job_state.write_progress('task-1', 30)
+    job_state.flush_progress()
+    self.assertEqual(self.db_progress(), ('COMPLETED', 100))
+
+  def test_status_etag_changes_with_live_progress(self):
+    url = f'/api/jobs/{self.job.id}/status/'
+    etag = self.client.get(url)['ETag']
+    self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    self.reporter.update(60, force=True) # seq moves, Job.version doesn't
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+    self.assertEqual(response.data['progress'], 60)
+
+  def test_unreachable_store_falls_back_to_postgres(self):
+    broken = mock.Mock(**{'set_progress.side_effect': ConnectionError('down')})
+    job_state.set_store(broken)
+    with self.assertLogs('core.job_state', 'WARNING'):
+      self.reporter.update(30, force=True)
+    self.assertEqual(self.db_progress(), ('PROCESSING', 30))
+
+
+@unittest.skipUnless(importlib.util.find_spec('fakeredis'), "fakeredis is not installed")
+class RedisJobStateTests(JobStateTests):
+
+  def make_store(self):
+    import fakeredis
+    return job_state.RedisJobState(fakeredis.FakeRedis(), ttl=60)
+
+
+# ============ Columnar cache ============
+
+class ColumnarCacheTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, _, self.project = self.make_user('alice')
+
+  def test_whitespace_only_values_are_kept(self):
+    dataset = self.make_dataset(self.project, b'id,name,score\n1,  ,1.5\n2,bob,\t\n')
+    columnar, _ = build_columnar(dataset)
+
+    self.assertEqual(list(columnar.iter_rows()), [('1', '  ', '1.5'), ('2', 'bob', '\t')])
+    self.assertEqual(list(columnar.iter_rows(typed=True)), [(1, None, 1.5), (2, 'bob', None)])
+    self.assertEqual(columnar.schema['columns'][2]['type'], 'float')
+
+  def test_wide_csv_stays_within_the_open_file_limit(self):
+    width = 600 # two files per column would need 1200 descriptors
+    header = ','.join(f"c{i}" for i in range(width))
+    rows = '\n'.join(','.join(str(row * width + i) for i in range(width)) for row in range(3))
+    dataset = self.make_dataset(self.project, f"{header}\n{rows}\n".encode())
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, hard), hard))
+    self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+    columnar, _ = build_columnar(dataset)
+
+    self.assertEqual(columnar.row_count, 3)
+    self.assertEqual(list(columnar.iter_rows(typed=True))[2][width - 1], 3 * width - 1)
+
+  def test_dataset_without_file_hash_is_not_cached(self):
+    cached = self.make_dataset(self.project)
+    build_columnar(cached)
+    dataset = self.make_dataset(self.project, b'x,y\n1,true\n2,false\n', 'other.csv')
+    Dataset.objects.filter(id=dataset.id).update(file_hash='')
+    dataset.refresh_from_db()
+
+    self.assertIsNone(get_or_build_columnar(dataset))
+    with self.assertRaises(ValueError):
+      build_columnar(dataset)
+    self.assertIsNotNone(load_columnar(cached)) # other caches are left alone
+
+    headers, rows, _, column_types = iter_typed_rows(dataset)
+    self.assertEqual(headers, ['x', 'y'])
+    self.assertEqual(list(rows), [[1, True], [2, False]])
+    self.assertEqual(column_types, ['integer', 'boolean'])
+
+
+# ============ CSV validation ============
+
+MULTILINE_CSV = (
+  b'id,comment,score\n'
+  b'1,"line one\nline two",5\n'
+  b'2,plain,6\n'
+  b'3,"has ""quotes"", and a comma",7\n'
+  b'4,too,many,fields\n'
+  b'5,"multi\nline\nagain",8\n'
+  b'\n'
+  b'6,short\n'
+)
+
+
+class ValidateCsvTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, _, self.project = self.make_user('alice')
+
+  def validate(self):
+    dataset = self.make_dataset(self.project, MULTILINE_CSV)
+    job = Job.objects.create(name='validate', project=self.project, job_type='validate_csv', status='PENDING')
+    # Tiny read chunks, so quoted records and lines are cut across chunk boundaries
+    small_chunks = lambda file_obj: iter_csv_lines(file_obj, 7)
+    with mock.patch('core.tasks.iter_csv_lines', small_chunks), mock.patch('core.columnar.iter_csv_lines', small_chunks):
+      validate_csv.apply(args=(dataset.id, job.id))
+    job.refresh_from_db()
+    self.assertEqual(job.status, 'COMPLETED')
+    return job.result_data
+
+  def assertCounted(self, report):
+    self.assertEqual(report['headers'], ['id', 'comment', 'score'])
+    self.assertEqual(report['row_count'], 6)
+    self.assertEqual(report['malformed_rows'], 2)
+    self.assertEqual(report['malformed_row_lines'], [6, 11])
+
+  @override_settings(COLUMNAR_CACHE_ENABLED=False)
+  def test_streamed_validation_counts_multiline_records(self):
+    self.assertCounted(self.validate())
+
+  def test_validation_through_the_columnar_cache(self):
+    first, second = self.validate(), self.validate() # the second upload reads the cached schema
+    self.assertEqual((first['source'], second['source']), ('csv', 'columnar_cache'))
+    self.assertCounted(first)
+    self.assertCounted(second)
+
+
+# ============ Statistics ============
+
+STATS_CONTENT = b'id,name,score,flag\n' + b''.join(
+  b'%d,%s,%s,%s\n' % (i, [b'ann', b'bob', b'', b'cy'][i % 4], b'' if i % 5 == 0 else b'%d.5' % (i * 7 % 11), [b'true', b'false'][i % 2])
+  for i in range(23)
+)
+
+
+def profile_rows(count):
+  # Integers, skewed strings with nulls (33 distinct) and floats
+  return [
+    [str(i), ['red', 'green', 'blue', 'red', ''][i % 5] + ('' if i % 7 else str(i % 10)), f"{(i * 37) % 1000 / 8}"]
+    for i in range(count)
+  ]
+
+
+class ProfilingTests(TestCase):
+
+  def json_round_trip(self, sketch):
+    # Through JSON and back, as between Celery tasks
+    state = json.loads(json.dumps(sketch.to_state()))
+    return type(sketch).from_state(state)
+
+  def test_sketch_states_round_trip(self):
+    hll, kll, topk = HyperLogLog(), KLLSketch(), TopK(capacity=8)
+    for i in range(5000):
+      hll.add(f"value-{i % 3000}")
+      kll.add(float(i))
+      topk.add(str(i % 5) if i % 3 else f"rare-{i}")
+
+    for sketch in (hll, kll, topk):
+      copy = self.json_round_trip(sketch)
+      self.assertEqual(copy.to_state(), sketch.to_state())
+    self.assertEqual(self.json_round_trip(hll).count(), hll.count())
+    self.assertEqual(self.json_round_trip(kll).quantiles([0.1, 0.5, 0.9]), kll.quantiles([0.1, 0.5, 0.9]))
+    self.assertEqual(self.json_round_trip(topk).top(), topk.top())
+
+    copy = self.json_round_trip(kll) # still usable after the trip
+    copy.add_many([5000.0] * 10)
+    self.assertEqual(copy.size, sum(len(items) for items in copy.compactors))
+
+  def test_merged_states_match_one_pass(self):
+    headers = ['id', 'color', 'score']
+    rows = profile_rows(6000)
+    whole = DatasetProfile(headers)
+    for row in rows:
+      whole.add_row(row)
+
+    merged = None
+    for start, stop in ((0, 1000), (1000, 3500), (3500, 6000)):
+      part = DatasetProfile(headers)
+      for row in rows[start:stop]:
+        part.add_row(row)
+      part = DatasetProfile.from_state(json.loads(json.dumps(part.to_state())))
+      merged = part if merged is None else merged.merge(part)
+
+    expected, actual = whole.to_dict(), merged.to_dict()
+    self.assertEqual(actual['total_rows'], 6000)
+    self.assertEqual(actual['null_counts'], expected['null_counts'])
+    for name in headers:
+      column, expected_column = actual['columns'][name], expected['columns'][name]
+      for key in ('type', 'count', 'null_count', 'min', 'max'):
+        self.assertEqual(column.get(key), expected_column.get(key))
+      # Register-wise max: the merged HyperLogLog is the one-pass one
+      self.assertEqual(column['approx_distinct'], expected_column['approx_distinct'])
+    self.assertAlmostEqual(actual['columns']['score']['mean'], expected['columns']['score']['mean'])
+    self.assertAlmostEqual(actual['columns']['score']['variance'], expected['columns']['score']['variance'])
+    # Fewer distinct colors than counters, so Misra-Gries counts are exact
+    self.assertEqual(actual['columns']['color']['top_values'], expected['columns']['color']['top_values'])
+    # KLL quantiles stay within the sketch's ~1% rank error of each other
+    for key, value in expected['columns']['id']['quantiles'].items():
+      self.assertLess(abs(actual['columns']['id']['quantiles'][key] - value), 6000 * 0.02)
+
+
+class StatisticsTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, _, self.project = self.make_user('alice')
+    self.dataset = self.make_dataset(self.project, STATS_CONTENT)
+
+  def run_statistics(self):
+    # generate_statistics here, then its chord (if any) in order, in this process
+    job = Job.objects.create(name='stats', project=self.project, job_type='generate_statistics', status='PENDING')
+    with mock.patch('core.tasks.chord') as chord:
+      generate_statistics.apply(args=(self.dataset.id, job.id))
+    if chord.called:
+      chunk_tasks, = chord.call_args.args
+      callback, = chord.return_value.call_args.args
+      states = [signature.apply().get() for signature in chunk_tasks.tasks]
+      merge_statistics(states, *callback.args, **callback.kwargs)
+    job.refresh_from_db()
+    self.assertEqual(job.status, 'COMPLETED')
+    return job.result_data, chord.called
+
+  def assertSameStatistics(self, stats, expected):
+    self.assertEqual(stats['total_rows'], expected['total_rows'])
+    self.assertEqual(stats['null_counts'], expected['null_counts'])
+    for name, column in expected['columns'].items():
+      for key in ('mean', 'variance', 'std'):
+        if key in column:
+          self.assertAlmostEqual(stats['columns'][name].pop(key), column.pop(key))
+      self.assertEqual(stats['columns'][name], column)
+
+  def test_columnar_statistics_fan_out_over_row_ranges(self):
+    columnar, _ = build_columnar(self.dataset)
+    expected = profile_columnar(columnar).to_dict()
+
+    with override_settings(STATS_CHUNK_ROWS=5):
+      stats, fanned_out = self.run_statistics()
+    self.assertTrue(fanned_out)
+    self.assertEqual((stats['source'], stats['chunk_count']), ('columnar_cache', 5))
+    self.assertSameStatistics(stats, expected)
+    self.assertEqual(stats['columns']['name']['null_count'], 6)
+
+  def test_csv_statistics_split_and_merged_match_one_pass(self):
+    content = STATS_CONTENT + b'23,"two\nlines, quoted",1.5,true\n24,"""q""",,false\n'
+    self.dataset = self.make_dataset(self.project, content)
+    rows = list(csv.reader(io.StringIO(content.decode())))
+    expected = DatasetProfile(rows[0])
+    for row in rows[1:]:
+      expected.add_row(row)
+
+    with override_settings(STATS_CHUNK_SIZE=40):
+      stats, fanned_out = self.run_statistics()
+    self.assertTrue(fanned_out)
+    self.assertGreater(stats['chunk_count'], 5)
+    self.assertEqual(stats['source'], 'csv')
+    self.assertSameStatistics(stats, expected.to_dict())
+    self.assertEqual(stats['columns']['name']['top_values'][0], {'value': 'ann', 'count': 6})
+
+
+# ============ Format conversion ============
+
+class ConverterTests(TestCase):
+
+  def test_integers_past_int64_widen_to_float(self):
+    headers = ['id', 'big']
+    rows = [['1', str(2**63)], ['2', '3'], ['3', str(-2**63)]]
+    column_types = infer_column_types(headers, rows)
+    self.assertEqual(column_types, ['integer', 'float'])
+
+    output = io.BytesIO()
+    self.assertEqual(write_parquet(headers, coerce_rows(rows, column_types), output, column_types), 3)
+
+  def test_excel_rolls_over_to_a_new_sheet(self):
+    import openpyxl
+
+    output = io.BytesIO()
+    rows = ([i, f"row {i}"] for i in range(7))
+    row_count, sheet_count, _ = write_excel(['id', 'name'], rows, output, max_rows_per_sheet=3)
+    self.assertEqual((row_count, sheet_count), (7, 4))
+
+    workbook = openpyxl.load_workbook(output, read_only=True)
+    self.assertEqual(workbook.sheetnames, ['Sheet1', 'Sheet2', 'Sheet3', 'Sheet4'])
+    sheets = [list(sheet.iter_rows(values_only=True)) for sheet in workbook]
+    # Every sheet repeats the header and holds at most max_rows_per_sheet rows with it
+    self.assertEqual(sheets[0], [('id', 'name'), (0, 'row 0'), (1, 'row 1')])
+    self.assertEqual(sheets[3], [('id', 'name'), (6, 'row 6')])
+    self.assertEqual([row[0] for sheet in sheets for row in sheet[1:]], list(range(7)))
+
+  def test_empty_excel_still_has_the_header(self):
+    import openpyxl
+
+    output = io.BytesIO()
+    self.assertEqual(write_excel(['id', 'name'], iter([]), output, max_rows_per_sheet=3)[:2], (0, 1))
+    workbook = openpyxl.load_workbook(output, read_only=True)
+    self.assertEqual(list(workbook['Sheet1'].iter_rows(values_only=True)), [('id', 'name')])
+
+
+CONVERT_CSV = b'id,name,score,flag\n1,ann,1.5,true\n2,,,false\n3,"b, ""c""",-2,true\n'
+
+TYPED_RECORDS = [
+  {'id': 1, 'name': 'ann', 'score': 1.5, 'flag': True},
+  {'id': 2, 'name': None, 'score': None, 'flag': False},
+  {'id': 3, 'name': 'b, "c"', 'score': -2.0, 'flag': True}, # a float column, from the cache
+]
+
+TEXT_RECORDS = [
+  {'id': '1', 'name': 'ann', 'score': '1.5', 'flag': 'true'},
+  {'id': '2', 'name': '', 'score': '', 'flag': 'false'},
+  {'id': '3', 'name': 'b, "c"', 'score': '-2', 'flag': 'true'},
+]
+
+
+class ConvertFileFormatTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, _, self.project = self.make_user('alice')
+    self.dataset = self.make_dataset(self.project, CONVERT_CSV)
+
+  def convert(self, target_format, **options):
+    job = Job.objects.create(name='convert', project=self.project, job_type='convert_file_format', status='PENDING')
+    convert_file_format.apply(args=(self.dataset.id, job.id, target_format), kwargs=options)
+    job.refresh_from_db()
+    self.assertEqual(job.status, 'COMPLETED')
+    with default_storage.open(job.result_data['output_path'], 'rb') as output:
+      return job.result_data, output.read().decode('utf-8')
+
+  def test_json_output(self):
+    for typed, records in ((True, TYPED_RECORDS), (False, TEXT_RECORDS)):
+      with self.subTest(typed_values=typed):
+        result, text = self.convert('json', typed_values=typed)
+        self.assertEqual(result['row_count'], 3)
+        self.assertEqual(text, json.dumps(records, indent=2))
+
+  def test_ndjson_output(self):
+    for typed, records in ((True, TYPED_RECORDS), (False, TEXT_RECORDS)):
+      with self.subTest(typed_values=typed):
+        result, text = self.convert('ndjson', typed_values=typed)
+        self.assertEqual(result['row_count'], 3)
+        self.assertEqual([json.loads(line) for line in text.splitlines()], records)
+        self.assertTrue(text.endswith('}\n'))
+
+  @override_settings(COLUMNAR_CACHE_ENABLED=False)
+  def test_typed_json_without_the_columnar_cache(self):
+    _, text = self.convert('json', typed_values=True)
+    self.assertEqual(json.loads(text), TYPED_RECORDS)
+
+
+class PipelineTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, _, self.project = self.make_user('alice')
+    self.dataset = self.make_dataset(self.project, CONVERT_CSV)
+
+  def test_failing_step_keeps_the_finished_ones(self):
+    steps = [
+      {'job_type': 'validate_csv'},
+      {'job_type': 'generate_statistics'},
+      {'job_type': 'convert_file_format', 'target_format': 'json'},
+    ]
+    job = Job.objects.create(name='pipeline', project=self.project, job_type='run_pipeline', status='PENDING')
+    with mock.patch('core.tasks.convert_dataset', side_effect=OSError('disk full')) as convert, \
+        mock.patch('core.tasks.build_statistics', wraps=tasks.build_statistics) as build_statistics:
+      run_pipeline.apply(args=(self.dataset.id, job.id, steps)) # eager: the retries run right away
+
+    job.refresh_from_db()
+    self.assertEqual((job.status, job.error_message), ('FAILED', 'disk full'))
+    self.assertEqual(convert.call_count, 1 + run_pipeline.max_retries)
+    result = job.result_data
+    self.assertEqual([step['status'] for step in result['steps']], ['COMPLETED', 'COMPLETED', 'FAILED'])
+    self.assertEqual(result['steps'][2]['error'], 'disk full')
+    self.assertEqual(result['steps'][0]['result']['row_count'], 3)
+    self.assertEqual(result['steps'][1]['result']['total_rows'], 3)
+    # Finished steps came from the result cache on every retry
+    build_statistics.assert_called_once()
+    self.assertTrue(result['steps'][1]['cached'])
+
+
+# ============ Tile pyramids ============
+
+@mock.patch('PIL.Image.MAX_IMAGE_PIXELS', 1000) # Pillow refuses anything over 2000 pixels
+class TilePyramidTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    from PIL import Image
+
+    _, _, self.project = self.make_user('alice')
+    image_file = io.BytesIO()
+    Image.new('RGB', (40, 30), 'red').save(image_file, format='PNG')
+    self.dataset = self.make_dataset(self.project, image_file.getvalue(), name='scan.png')
+
+  @override_settings(TILE_MAX_PIXELS=1200, TILE_SIZE=8)
+  def test_images_up_to_the_limit_are_tiled(self):
+    from PIL import Image
+
+    open_image = Image.open
+    limits = []
+
+    def watched_open(*args, **kwargs):
+      limits.append(Image.MAX_IMAGE_PIXELS)
+      return open_image(*args, **kwargs)
+
+    with mock.patch('PIL.Image.open', watched_open):
+      descriptor = build_pyramid(self.dataset)
+    self.assertEqual((descriptor['width'], descriptor['height'], descriptor['levels']), (40, 30, 7))
+    self.assertEqual(set(limits), {1000}) # Pillow's process-wide limit is left alone
+
+  @override_settings(TILE_MAX_PIXELS=10_000)
+  def test_images_pillow_refuses_fail_the_job(self):
+    job = Job.objects.create(name='tiles', project=self.project, job_type='build_tile_pyramid', status='PENDING')
+    with mock.patch('PIL.Image.MAX_IMAGE_PIXELS', 500): # Pillow refuses anything over 1000 pixels
+      build_tile_pyramid.apply(args=(self.dataset.id, job.id))
+
+    job.refresh_from_db()
+    self.assertEqual(job.status, 'FAILED')
+    self.assertIn('MAX_IMAGE_PIXELS', job.error_message)
+
+  @override_settings(TILE_MAX_PIXELS=1000)
+  def test_larger_images_fail_the_job(self):
+    job = Job.objects.create(name='tiles', project=self.project, job_type='build_tile_pyramid', status='PENDING')
+    build_tile_pyramid.apply(args=(self.dataset.id, job.id))
+
+    job.refresh_from_db()
+    self.assertEqual(job.status, 'FAILED')
+    self.assertIn('40 x 30', job.error_message)
+    self.assertIn('TILE_MAX_PIXELS', job.error_message)
+
+
+# ============ Dataset uploads ============
+
+class DatasetUploadTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.user, self.client, self.project = self.make_user('alice')
+
+  def upload(self, content, method='post', url='/api/datasets/', **data):
+    upload = SimpleUploadedFile('data.csv', content, content_type='text/csv')
+    return getattr(self.client, method)(url, {'file': upload, **data}, format='multipart')
+
+  def test_file_hash_comes_from_the_content(self):
+    response = self.upload(CSV_CONTENT, name='data', project=self.project.id, file_hash='0' * 64)
+    self.assertEqual(response.status_code, 201)
+    dataset = Dataset.objects.get(id=response.data['id'])
+    self.assertEqual(dataset.file_hash, hashlib.sha256(CSV_CONTENT).hexdigest())
+    self.assertEqual(dataset.file.name, blob_name(dataset.file_hash))
+
+  def test_replacing_the_file_moves_the_blob_reference(self):
+    dataset_id = self.upload(CSV_CONTENT, name='data', project=self.project.id).data['id']
+    old_hash = Dataset.objects.get(id=dataset_id).file_hash
+
+    new_content = b'a,b\n5,6\n'
+    response = self.upload(
+      new_content, 'put', f'/api/datasets/{dataset_id}/', name='data', project=self.project.id
+    )
+    self.assertEqual(response.status_code, 200)
+    dataset = Dataset.objects.get(id=dataset_id)
+    self.assertEqual(dataset.file_hash, hashlib.sha256(new_content).hexdigest())
+    self.assertEqual(dataset.file.name, blob_name(dataset.file_hash))
+    self.assertEqual(dataset.size, len(new_content))
+    self.assertEqual(Blob.objects.get(sha256=dataset.file_hash).ref_count, 1)
+    self.assertEqual(Blob.objects.get(sha256=old_hash).ref_count, 0)
+
+  def test_patch_without_a_file_keeps_it(self):
+    dataset_id = self.upload(CSV_CONTENT, name='data', project=self.project.id).data['id']
+    response = self.client.patch(f'/api/datasets/{dataset_id}/', {'name': 'renamed'}, format='json')
+    self.assertEqual(response.status_code, 200)
+    dataset = Dataset.objects.get(id=dataset_id)
+    self.assertEqual(dataset.name, 'renamed')
+    self.assertEqual(dataset.file_hash, hashlib.sha256(CSV_CONTENT).hexdigest())
+    self.assertEqual(Blob.objects.get(sha256=dataset.file_hash).ref_count, 1)
+
+
+# ============ Resumable uploads ============
+
+class UploadSessionTests(CoreTestCase):
+  CHUNK_SIZE = 1024 * 1024
+
+  def setUp(self):
+    super().setUp()
+    _, self.client, self.project = self.make_user('alice')
+    self.content = b'a,b\n' + b''.join(b'%d,%d\n' % (i, i * i) for i in range(300000))
+
+  def start(self, **fields):
+    response = self.client.post('/api/uploads/', {
+      'project': self.project.id, 'name': 'big', 'filename': 'big.csv', 'content_type': 'text/csv',
+      'size': len(self.content), 'chunk_size': self.CHUNK_SIZE, **fields,
+    }, format='json')
+    self.assertEqual(response.status_code, 201)
+    return response.data['id'], response.data['chunk_count']
+
+  def put_chunk(self, session_id, index):
+    chunk = self.content[index * self.CHUNK_SIZE:(index + 1) * self.CHUNK_SIZE]
+    response = self.client.put(
+      f'/api/uploads/{session_id}/chunks/{index}/', chunk, content_type='application/octet-stream'
+    )
+    self.assertEqual(response.status_code, 200)
+
+  def test_catch_up_hashes_outside_the_lock(self):
+    sha256 = hashlib.sha256(self.content).hexdigest()
+    session_id, chunk_count = self.start()
+    for index in range(2, chunk_count):
+      self.put_chunk(session_id, index)
+    self.put_chunk(session_id, 0)
+
+    catch_up = uploads._catch_up
+    calls = []
+
+    def watched_catch_up(state, session, fd):
+      calls.append(uploads._session_hashes_lock.locked())
+      if len(calls) == 1:
+        uploads.chunk_received(session) # another request while this one hashes
+        self.assertTrue(state.pending)
+      catch_up(state, session, fd)
+
+    with mock.patch.object(uploads, '_catch_up', watched_catch_up):
+      self.put_chunk(session_id, 1)
+    self.assertEqual(calls, [False]) # the first pass got to the end, nothing left to catch up
+    self.assertEqual(UploadSession.objects.get(id=session_id).ingest['sha256'], sha256)
+
+  def test_hash_is_shared_once_chunks_are_in(self):
+    sha256 = hashlib.sha256(self.content).hexdigest()
+    session_id, chunk_count = self.start()
+    for index in reversed(range(chunk_count)): # out of order, caught up from the recorded chunks
+      self.put_chunk(session_id, index)
+
+    session = UploadSession.objects.get(id=session_id)
+    self.assertEqual(session.ingest['sha256'], sha256)
+    self.assertNotIn(session.id, uploads._session_hashes) # nothing kept in the process
+
+    with mock.patch.object(uploads.Ingest, 'feed') as feed:
+      response = self.client.post(f'/api/uploads/{session_id}/finalize/')
+    self.assertEqual(response.status_code, 201)
+    feed.assert_not_called() # the part file wasn't read again
+    self.assertEqual(Dataset.objects.get(id=response.data['id']).file_hash, sha256)
+
+  def test_finalize_hashes_the_file_without_a_shared_hash(self):
+    session_id, chunk_count = self.start(sha256=hashlib.sha256(self.content).hexdigest())
+    for index in range(chunk_count):
+      self.put_chunk(session_id, index)
+    UploadSession.objects.filter(id=session_id).update(ingest=None) # e.g. the owner restarted
+
+    self.assertEqual(self.client.post(f'/api/uploads/{session_id}/finalize/').status_code, 201)
+
+  def test_only_one_finalize_claims_the_session(self):
+    session_id, chunk_count = self.start()
+    for index in range(chunk_count):
+      self.put_chunk(session_id, index)
+
+    # Another finalize claims it after this one loaded the session
+    loaded = UploadSession.objects.get(id=session_id)
+    UploadSession.objects.filter(id=session_id).update(status='FINALIZING')
+    with mock.patch('core.views.UploadSessionViewSet.get_object', return_value=loaded):
+      self.assertEqual(self.client.post(f'/api/uploads/{session_id}/finalize/').status_code, 409)
+    self.assertFalse(Dataset.objects.exists())
+
+  def test_failed_finalize_can_be_retried(self):
+    fixed = b'x,y' + self.content[3:]
+    session_id, chunk_count = self.start(sha256=hashlib.sha256(fixed).hexdigest())
+    for index in range(chunk_count):
+      self.put_chunk(session_id, index)
+
+    self.assertEqual(self.client.post(f'/api/uploads/{session_id}/finalize/').status_code, 400)
+    self.assertEqual(UploadSession.objects.get(id=session_id).status, 'ACTIVE')
+
+    self.content = fixed
+    self.put_chunk(session_id, 0) # the hash is redone with the new chunk
+    response = self.client.post(f'/api/uploads/{session_id}/finalize/')
+    self.assertEqual(response.status_code, 201)
+    self.assertEqual(Dataset.objects.get(id=response.data['id']).file_hash, hashlib.sha256(fixed).hexdigest())
+
+
+
+# ============ Blobs ============
+
+class HoldArtifactsTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, _, self.project = self.make_user('alice')
+    self.hashes = {}
+    for content in (b'a', b'b', b'c'):
+      self.hashes[content] = hashlib.sha256(content).hexdigest()
+      put_blob(ContentFile(content, name='blob'))
+
+  def ref_counts(self):
+    return {
+      content: Blob.objects.get(sha256=sha256).ref_count for content, sha256 in self.hashes.items()
+    }
+
+  def path(self, content):
+    return blob_name(self.hashes[content])
+
+  def test_references_follow_the_result(self):
+    jobs = [
+      Job.objects.create(name=f'job {i}', project=self.project, status='PROCESSING', task_id='task-1')
+      for i in range(2)
+    ]
+    rows = Job.objects.filter(task_id='task-1')
+
+    hold_artifacts(rows, {'output_path': self.path(b'a'), 'rows': [[self.path(b'b')]]})
+    self.assertEqual(self.ref_counts(), {b'a': 2, b'b': 2, b'c': 0})
+
+    # A later checkpoint / the final result: b is dropped, c taken, a kept once per job
+    hold_artifacts(rows, [{'output_path': self.path(b'a')}, {'thumbnail': self.path(b'c')}])
+    self.assertEqual(self.ref_counts(), {b'a': 2, b'b': 0, b'c': 2})
+    self.assertEqual(rows.get(id=jobs[0].id).artifacts, sorted([self.hashes[b'a'], self.hashes[b'c']]))
+
+    hold_artifacts(rows, {'output_path': self.path(b'a'), 'again': self.path(b'a')})
+    self.assertEqual(self.ref_counts(), {b'a': 2, b'b': 0, b'c': 0})
+
+    rows.get(id=jobs[0].id).delete()
+    self.assertEqual(self.ref_counts(), {b'a': 1, b'b': 0, b'c': 0})
+
+
+# ============ Result cache ============
+
+class ResultCacheBlobTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, _, self.project = self.make_user('alice')
+    self.output = put_blob(ContentFile(b'converted', name='output'))
+    self.sha256 = hashlib.sha256(b'converted').hexdigest()
+    self.job = Job.objects.create(
+      name='convert', project=self.project, job_type='convert_file_format', status='PENDING',
+      cache_key='c' * 64, task_id='task-1',
+    )
+    ProgressReporter(None, self.job.id).complete({'output_path': self.output})
+
+  def ref_count(self):
+    return Blob.objects.get(sha256=self.sha256).ref_count
+
+  def test_cache_entry_holds_a_reference(self):
+    self.assertEqual(JobResultCache.objects.get(key='c' * 64).artifacts, [self.sha256])
+    self.assertEqual(self.ref_count(), 2) # the job and the cache entry
+
+    Job.objects.get(id=self.job.id).delete()
+    self.assertEqual(self.ref_count(), 1)
+    self.assertIn('c' * 64, lookup_results(['c' * 64]))
+
+    evict_results(max_bytes=0)
+    self.assertEqual(self.ref_count(), 0)
+
+  def test_missing_blob_is_a_cache_miss(self):
+    Blob.objects.filter(sha256=self.sha256).delete()
+    self.assertEqual(lookup_results(['c' * 64]), {})
+    self.assertFalse(JobResultCache.objects.exists())
+
+
+# ============ Offloaded results ============
+
+class ResultStoreTests(CoreTestCase):
+
+  @override_settings(RESULT_OFFLOAD_BYTES=100, RESULT_OFFLOAD_COMPRESSION='zstd')
+  @mock.patch('core.result_store._zstd_warned', False)
+  @unittest.skipIf(importlib.util.find_spec('zstandard'), "zstandard is installed")
+  def test_zstd_without_zstandard_falls_back_to_gzip_with_one_warning(self):
+    result = {'row_count': 5, 'rows': list(range(100))}
+    with self.assertLogs('core.result_store', 'WARNING') as logs:
+      packed = [result_store.pack_result(result) for _ in range(3)]
+
+    self.assertEqual(len(logs.records), 1)
+    self.assertEqual({pointer['offloaded']['encoding'] for pointer in packed}, {'gzip'})
+    self.assertEqual(result_store.unpack_result(packed[0]), result)
+
+
+# ============ Downloads ============
+
+class ParseRangeTests(TestCase):
+
+  def test_ranges(self):
+    cases = [
+      ('bytes=0-99', 1000, (0, 99)),
+      ('bytes=900-', 1000, (900, 999)),
+      ('bytes=900-5000', 1000, (900, 999)), # clamped to the end of the file
+      ('bytes=-100', 1000, (900, 999)),
+      ('bytes=-5000', 1000, (0, 999)),
+      (' bytes=5-5 ', 1000, (5, 5)),
+    ]
+    for header, size, expected in cases:
+      with self.subTest(header=header):
+        self.assertEqual(parse_range(header, size), expected)
+
+  def test_whole_file(self):
+    # No header, several ranges, other units, nonsense and backwards ranges are ignored
+    for header in [None, '', 'bytes=0-1,5-6', 'items=0-1', 'bytes=-', 'bytes=a-b', 'bytes=10-5']:
+      with self.subTest(header=header):
+        self.assertIsNone(parse_range(header, 1000))
+
+  def test_not_satisfiable(self):
+    for header, size in [('bytes=1000-', 1000), ('bytes=1000-2000', 1000), ('bytes=-0', 1000), ('bytes=-10', 0)]:
+      with self.subTest(header=header, size=size):
+        with self.assertRaises(RangeNotSatisfiable):
+          parse_range(header, size)
+
+
+class DownloadTests(CoreTestCase):
+
+  def setUp(self):
+    super().setUp()
+    _, self.client, project = self.make_user('alice')
+    self.dataset = self.make_dataset(project, b'0123456789' * 10)
+    self.url = f'/api/datasets/{self.dataset.id}/download/'
+
+  def body(self, response):
+    return b''.join(response.streaming_content)
+
+  def test_range_request(self):
+    response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+    self.assertEqual(response.status_code, 206)
+    self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+    self.assertEqual(self.body(response), b'0123456789')
+
+    response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+    self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */100'))
+
+  def test_etag_and_if_range(self):
+    response = self.client.get(self.url)
+    etag = response['ETag']
+    self.assertEqual(len(self.body(response)), 100)
+    self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+    # The client's copy is stale: the whole file instead
+    self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old"').status_code, 200)
+
+
+# ============ Row index ============
+
+QUOTED_CSV = (
+  '\ufeffid,text\r\n'
+  '1,"two\nlines"\r\n'
+  '2,héllo\r\n'
+  '\r\n'
+  '3,"a ""quoted""\r\nfield"\n'
+  '4,last'
+).encode('utf-8')
+
+QUOTED_ROWS = [['1', 'two\nlines'], ['2', 'héllo'], ['3', 'a "quoted"\r\nfield'], ['4', 'last']]
+
+
+class CsvLinesTests(TestCase):
+
+  def test_position_is_where_each_record_starts(self):
+    # Small chunks, so lines and multi-byte characters straddle chunk boundaries
+    for chunk_size in (3, 7, 64 * 1024):
+      with self.subTest(chunk_size=chunk_size):
+        lines = CsvLines(io.BytesIO(QUOTED_CSV), chunk_size)
+        reader = csv.reader(lines)
+        next(reader)
+        starts = []
+        while True:
+          start = lines.position
+          row = next(reader, None)
+          if row is None:
+            break
+          if row:
+            starts.append(start)
+            # Parsing from the recorded offset gives the same row back
+            self.assertEqual(next(csv.reader(io.StringIO(QUOTED_CSV[start:].decode('utf-8')))), row)
+        self.assertEqual(len(starts), 4)
+        self.assertEqual(lines.position, len(QUOTED_CSV))
+
+
+@override_settings(ROW_INDEX_INTERVAL=2)
+class RowIndexTests(CoreTestCase):
+
+  def test_pages_start_inside_blocks(self):
+    _, client, project = self.make_user('alice')
+    dataset = self.make_dataset(project, QUOTED_CSV)
+    index = build_row_index(dataset)
+
+    self.assertEqual(len(index), 4)
+    self.assertEqual(index.headers(), ['id', 'text'])
+    for start in range(4):
+      for stop in range(start, 5):
+        self.assertEqual(index[start:stop], QUOTED_ROWS[start:stop])
+
+    response = client.get(f'/api/datasets/{dataset.id}/rows/?limit=2&offset=1')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.data['results'], QUOTED_ROWS[1:3])
@@ -0,0 +1,210 @@
+"""
+Deep Zoom (DZI) tile pyramids for large images
+
+What it does:
+- Cuts an image into TILE_SIZE x TILE_SIZE tiles at every zoom level,
+  so a viewer (e.g. OpenSeadragon) only downloads the tiles on screen
+- Keyed by Dataset.file_hash and the tile settings, so identical uploads
+  share one pyramid
+- Builds the levels from full resolution down: each level is the one
+  above it halved (Image.reduce), and the previous level is dropped as
+  soon as the next one exists, so memory stays around 1.25x one decode
+- That decode is the whole image, so images over TILE_MAX_PIXELS (or
+  over what Pillow is set to open) are refused (ImageTooLarge) before
+  anything is decoded
+- Tiles of a level are cropped and encoded on a thread pool
+
+Layout (the standard DZI layout):
+  TILE_ROOT/<file_hash>-<tile size>-<overlap>-<format>/
+    image.dzi                       XML descriptor
+    pyramid.json                    the same, as JSON (plus tile_count)
+    image_files/<level>/<col>_<row>.<format>
+
+Level <max> is full resolution, level 0 is 1x1 pixel.
+"""
+
+import json
+import math
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .utils import file_lock
+
+# Report progress every this many tiles
+PROGRESS_TILES = 64
+
+DZI_TEMPLATE = (
+  '<?xml version="1.0" encoding="UTF-8"?>\n'
+  '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+  'TileSize="{tile_size}" Overlap="{overlap}" Format="{format}">'
+  '<Size Width="{width}" Height="{height}"/></Image>\n'
+)
+
+# Pillow encoder name per tile format
+PIL_FORMATS = {
+  'jpeg': 'JPEG',
+  'png': 'PNG',
+}
+
+
+class ImageTooLarge(ValueError):
+  pass
+
+
+def pyramid_dir(file_hash):
+  name = f"{file_hash}-{settings.TILE_SIZE}-{settings.TILE_OVERLAP}-{settings.TILE_FORMAT}"
+  return Path(settings.TILE_ROOT) / name
+
+
+def tile_path(directory, level, col, row, tile_format):
+  return Path(directory) / 'image_files' / str(level) / f"{col}_{row}.{tile_format}"
+
+
+def load_pyramid(dataset):
+  # The pyramid's descriptor (with its directory), or None if it wasn't built
+  directory = pyramid_dir(dataset.file_hash)
+  try:
+    with open(directory / 'pyramid.json') as descriptor_file:
+      descriptor = json.load(descriptor_file)
+  except (FileNotFoundError, ValueError):
+    return None
+  descriptor['directory'] = str(directory)
+  return descriptor
+
+
+def level_sizes(width, height):
+  # [(width, height) of level 0, ..., of the full-resolution level]
+  max_level = math.ceil(math.log2(max(width, height, 1)))
+  return [
+    (math.ceil(width / 2 ** (max_level - level)), math.ceil(height / 2 ** (max_level - level)))
+    for level in range(max_level + 1)
+  ]
+
+
+def _tile_boxes(width, height, tile_size, overlap):
+  # (col, row, crop box) for every tile of one level, with overlap on inner edges
+  for row in range(math.ceil(height / tile_size)):
+    for col in range(math.ceil(width / tile_size)):
+      left = col * tile_size - (overlap if col else 0)
+      top = row * tile_size - (overlap if row else 0)
+      right = min((col + 1) * tile_size + overlap, width)
+      bottom = min((row + 1) * tile_size + overlap, height)
+      yield col, row, (left, top, right, bottom)
+
+
+def _save_tile(image, box, path, pil_format, quality):
+  tile = image.crop(box)
+  if pil_format == 'JPEG':
+    tile.save(path, format=pil_format, quality=quality)
+  else:
+    tile.save(path, format=pil_format)
+
+
+def _open_image(image_file):
+  # Image.open only reads the header, so the size is checked before decoding.
+  # Pillow's decompression bomb limit (2 x Image.MAX_IMAGE_PIXELS, ~179 MP by
+  # default) still applies: it is process-wide, so it is left as configured
+  # and Pillow refusing the image counts as too large too
+  from PIL import Image
+
+  try:
+    image = Image.open(image_file)
+  except Image.DecompressionBombError as exc:
+    raise ImageTooLarge(f"{exc} (PIL.Image.MAX_IMAGE_PIXELS)") from exc
+
+  width, height = image.size
+  max_pixels = settings.TILE_MAX_PIXELS
+  if width * height > max_pixels:
+    raise ImageTooLarge(
+      f"Image is {width} x {height} ({width * height / 1e6:.0f} MP), over the "
+      f"{max_pixels / 1e6:.0f} MP a tile pyramid can be built for (TILE_MAX_PIXELS)."
+    )
+  image.load()
+  return image
+
+
+def build_pyramid(dataset, on_progress=None):
+  """
+  Build the dataset's DZI pyramid (once per file_hash) and return its descriptor.
+  on_progress(fraction) is called as tiles are written.
+  Raises ImageTooLarge for images over TILE_MAX_PIXELS.
+  """
+  final_dir = pyramid_dir(dataset.file_hash)
+  with file_lock(final_dir.parent, final_dir.name):
+    # Another worker may have built it while we waited for the lock
+    existing = load_pyramid(dataset)
+    if existing:
+      return existing
+
+    tile_size = settings.TILE_SIZE
+    overlap = settings.TILE_OVERLAP
+    tile_format = settings.TILE_FORMAT
+    pil_format = PIL_FORMATS[tile_format]
+
+    with default_storage.open(dataset.file.name, 'rb') as image_file:
+      image = _open_image(image_file)
+
+    # Pillow can only halve RGB(A)/L images; JPEG tiles can't have alpha
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+      image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+      image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    width, height = image.size
+    sizes = level_sizes(width, height)
+    max_level = len(sizes) - 1
+    tile_count = sum(
+      math.ceil(level_width / tile_size) * math.ceil(level_height / tile_size)
+      for level_width, level_height in sizes
+    )
+
+    temp_dir = final_dir.parent / f".{final_dir.name}.{uuid.uuid4().hex}"
+    try:
+      done = 0
+      with ThreadPoolExecutor(max_workers=settings.TILE_WORKERS or os.cpu_count() or 1) as pool:
+        for level in range(max_level, -1, -1):
+          if level < max_level:
+            image = image.reduce(2) # halves, rounding up like the DZI level sizes
+          (temp_dir / 'image_files' / str(level)).mkdir(parents=True)
+
+          futures = [
+            pool.submit(
+              _save_tile, image, box, tile_path(temp_dir, level, col, row, tile_format),
+              pil_format, settings.TILE_QUALITY,
+            )
+            for col, row, box in _tile_boxes(*image.size, tile_size, overlap)
+          ]
+          for future in as_completed(futures):
+            future.result()
+            done += 1
+            if on_progress and done % PROGRESS_TILES == 0:
+              on_progress(done / tile_count)
+
+      descriptor = {
+        'width': width,
+        'height': height,
+        'tile_size': tile_size,
+        'overlap': overlap,
+        'format': tile_format,
+        'levels': max_level + 1,
+        'tile_count': tile_count,
+      }
+      with open(temp_dir / 'image.dzi', 'w') as dzi_file:
+        dzi_file.write(DZI_TEMPLATE.format(**descriptor))
+      with open(temp_dir / 'pyramid.json', 'w') as descriptor_file:
+        json.dump(descriptor, descriptor_file)
+
+      os.replace(temp_dir, final_dir)
+    except Exception:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      raise
+
+  if on_progress:
+    on_progress(1)
+  return load_pyramid(dataset)
@@ -0,0 +1,323 @@
+"""
+Single-pass upload ingest
+
+IngestUploadHandler replaces Django's default upload handlers
+(settings.FILE_UPLOAD_HANDLERS). While the request body streams into
+the upload's temp file it also:
+- computes the SHA-256
+- measures the size
+- keeps the first INGEST_HEAD_BYTES, for the magic number and image header
+
+The results are attached to the uploaded file as `uploaded_file.ingest`,
+so DatasetSerializer doesn't read the file again. Temp files are created
+under FILE_UPLOAD_TEMP_DIR (inside MEDIA_ROOT), so saving the upload to
+storage is a rename, not a copy.
+
+ingest_file() does the same for files that came in some other way
+(in-memory uploads, tests): one read in large chunks.
+
+Resumable uploads (UploadSession) write each chunk straight to its offset
+in one part file under UPLOAD_SESSION_ROOT. A SHA-256 can only be advanced
+in order, by one process, so the process that receives chunk 0 owns the
+session's hash: it hashes chunks as they arrive in order (chunks that
+arrive early, in that process or another, are read back once the gap
+before them is filled) and saves the ingest result on the session once
+the whole file is hashed. Whichever process finalizes then reads it from
+the database instead of the file, and the owner lets go of its state.
+Finalize only hashes the part file itself when the owner didn't get to
+the end (a chunk failed half way, the process restarted).
+"""
+
+import hashlib
+import io
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+from .models import UploadSession
+from .utils import sniff_content_type
+
+# Bytes kept from the start of each upload (image headers, EXIF included, fit in this)
+INGEST_HEAD_BYTES = 256 * 1024 # 256 KB
+
+# Read size for the upload stream and for ingest_file
+INGEST_CHUNK_SIZE = 1024 * 1024 # 1 MB
+
+
+class Ingest:
+  # Accumulates hash, size and the head of a file as its chunks go by
+
+  def __init__(self):
+    self.hash = hashlib.sha256()
+    self.size = 0
+    self.head = bytearray()
+
+  def feed(self, chunk):
+    self.hash.update(chunk)
+    self.size += len(chunk)
+    if len(self.head) < INGEST_HEAD_BYTES:
+      self.head += chunk[:INGEST_HEAD_BYTES - len(self.head)]
+
+  def result(self, file_obj=None):
+    # {'sha256', 'size', 'detected_type', 'image'}
+    # file_obj is only read when an image header doesn't fit in the head
+    head = bytes(self.head)
+    detected_type = sniff_content_type(head)
+    image = None
+    if detected_type and detected_type.startswith('image/'):
+      image = read_image_header(head, file_obj)
+    return {
+      'sha256': self.hash.hexdigest(),
+      'size': self.size,
+      'detected_type': detected_type,
+      'image': image,
+    }
+
+
+def read_image_header(head, file_obj=None):
+  # Width / height / format from an image's header (nothing is decoded)
+  from PIL import Image
+
+  sources = [io.BytesIO(head)]
+  if file_obj is not None:
+    sources.append(file_obj)
+
+  for source in sources:
+    try:
+      source.seek(0)
+      with Image.open(source) as image:
+        width, height = image.size
+        return {'width': width, 'height': height, 'format': image.format}
+    except Exception:
+      continue
+    finally:
+      source.seek(0)
+  return None
+
+
+def ingest_file(file_obj):
+  # One read through a file that didn't come through IngestUploadHandler
+  ingest = Ingest()
+  file_obj.seek(0)
+  while True:
+    chunk = file_obj.read(INGEST_CHUNK_SIZE)
+    if not chunk:
+      break
+    ingest.feed(chunk)
+  file_obj.seek(0)
+  return ingest.result(file_obj)
+
+
+class IngestUploadHandler(TemporaryFileUploadHandler):
+  """
+    Streams uploads to a temp file in INGEST_CHUNK_SIZE chunks and ingests
+    them on the way (see module docstring).
+  """
+
+  chunk_size = INGEST_CHUNK_SIZE
+
+  def new_file(self, *args, **kwargs):
+    if settings.FILE_UPLOAD_TEMP_DIR:
+      os.makedirs(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
+    super().new_file(*args, **kwargs)
+    self.ingest = Ingest()
+
+  def receive_data_chunk(self, raw_data, start):
+    self.ingest.feed(raw_data)
+    return super().receive_data_chunk(raw_data, start)
+
+  def file_complete(self, file_size):
+    uploaded_file = super().file_complete(file_size)
+    uploaded_file.ingest = self.ingest.result(uploaded_file)
+    return uploaded_file
+
+
+# ---- Resumable uploads ----
+
+class _SessionHash(Ingest):
+  # Ingest of the first <size> bytes of a session's part file
+
+  def __init__(self):
+    super().__init__()
+    self.busy = False # a request is hashing: a chunk streaming in, or a catch-up
+    self.pending = False # chunks were recorded while busy, catch up again
+    self.touched = time.monotonic()
+
+
+# session id -> _SessionHash, for sessions whose hash this process owns
+_session_hashes = {}
+_session_hashes_lock = threading.Lock()
+
+
+def part_path(session):
+  return Path(settings.UPLOAD_SESSION_ROOT) / f"{session.id}.part"
+
+
+def create_part_file(session):
+  # Empty part file of the final size (sparse), ready for chunks at any offset
+  path = part_path(session)
+  path.parent.mkdir(parents=True, exist_ok=True)
+  with open(path, 'wb') as part_file:
+    part_file.truncate(session.size)
+
+
+def _drop_idle_hashes():
+  # Forget sessions that stopped sending chunks (abandoned, or finished elsewhere)
+  # (called with the lock held)
+  cutoff = time.monotonic() - settings.UPLOAD_SESSION_TTL_HOURS * 3600
+  for session_id, state in list(_session_hashes.items()):
+    if state.touched < cutoff and not state.busy:
+      del _session_hashes[session_id]
+
+
+def _catch_up(state, session, fd):
+  # Hash the chunks after what's hashed that are already in the part file
+  # (called with state.busy claimed, not under the lock)
+  received = set(
+    session.chunks.filter(index__gte=state.size // session.chunk_size).values_list('index', flat=True)
+  )
+  while state.size < session.size and state.size // session.chunk_size in received:
+    index = state.size // session.chunk_size
+    state.feed(os.pread(fd, session.chunk_length(index), state.size))
+
+
+def _save_ingest(session, state):
+  # The whole file is hashed: share the result through the session row
+  with open(part_path(session), 'rb') as part_file:
+    session.ingest = state.result(part_file)
+  UploadSession.objects.filter(pk=session.pk, status='ACTIVE').update(ingest=session.ingest)
+
+
+def write_chunk(session, index, stream):
+  """
+    Copy one chunk from stream into the part file at its offset.
+    Returns the number of bytes written (the caller checks it, then
+    records the chunk and calls chunk_received).
+  """
+  expected = session.chunk_length(index)
+  offset = index * session.chunk_size
+
+  # If this is the chunk the hash needs next, hash it while it streams in
+  with _session_hashes_lock:
+    state = _session_hashes.get(session.id)
+    if state is None and offset == 0:
+      _drop_idle_hashes()
+      state = _session_hashes[session.id] = _SessionHash()
+    if state is not None and offset < state.size:
+      # Rewriting bytes that are hashed already: finalize will hash the file instead
+      _session_hashes.pop(session.id, None)
+      state = None
+    hash_inline = state is not None and not state.busy and state.size == offset
+    if hash_inline:
+      state.busy = True
+      state.touched = time.monotonic()
+
+  written = 0
+  fd = os.open(part_path(session), os.O_WRONLY)
+  try:
+    while written < expected:
+      data = stream.read(min(INGEST_CHUNK_SIZE, expected - written))
+      if not data:
+        break
+      os.pwrite(fd, data, offset + written)
+      written += len(data)
+      if hash_inline:
+        state.feed(data)
+  finally:
+    os.close(fd)
+
+  if hash_inline:
+    with _session_hashes_lock:
+      state.busy = False
+      if written != expected:
+        # Half a chunk went into the hash: finalize will hash the file instead
+        _session_hashes.pop(session.id, None)
+  return written
+
+
+def chunk_received(session):
+  """
+    Called once a chunk is recorded (UploadChunk): if this process owns the
+    session's hash, hash what is now in order and, when that reaches the
+    end of the file, save the ingest result on the session.
+  """
+  # A chunk sent again after the whole file was hashed may have changed it
+  UploadSession.objects.filter(pk=session.pk, ingest__isnull=False).update(ingest=None)
+
+  # The lock is only held to claim and publish the state; reading and
+  # hashing the chunks happens without it, so other sessions aren't held up
+  with _session_hashes_lock:
+    state = _session_hashes.get(session.id)
+    if state is None:
+      return
+    if state.busy:
+      state.pending = True # whoever is hashing catches this chunk up too
+      return
+    state.busy = True
+
+  while True:
+    state.pending = False
+    state.touched = time.monotonic()
+    try:
+      fd = os.open(part_path(session), os.O_RDONLY)
+      try:
+        _catch_up(state, session, fd)
+      finally:
+        os.close(fd)
+    except BaseException:
+      with _session_hashes_lock:
+        state.busy = False
+        if _session_hashes.get(session.id) is state:
+          del _session_hashes[session.id]
+      raise
+
+    with _session_hashes_lock:
+      if _session_hashes.get(session.id) is not state:
+        # Dropped meanwhile (hashed bytes rewritten, finalized, cancelled)
+        state.busy = False
+        return
+      if state.size >= session.size:
+        del _session_hashes[session.id]
+        state.busy = False
+        break
+      if not state.pending:
+        state.busy = False
+        return
+  _save_ingest(session, state)
+
+
+def finish_part_file(session):
+  """
+    Ingest result ({'sha256', 'size', 'detected_type', 'image'}) of a
+    session's complete part file: the one saved on the session if the
+    whole file was hashed as it arrived, otherwise the bytes this process
+    hasn't hashed yet are read (all of them if its hash is elsewhere).
+  """
+  with _session_hashes_lock:
+    state = _session_hashes.pop(session.id, None)
+  if session.ingest:
+    return session.ingest
+  if state is None or state.busy:
+    state = Ingest()
+
+  with open(part_path(session), 'rb') as part_file:
+    part_file.seek(state.size)
+    while True:
+      chunk = part_file.read(INGEST_CHUNK_SIZE)
+      if not chunk:
+        break
+      state.feed(chunk)
+    return state.result(part_file)
+
+
+def discard_part_file(session):
+  with _session_hashes_lock:
+    _session_hashes.pop(session.id, None)
+  try:
+    os.remove(part_path(session))
+  except FileNotFoundError:
+    pass
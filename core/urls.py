@@ -1,12 +1,23 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 from rest_framework.routers import DefaultRouter
-from .views import ProjectViewSet, DatasetViewSet, JobViewSet
+from .polling import job_status
+from .views import ProjectViewSet, DatasetViewSet, JobViewSet, UploadSessionViewSet
 
 router = DefaultRouter()
 router.register(r'projects', ProjectViewSet)
 router.register(r'datasets', DatasetViewSet)
 router.register(r'jobs', JobViewSet)
+router.register(r'uploads', UploadSessionViewSet)
 
 urlpatterns = [
+  # Deep Zoom tiles: relative to image.dzi/ and without a trailing slash, as viewers request them
+  re_path(
+    r'^datasets/(?P<pk>[0-9]+)/image_files/(?P<level>[0-9]+)/(?P<col>[0-9]+)_(?P<row>[0-9]+)\.(?P<ext>jpeg|png)$',
+    DatasetViewSet.as_view({'get': 'tile'}),
+    name='dataset-tile',
+  ),
+  # Job status with ?wait= long-polling (async, see core.polling); hands other
+  # requests to JobViewSet.status, so it sits in front of the router's route
+  path('jobs/<int:pk>/status/', job_status, name='job-status-poll'),
   path('', include(router.urls)),
-]
\ No newline at end of file
+]
@@ -1,8 +1,19 @@
+import fcntl
 import hashlib
+import os
+import resource
+import tempfile
 import uuid
+from contextlib import contextmanager
 from pathlib import Path
 from PIL import Image
 import io
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+# Size of each read when streaming CSV files from storage
+CSV_READ_CHUNK_SIZE = 1024 * 1024 # 1 MB
 
 # Magic numbers # the first few bytes of common image formats
 MAGIC_NUMBERS = {
@@ -13,29 +24,26 @@ MAGIC_NUMBERS = {
 }
 
 def check_magic_number(file_obj):
-  # Read first 4 bytes and check against known magic numbers
+  # Read first 8 bytes and check against known magic numbers
   # Returns (is_valid, detected_type)
 
   file_obj.seek(0)
-  magic = file_obj.read(4)
+  magic = file_obj.read(8)
   file_obj.seek(0)
 
-  # PNG check
-  if magic.startswith(b'\x89PNG'):
-    return True, 'image/png'
-  
-  # JPEG check
-  if magic.startswith(b'\xff\xd8\xff'):
-    return True, 'image/jpeg'
-  
-  # GIF check
-  if magic.startswith(b'GIF87a') or magic.startswith(b'GIF89a'):
-    return True, 'image/gif'
-  
-  # CSV: check extension instead (no reliable magic for plain text)
-  # This is checked elsewhere in validation logic
+  detected_type = sniff_content_type(magic)
+  return detected_type is not None, detected_type
+
 
-  return False, None
+def sniff_content_type(head):
+  # Image type from the first bytes of a file, or None
+  # CSV: no reliable magic for plain text, the extension is checked instead
+  for content_type, signatures in MAGIC_NUMBERS.items():
+    if content_type == 'text/csv':
+      continue
+    if any(head.startswith(signature) for signature in signatures):
+      return content_type
+  return None
 
 
 def sanitize_filename(filename):
@@ -105,3 +113,192 @@ def mock_virus_scan(file_obj):
   return True
 
 
+class CsvLines:
+  # Decoded lines from a binary file, read in bounded chunks (see iter_csv_lines)
+  # .position is how many bytes the lines handed out so far took up; csv.reader
+  # never reads ahead, so between rows it is where the next record starts
+
+  def __init__(self, file_obj, chunk_size=CSV_READ_CHUNK_SIZE):
+    self.position = 0
+    self._lines = self._read(file_obj, chunk_size)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return next(self._lines)
+
+  def _read(self, file_obj, chunk_size):
+    remainder = b''
+    first = True
+    while True:
+      chunk = file_obj.read(chunk_size)
+      if not chunk:
+        break
+      lines = (remainder + chunk).split(b'\n')
+      remainder = lines.pop() # last piece may be an unfinished line
+      for line in lines:
+        text = (line + b'\n').decode('utf-8', errors='replace')
+        if first:
+          text = text.lstrip('\ufeff') # drop UTF-8 BOM written by Excel
+          first = False
+        self.position += len(line) + 1
+        yield text
+
+    if remainder:
+      text = remainder.decode('utf-8', errors='replace')
+      self.position += len(remainder)
+      yield text.lstrip('\ufeff') if first else text
+
+
+def iter_csv_lines(file_obj, chunk_size=CSV_READ_CHUNK_SIZE):
+  # Yield decoded lines from a binary file, reading it in bounded chunks
+  # Line endings are kept so csv.reader can handle quoted newlines itself
+  # Memory use is one chunk plus one line, no matter how big the file is
+  return CsvLines(file_obj, chunk_size)
+
+
+def current_memory_kb():
+  # Resident memory of this process in KB
+  # /proc gives the current value; ru_maxrss (lifetime peak) is the fallback off Linux
+  try:
+    with open('/proc/self/statm') as statm:
+      pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+  except (OSError, ValueError, IndexError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class ByteRangeReader:
+  # File-like wrapper that only lets reads see bytes [start, end)
+  # Used to hand one slice of a big file to iter_csv_lines
+
+  def __init__(self, file_obj, start, end):
+    file_obj.seek(start)
+    self.file_obj = file_obj
+    self.remaining = end - start
+
+  def read(self, size=-1):
+    if self.remaining <= 0:
+      return b''
+    if size < 0 or size > self.remaining:
+      size = self.remaining
+    data = self.file_obj.read(size)
+    self.remaining -= len(data)
+    return data
+
+  def tell(self):
+    return self.file_obj.tell()
+
+
+def split_csv_records(file_obj, target_size, block_size=CSV_READ_CHUNK_SIZE):
+  # Split a CSV file into byte ranges of roughly target_size that each hold whole records
+  # Returns (header_end, ranges): the header row is bytes [0, header_end)
+  # and ranges is a list of (start, end) offsets covering the rest of the file
+
+  # A newline only ends a record when an even number of quotes came before it,
+  # so newlines inside quoted fields never split a record
+  # (escaped "" quotes count twice and cancel out)
+  # This is one sequential read using bytes.find/count, far cheaper than parsing
+
+  cuts = []
+  next_cut = 0 # the first cut is right after the header row
+  quotes_before_block = 0
+  block_start = 0
+
+  file_obj.seek(0)
+  while True:
+    block = file_obj.read(block_size)
+    if not block:
+      break
+
+    quotes = quotes_before_block
+    counted_upto = 0
+    search_from = max(next_cut - block_start, 0)
+
+    while search_from < len(block):
+      newline = block.find(b'\n', search_from)
+      if newline == -1:
+        break
+      quotes += block.count(b'"', counted_upto, newline)
+      counted_upto = newline
+      if quotes % 2 == 0:
+        cut = block_start + newline + 1
+        cuts.append(cut)
+        next_cut = cut + target_size
+        search_from = next_cut - block_start
+      else:
+        search_from = newline + 1
+
+    quotes_before_block += block.count(b'"')
+    block_start += len(block)
+
+  file_size = block_start
+  if not cuts:
+    return file_size, [] # header only (or empty file)
+
+  header_end = cuts[0]
+  edges = [cut for cut in cuts if cut < file_size] + [file_size]
+  ranges = [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+  return header_end, ranges
+
+
+class LocalFile(File):
+  # A File that lives on local disk, so FileSystemStorage moves it instead of copying
+  def temporary_file_path(self):
+    return self.file.name
+
+
+class StorageOutput:
+  # Write a new storage file as a stream, without building it in memory
+  # Bytes go to a local temp file; on exit the file is handed to default_storage
+  # (FileSystemStorage just renames it into place) and .name holds the saved name
+  #
+  # with StorageOutput('converted/1.json') as output:
+  #   output.file.write(b'...')
+  # saved_name = output.name
+
+  def __init__(self, name):
+    self.name = name
+    self.file = None
+
+  def __enter__(self):
+    # Workers may run before any upload has created the temp dir
+    if settings.FILE_UPLOAD_TEMP_DIR:
+      os.makedirs(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
+    self.file = tempfile.NamedTemporaryFile(
+      suffix=Path(self.name).suffix,
+      dir=settings.FILE_UPLOAD_TEMP_DIR,
+      delete=False,
+    )
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    temp_path = self.file.name
+    try:
+      if exc_type is None:
+        self.file.flush()
+        self.file.seek(0)
+        self.name = self.save()
+    finally:
+      self.file.close()
+      if os.path.exists(temp_path):
+        os.unlink(temp_path)
+    return False
+
+  def save(self):
+    # Hand the finished temp file to storage; returns the saved name
+    return default_storage.save(self.name, LocalFile(self.file))
+
+
+@contextmanager
+def file_lock(directory, name):
+  # Exclusive lock on directory/.<name>.lock, shared by every worker process on this machine
+  directory = Path(directory)
+  directory.mkdir(parents=True, exist_ok=True)
+  with open(directory / f".{name}.lock", 'w') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,11 +1,38 @@
+import io
+import itertools
+import json
+from pathlib import Path
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
-from rest_framework import viewsets, status
+from django.db import transaction
+from django.db.models import Q
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import mixins, viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django_filters.rest_framework import DjangoFilterBackend
-from .models import Project, Dataset, Job
-from .serializers import ProjectSerializer, DatasetSerializer, JobSerializer, JobSubmitSerializer
+from .models import Project, Dataset, Job, UploadSession, UploadChunk
+from .serializers import ProjectSerializer, DatasetSerializer, JobSerializer, UploadSessionSerializer
+from .serializers import check_upload, create_dataset, find_stored_content, reference_dataset
+from .serializers import ContentHashSerializer, DatasetFromHashSerializer
+from .serializers import JobSpecSerializer, JobSubmitSerializer, JobBulkSubmitSerializer, ImageBatchSerializer
+from .tasks import job_signature, process_image_batch
+from .blobs import add_refs, result_blobs
+from .downloads import dataset_download, job_download, job_outputs, serve_file
+from .job_state import live_progress, live_states
+from .pagination import DatasetCursorPagination, DatasetRowPagination, JobCursorPagination, only_requested
+from .result_cache import lookup_results, result_cache_key
+from .result_store import is_offloaded, iter_result_json
+from .row_index import load_row_index
+from .tiles import load_pyramid, tile_path
+from .uploads import chunk_received, create_part_file, discard_part_file, finish_part_file
+from .uploads import part_path, write_chunk
+from .utils import LocalFile
+from celery import group
+from celery.utils import uuid
 from rest_framework import parsers
 import logging
 
@@ -30,6 +57,39 @@ class ProjectViewSet(viewsets.ModelViewSet):
   def get_queryset(self):
     return self.queryset.filter(owner=self.request.user)
 
+  @action(detail=True, methods=['post'])
+  def process_images(self, request, pk=None):
+    """
+      Process every image in the project (or some of them) as ONE job.
+      POST /api/projects/{id}/process_images/ with optional {"dataset_ids": [...]}
+      Returns the batch Job; per-image results end up in its result_data.
+    """
+    project = self.get_object()
+    serializer = ImageBatchSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    dataset_ids = serializer.validated_data.get('dataset_ids')
+
+    job = Job.objects.create(
+      name = f"process_image_batch for Project {project.id}",
+      project = project,
+      job_type = 'process_image_batch',
+      params = {'dataset_ids': dataset_ids} if dataset_ids else {},
+      status = 'PENDING',
+      task_id = uuid()
+    )
+
+    try:
+      process_image_batch.apply_async((project.id, job.id, dataset_ids), task_id=job.task_id)
+    except Exception as e:
+      logger.error(f"Error enqueueing batch image job: {str(e)}")
+      Job.objects.filter(id=job.id).update_versioned(status='FAILED', error_message="Could not enqueue job.")
+      return Response(
+        {"error": "An error occurred while creating the job."},
+        status=status.HTTP_400_BAD_REQUEST
+      )
+
+    return Response(JobSerializer(job).data, status=status.HTTP_201_CREATED)
+
 
 class DatasetViewSet(viewsets.ModelViewSet):
   queryset = Dataset.objects.all()
@@ -37,10 +97,14 @@ class DatasetViewSet(viewsets.ModelViewSet):
   permission_classes = [IsAuthenticated]
   filter_backends = [DjangoFilterBackend]
   filterset_fields = ['project']
+  pagination_class = DatasetCursorPagination
 
   def get_queryset(self):
     # return only datasets for projects owned by the user
-    return self.queryset.filter(project__owner=self.request.user)
+    queryset = self.queryset.filter(project__owner=self.request.user)
+    if self.action in ('list', 'retrieve'):
+      queryset = only_requested(queryset, self.request, self.pagination_class.ordering)
+    return queryset
 
   def perform_create(self, serializer):
     parser_class = [parsers.MultiPartParser, parsers.FormParser]
@@ -55,69 +119,269 @@ class DatasetViewSet(viewsets.ModelViewSet):
     # serializer.create already saves file and metadata
     serializer.save()
 
+  @action(detail=False, methods=['post'])
+  def preflight(self, request):
+    """
+      Ask before uploading whether the content is already stored.
+      POST /api/datasets/preflight/ {"sha256": "...", "size": 123}
+      If it is, create the dataset with from_hash instead of uploading it again.
+      Only the user's own datasets are searched, so a hash can't be used
+      to find out what other users have uploaded.
+    """
+    serializer = ContentHashSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    existing = find_stored_content(
+      serializer.validated_data['sha256'], serializer.validated_data['size'], user=request.user
+    )
+    return Response({
+      "exists": existing is not None,
+      "dataset_id": existing.id if existing else None,
+    })
+
+  @action(detail=False, methods=['post'])
+  def from_hash(self, request):
+    """
+      Create a dataset from content the user already uploaded: no bytes are sent,
+      the new dataset shares the stored file.
+      POST /api/datasets/from_hash/ {"sha256", "size", "project", "name", "original_name"?}
+    """
+    serializer = DatasetFromHashSerializer(data=request.data, context={'request': request})
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    existing = find_stored_content(data['sha256'], data['size'], user=request.user)
+    if existing is None:
+      return Response(
+        {"error": "No stored file with this content. Upload the file instead."},
+        status=status.HTTP_404_NOT_FOUND
+      )
+
+    fields = {'project': data['project'], 'name': data['name']}
+    if data.get('original_name'):
+      fields['original_name'] = data['original_name']
+    dataset = reference_dataset(existing, **fields)
+    return Response(DatasetSerializer(dataset).data, status=status.HTTP_201_CREATED)
+
+  @action(detail=True, methods=['get'])
+  def download(self, request, pk=None):
+    """
+      The dataset's file, with Range / ETag support (see core.downloads).
+      GET /api/datasets/{id}/download/
+    """
+    dataset = self.get_object()
+    name, etag, filename = dataset_download(dataset)
+    try:
+      return serve_file(request, name, etag, filename, dataset.content_type or None)
+    except FileNotFoundError:
+      raise Http404("Dataset file not found.")
+
+  @action(detail=True, methods=['get'])
+  def rows(self, request, pk=None):
+    """
+      A page of the dataset's CSV rows (as lists of strings), read through
+      the row-offset index a validate_csv job builds (see core.row_index).
+      GET /api/datasets/{id}/rows/?offset=1000000&limit=100
+    """
+    dataset = self.get_object()
+    row_index = load_row_index(dataset)
+    if row_index is None:
+      return Response(
+        {"error": "No row index for this dataset. Submit a validate_csv job first."},
+        status=status.HTTP_404_NOT_FOUND
+      )
+    paginator = DatasetRowPagination()
+    page = paginator.paginate_queryset(row_index, request, view=self)
+    response = paginator.get_paginated_response(page)
+    response.data['headers'] = row_index.headers()
+    return response
+
+  @action(detail=True, methods=['get'], url_path='image.dzi')
+  def dzi(self, request, pk=None):
+    """
+      Deep Zoom descriptor of an image (built by a build_tile_pyramid job).
+      GET /api/datasets/{id}/image.dzi/
+      Viewers like OpenSeadragon load tiles from the sibling image_files/ URL.
+    """
+    dataset = self.get_object()
+    pyramid = load_pyramid(dataset)
+    if pyramid is None:
+      return Response(
+        {"error": "No tile pyramid for this dataset. Submit a build_tile_pyramid job first."},
+        status=status.HTTP_404_NOT_FOUND
+      )
+    with open(Path(pyramid['directory']) / 'image.dzi', 'rb') as dzi_file:
+      return HttpResponse(dzi_file.read(), content_type='application/xml')
+
+  def tile(self, request, pk=None, level=None, col=None, row=None, ext=None):
+    """
+      One tile of the pyramid: GET /api/datasets/{id}/image_files/{level}/{col}_{row}.{ext}
+      Routed in core/urls.py (no trailing slash, as DZI viewers expect).
+      The file is streamed straight from disk and can be cached for good,
+      since the pyramid is keyed by the image's content hash.
+    """
+    dataset = self.get_object()
+    pyramid = load_pyramid(dataset)
+    if pyramid is None or ext != pyramid['format']:
+      raise Http404("Tile not found.")
+    path = tile_path(pyramid['directory'], level, col, row, ext)
+    try:
+      response = FileResponse(open(path, 'rb'), content_type=f"image/{ext}")
+    except FileNotFoundError:
+      raise Http404("Tile not found.")
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 
 
+
+def job_status_state(jobs, pk):
+  """
+    What the status endpoint's validators are built from, without loading
+    the job itself: {'id', 'version', 'updated_at', 'status', 'task_id', 'seq'}
+    (seq counts live progress writes, see core.job_state). None if jobs
+    has no such job.
+  """
+  state = jobs.filter(pk=pk).values('id', 'version', 'updated_at', 'status', 'task_id').first()
+  if state is not None:
+    live = live_states([state]).get(state['id'])
+    state['seq'] = live['seq'] if live else 0
+  return state
+
+
+def job_validators(state):
+  # (ETag, Last-Modified timestamp) of a job's status, from job_status_state()
+  etag = f'"job-{state["id"]}-v{state["version"]}.{state["seq"]}"'
+  return etag, int(state['updated_at'].timestamp())
+
+
 class JobViewSet(viewsets.ModelViewSet):
   queryset = Job.objects.all()
   serializer_class = JobSerializer
   permission_classes = [IsAuthenticated]
   filter_backends = [DjangoFilterBackend]
   filterset_fields = ['project', 'status']
+  pagination_class = JobCursorPagination
 
   def get_queryset(self):
-    return self.queryset.filter(project__owner=self.request.user)
+    queryset = self.queryset.filter(project__owner=self.request.user)
+    if self.action in ('list', 'retrieve'):
+      # ?fields=id,status,progress leaves result_data etc. in the database
+      queryset = only_requested(
+        queryset, self.request, self.pagination_class.ordering, always=('status', 'task_id')
+      )
+    return queryset
+
+  def get_serializer(self, *args, **kwargs):
+    # Jobs being shown get their live progress from the hot store (core.job_state)
+    if args and self.request.method == 'GET':
+      jobs = args[0] if kwargs.get('many') else [args[0]]
+      kwargs['context'] = {**self.get_serializer_context(), 'live_progress': live_progress(jobs)}
+    return super().get_serializer(*args, **kwargs)
   
 
+  def _submit_jobs(self, specs, datasets):
+    """
+      Create Job rows for validated job specs and queue what needs running.
+      datasets maps dataset_id -> Dataset (already checked for ownership).
+
+      For each job, by its result cache key (see core.result_cache):
+      - cached result -> the job is COMPLETED straight away
+      - identical job already PENDING / PROCESSING (or earlier in this batch)
+        -> the job follows that job's task instead of starting another one
+      - otherwise -> a new Celery task, all sent as one group
+    """
+    keys = []
+    for spec in specs:
+      dataset = datasets[spec['dataset_id']]
+      keys.append(result_cache_key(dataset.file_hash, spec['job_type'], JobSpecSerializer.job_params(spec)))
+
+    cached = lookup_results(keys)
+    running = {}
+    for leader in Job.objects.filter(
+      cache_key__in=[key for key in keys if key and key not in cached],
+      status__in=['PENDING', 'PROCESSING'],
+      coalesced_into__isnull=True,
+    ).order_by('-created_at'):
+      running[leader.cache_key] = leader # oldest one wins
+
+    jobs = []
+    new_jobs = [] # (spec, job) pairs that get a Celery task
+    batch_followers = [] # (job, leader) pairs where the leader isn't saved yet
+    batch_leaders = {}
+    for spec, key in zip(specs, keys):
+      dataset = datasets[spec['dataset_id']]
+      job = Job(
+        name = f"{spec['job_type']} for Dataset {dataset.id}",
+        project_id = dataset.project_id,
+        job_type = spec['job_type'],
+        params = JobSpecSerializer.job_params(spec),
+        cache_key = key or '',
+        status = 'PENDING'
+      )
+
+      if key in cached:
+        job.status = 'COMPLETED'
+        job.progress = 100
+        job.result_data = cached[key]
+        job.artifacts = sorted(result_blobs(job.result_data))
+      elif key in running:
+        leader = running[key]
+        job.coalesced_into = leader
+        job.task_id = leader.task_id
+        job.status = leader.status
+        job.progress = leader.progress
+      elif key in batch_leaders:
+        batch_followers.append((job, batch_leaders[key]))
+      else:
+        job.task_id = uuid()
+        new_jobs.append((spec, job))
+        if key:
+          batch_leaders[key] = job
+      jobs.append(job)
+
+    # Followers of jobs from this same batch need their leader's id first
+    waiting = {id(job) for job, _ in batch_followers}
+    with transaction.atomic():
+      Job.objects.bulk_create([job for job in jobs if id(job) not in waiting])
+      # Jobs completed from the cache hold references to the result's blobs
+      add_refs(sha256 for job in jobs for sha256 in job.artifacts)
+    if batch_followers:
+      for job, leader in batch_followers:
+        job.coalesced_into = leader
+        job.task_id = leader.task_id
+      Job.objects.bulk_create([job for job, _ in batch_followers])
+
+    if new_jobs:
+      try:
+        group(
+          job_signature(spec['job_type'], spec['dataset_id'], job.id, job.params).set(task_id=job.task_id)
+          for spec, job in new_jobs
+        ).apply_async()
+      except Exception:
+        failed = [job.id for _, job in new_jobs]
+        Job.objects.filter(Q(id__in=failed) | Q(coalesced_into_id__in=failed)).update_versioned(
+          status='FAILED', error_message="Could not enqueue job."
+        )
+        raise
+
+    return jobs
+
   def create(self, request, *args, **kwargs):
     # Step 1: Validate input data
     serializer = JobSubmitSerializer(data=request.data)
     serializer.is_valid(raise_exception=True) # raise error if validation fails
 
     dataset_id = serializer.validated_data['dataset_id']
-    job_type = serializer.validated_data['job_type']
-    target_format = serializer.validated_data.get('target_format')
 
     try:
-      # Get the dataset
-      dataset = Dataset.objects.get(id=dataset_id)
+      # Step 2: Get the dataset (only the user's own datasets)
+      dataset = Dataset.objects.get(id=dataset_id, project__owner=request.user)
 
-      # Step 3: Create job record in database
-      job = Job.objects.create(
-        name = f"{job_type} for Dataset {dataset.id}",
-        project = dataset.project,
-        status = 'PENDING'
-      )
-
-      # Step 4: Enqueue Celery task based on job type
-      if job_type == 'validate_csv':
-        from .tasks import validate_csv
-        task = validate_csv.delay(dataset.id, job.id)
-
-      elif job_type == 'process_image':
-        from .tasks import process_image
-        task = process_image.delay(dataset.id, job.id)
-
-      elif job_type == 'generate_statistics':
-        from .tasks import generate_statistics
-        task = generate_statistics.delay(dataset.id, job.id)
-
-      elif job_type == 'convert_file_format':
-        # this job type needs target_format
-        if not target_format:
-          return Response(
-            {"error": "target_format is required for convert_file_format job type."},
-            status=status.HTTP_400_BAD_REQUEST
-          )  
-        from .tasks import convert_file_format
-        task = convert_file_format.delay(dataset.id, job.id, target_format)
-
-      # Step 5: Save Celery task ID in job
-      job.task_id = task.id
-      job.save()
-      
+      # Step 3: Create the job and enqueue its Celery task
+      # (or complete it from the result cache / attach it to an identical running job)
+      job, = self._submit_jobs([serializer.validated_data], {dataset.id: dataset})
 
-      # Step 6: Return job into to user
+      # Step 4: Return job into to user
       response_serializer = JobSerializer(job)
       return Response(response_serializer.data, status=status.HTTP_201_CREATED)
 
@@ -134,19 +398,72 @@ class JobViewSet(viewsets.ModelViewSet):
         status=status.HTTP_400_BAD_REQUEST
       )
 
-  @action(detail=True, methods=['get'])
-  def status(self, request, pk=None):
+  @action(detail=False, methods=['post'])
+  def bulk(self, request):
+    """
+      Submit many jobs in one request.
+      POST /api/jobs/bulk/ with {"jobs": [{dataset_id, job_type, ...}, ...]}
+
+      - One query checks that every dataset belongs to the user
+      - One INSERT creates all the Job rows (bulk_create)
+      - One Celery group enqueues all the tasks
+    """
+    serializer = JobBulkSubmitSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    specs = serializer.validated_data['jobs']
+
+    # Step 1: Load every requested dataset the user owns, in one query
+    dataset_ids = {spec['dataset_id'] for spec in specs}
+    datasets = Dataset.objects.filter(id__in=dataset_ids, project__owner=request.user).in_bulk()
+    missing = sorted(dataset_ids - datasets.keys())
+    if missing:
+      return Response(
+        {"error": "Datasets with given IDs do not exist.", "dataset_ids": missing},
+        status=status.HTTP_404_NOT_FOUND
+      )
 
+    # Step 2: Create all job rows and enqueue what needs running
     try:
-      job = self.get_object()
-      serializer = JobSerializer(job)
-      return Response(serializer.data)
+      jobs = self._submit_jobs(specs, datasets)
+    except Exception as e:
+      logger.error(f"Error enqueueing bulk jobs: {str(e)}")
+      return Response(
+        {"error": "An error occurred while creating the jobs."},
+        status=status.HTTP_400_BAD_REQUEST
+      )
 
-    except Job.DoesNotExist:
+    return Response({
+      "count": len(jobs),
+      "job_ids": [job.id for job in jobs],
+      "jobs": JobSerializer(jobs, many=True).data,
+    }, status=status.HTTP_201_CREATED)
+
+  @action(detail=True, methods=['get'])
+  def status(self, request, pk=None):
+    # Fallback for clients that can't hold a WebSocket open
+    # Live progress is pushed to ws/jobs/ (see core.consumers.JobConsumer)
+    #
+    # Conditional GET: the ETag / Last-Modified come from Job.version / updated_at,
+    # so a poll with If-None-Match gets a 304 without the job (or its result_data)
+    # being loaded. ?wait=<seconds> long-polls instead (see core.polling).
+
+    state = job_status_state(self.get_queryset(), pk)
+    if state is None:
       return Response(
         {"error": "Job with given ID does not exist."},
         status=status.HTTP_404_NOT_FOUND
       )
+
+    etag, last_modified = job_validators(state)
+    # Only the ETag decides: Last-Modified has 1 s resolution and jobs change faster
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+      job = self.get_object()
+      response = Response(self.get_serializer(job).data)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
     
   @action(detail=True, methods=['post'])
   def cancel(self, request, pk=None):
@@ -183,6 +500,26 @@ class JobViewSet(viewsets.ModelViewSet):
       )
     
 
+  @action(detail=True, methods=['get'])
+  def download(self, request, pk=None):
+    """
+      A file the job produced (conversion output, image rendition), with
+      Range / ETag support (see core.downloads).
+      GET /api/jobs/{id}/download/?blob=<sha256>
+      ?blob= can be left out when the job produced a single file.
+    """
+    job = self.get_object()
+    target = job_download(job, request.query_params.get('blob'))
+    if target is None:
+      return Response(
+        {"error": "No such output. Pick one with ?blob=.", "outputs": job_outputs(job)},
+        status=status.HTTP_404_NOT_FOUND
+      )
+    try:
+      return serve_file(request, *target)
+    except FileNotFoundError:
+      raise Http404("Output file not found.")
+
   @action(detail=True, methods=['get'])
   def results(self, request, pk=None):
     try:
@@ -195,6 +532,15 @@ class JobViewSet(viewsets.ModelViewSet):
         )
 
 
+      if is_offloaded(job.result_data):
+        # Big results live compressed in storage: stream them out decompressed,
+        # in the same {"result_data", "id", "status"} shape
+        head = json.dumps({'id': job.id, 'status': job.status})[:-1]
+        body = itertools.chain(
+          [f'{head}, "result_data": '.encode('utf-8')], iter_result_json(job.result_data), [b'}']
+        )
+        return StreamingHttpResponse(body, content_type='application/json')
+
       return Response({
         'result_data': job.result_data,
         'id': job.id,
@@ -206,4 +552,110 @@ class JobViewSet(viewsets.ModelViewSet):
       return Response(
         {"error": "Job with given ID does not exist."},
         status=status.HTTP_404_NOT_FOUND
-      )
\ No newline at end of file
+      )
+
+
+class UploadSessionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin, viewsets.GenericViewSet):
+  """
+    Resumable uploads for files too big for one request.
+
+    1. POST   /api/uploads/                       create a session (see UploadSessionSerializer)
+    2. PUT    /api/uploads/{id}/chunks/{index}/   raw bytes of chunk <index> (0-based),
+                                                  in any order, in parallel, retried as needed
+    3. GET    /api/uploads/{id}/                  which chunks were received
+    4. POST   /api/uploads/{id}/finalize/         checks the file and creates the Dataset
+       DELETE /api/uploads/{id}/                  abandon the upload
+  """
+  queryset = UploadSession.objects.all()
+  serializer_class = UploadSessionSerializer
+  permission_classes = [IsAuthenticated]
+
+  def get_queryset(self):
+    return self.queryset.filter(owner=self.request.user)
+
+  def perform_create(self, serializer):
+    chunk_size = serializer.validated_data.get('chunk_size') or settings.UPLOAD_CHUNK_SIZE
+    session = serializer.save(owner=self.request.user, chunk_size=chunk_size)
+    create_part_file(session)
+
+  def perform_destroy(self, instance):
+    discard_part_file(instance)
+    instance.delete()
+
+  @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>[0-9]+)')
+  def chunk(self, request, pk=None, index=None):
+    session = self.get_object()
+    index = int(index)
+
+    if session.status != 'ACTIVE':
+      return Response({"error": "Upload is already finalized."}, status=status.HTTP_409_CONFLICT)
+    if index >= session.chunk_count:
+      return Response(
+        {"error": f"Chunk index must be below {session.chunk_count}."},
+        status=status.HTTP_400_BAD_REQUEST
+      )
+
+    # Streamed straight from the request body to its offset in the part file
+    expected = session.chunk_length(index)
+    written = write_chunk(session, index, request.stream or io.BytesIO())
+    if written != expected:
+      return Response(
+        {"error": f"Chunk {index} must be exactly {expected} bytes, got {written}."},
+        status=status.HTTP_400_BAD_REQUEST
+      )
+
+    UploadChunk.objects.get_or_create(session=session, index=index)
+    chunk_received(session)
+    return Response({"index": index, "size": written}, status=status.HTTP_200_OK)
+
+  @action(detail=True, methods=['post'])
+  def finalize(self, request, pk=None):
+    session = self.get_object()
+    if session.status != 'ACTIVE':
+      return Response({"error": "Upload is already finalized."}, status=status.HTTP_409_CONFLICT)
+
+    received = session.chunks.count()
+    if received != session.chunk_count:
+      return Response(
+        {"error": "Upload is missing chunks.", "received": received, "chunk_count": session.chunk_count},
+        status=status.HTTP_400_BAD_REQUEST
+      )
+
+    # Only one finalize gets past this; chunk uploads stop being accepted too
+    claimed = UploadSession.objects.filter(pk=session.pk, status='ACTIVE').update(status='FINALIZING')
+    if not claimed:
+      return Response({"error": "Upload is already finalized."}, status=status.HTTP_409_CONFLICT)
+    session.refresh_from_db()
+
+    try:
+      # Hash whatever wasn't hashed as chunks arrived, plus magic number and image header
+      ingest = finish_part_file(session)
+      if session.sha256 and session.sha256.lower() != ingest['sha256']:
+        UploadSession.objects.filter(pk=session.pk).update(status='ACTIVE')
+        return Response(
+          {"error": "SHA-256 of the uploaded file does not match.", "sha256": ingest['sha256']},
+          status=status.HTTP_400_BAD_REQUEST
+        )
+
+      with open(part_path(session), 'rb') as part_file:
+        check_upload(part_file, session.filename, session.content_type, ingest)
+
+        # The part file is renamed into storage, not copied
+        dataset = create_dataset(
+          LocalFile(part_file, name=session.filename), session.filename, session.content_type, ingest,
+          name=session.name, project=session.project,
+        )
+    except Exception:
+      # Let the client fix it up (re-send chunks) and finalize again
+      UploadSession.objects.filter(pk=session.pk).update(status='ACTIVE')
+      raise
+
+    # Still there if the content was already stored and the dataset shares that file
+    discard_part_file(session)
+
+    session.status = 'COMPLETED'
+    session.dataset = dataset
+    session.save(update_fields=['status', 'dataset'])
+    session.chunks.all().delete()
+    return Response(DatasetSerializer(dataset).data, status=status.HTTP_201_CREATED)
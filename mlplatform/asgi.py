@@ -10,7 +10,6 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import get_asgi_application 
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import django
@@ -20,27 +19,25 @@ django.setup()
 
 # Import after Django setup
 
-from core.consumers import JobConsumer
+from core.middleware import JWTAuthMiddleware
+from core.routing import websocket_urlpatterns
 
 # Get Django ASGI app for HTTP requests
 django_asgi_app = get_asgi_application()
 
-# Define Websocket URL routes (like urls.py but for WebSocket)
-websocket_urlpatterns = [
-
-
-]
-
 # Main ASGI application
 application = ProtocolTypeRouter({
   # Handle HTTP requests normally (Djngo views)
   "http": django_asgi_app,
 
-  # Handle WebSocket connections
+  # Handle WebSocket connections (ws/jobs/, see core/routing.py)
   # AuthMiddlewareStack = authenticate user before allowing connection
+  # JWTAuthMiddleware = or with the API's JWT access token (?token=...)
   "websocket": AuthMiddlewareStack(
-    URLRouter(
-      websocket_urlpatterns
+    JWTAuthMiddleware(
+      URLRouter(
+        websocket_urlpatterns
+      )
     )
   )
 })
@@ -98,6 +98,43 @@ CORS_ALLOWED_ORIGINS = config('CORS_ALLOWED_ORIGINS', cast=Csv())
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'  # BASE_DIR should be pathlib.Path
 
+# Uploads stream through core.uploads.IngestUploadHandler, which hashes and
+# sniffs them on the way into a temp file inside MEDIA_ROOT (so saving the
+# upload to storage is a rename, not a copy)
+FILE_UPLOAD_HANDLERS = ['core.uploads.IngestUploadHandler']
+FILE_UPLOAD_TEMP_DIR = MEDIA_ROOT / 'tmp'
+
+# Resumable uploads (/api/uploads/): chunks are written into part files here
+# Sessions not finalized within UPLOAD_SESSION_TTL_HOURS are deleted
+UPLOAD_SESSION_ROOT = MEDIA_ROOT / 'uploads'
+UPLOAD_SESSION_MAX_SIZE = 50 * 1024 ** 3  # 50 GB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB, default per session
+UPLOAD_CHUNK_MAX_SIZE = 64 * 1024 * 1024  # 64 MB
+UPLOAD_SESSION_TTL_HOURS = 24
+
+# Dataset files, renditions and conversion outputs are stored once per content
+# under MEDIA_ROOT/blobs/<ab>/<cd>/<sha256> (see core.blobs). Blobs no dataset
+# or job has referenced for this long are deleted by collect_unreferenced_blobs
+BLOB_GC_GRACE_HOURS = 24
+
+# Downloads (/api/datasets/<id>/download/, /api/jobs/<id>/download/, see
+# core.downloads): None streams files from Python; 'x-accel-redirect' hands
+# them to nginx, which needs an internal location at DOWNLOAD_ACCEL_PREFIX
+#   location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+# and 'x-sendfile' to Apache mod_xsendfile / lighttpd
+DOWNLOAD_OFFLOAD = config('DOWNLOAD_OFFLOAD', default=None)
+DOWNLOAD_ACCEL_PREFIX = '/protected-media/'
+
+# Columnar cache: each CSV dataset is parsed once into typed column files
+# keyed by its SHA-256, and later jobs read those instead of the CSV text
+COLUMNAR_CACHE_ENABLED = True
+COLUMNAR_CACHE_ROOT = MEDIA_ROOT / 'columnar'
+
+# Row-offset index: validate_csv records where every ROW_INDEX_INTERVAL-th row
+# starts in the CSV, so /api/datasets/<id>/rows/ can seek straight to a page
+ROW_INDEX_ROOT = MEDIA_ROOT / 'rowindex'
+ROW_INDEX_INTERVAL = 1000
+
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -108,6 +145,92 @@ CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes
 
+# Job progress writes are throttled per job: at most one every N ms,
+# and only once progress has moved by at least this many percent
+JOB_PROGRESS_MIN_INTERVAL_MS = 1000
+JOB_PROGRESS_MIN_DELTA = 1
+
+# Live progress of running jobs is kept in Redis (core.job_state) and written
+# back to Postgres every JOB_STATE_FLUSH_SECONDS; 'memory://' keeps it in-process
+JOB_STATE_URL = CELERY_BROKER_URL
+JOB_STATE_TTL_SECONDS = 24 * 60 * 60
+JOB_STATE_FLUSH_SECONDS = 10
+
+# GET /api/jobs/<id>/status/?wait=N holds the request up to this long for a
+# change (see core.polling), re-reading the job at least every RECHECK seconds
+JOB_STATUS_MAX_WAIT_SECONDS = 30
+JOB_STATUS_RECHECK_SECONDS = 5
+
+# Most jobs one POST /api/jobs/bulk/ request may submit
+JOB_BULK_MAX_JOBS = 500
+
+# Finished statistics / conversion results are cached by file content + params
+# Entries unused for MAX_AGE_DAYS are dropped, then the least recently used
+# ones until the cache fits in MAX_BYTES (see core.result_cache)
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 256 MB
+RESULT_CACHE_MAX_AGE_DAYS = 30
+
+# Job results bigger than this (as JSON) are stored compressed as a blob and
+# result_data keeps a summary + pointer (see core.result_store)
+# 'zstd' (smaller, faster) needs the zstandard package (not in requirements.txt);
+# without it gzip is used and a warning is logged
+RESULT_OFFLOAD_BYTES = 256 * 1024  # 256 KB
+RESULT_OFFLOAD_COMPRESSION = 'gzip'
+
+# Periodic tasks (run with: celery -A mlplatform beat)
+CELERY_BEAT_SCHEDULE = {
+  'evict-result-cache': {
+    'task': 'core.tasks.evict_result_cache',
+    'schedule': 60 * 60,  # hourly
+  },
+  'expire-upload-sessions': {
+    'task': 'core.tasks.expire_upload_sessions',
+    'schedule': 60 * 60,  # hourly
+  },
+  'flush-job-state': {
+    'task': 'core.tasks.flush_job_state',
+    'schedule': JOB_STATE_FLUSH_SECONDS,
+  },
+  'collect-unreferenced-blobs': {
+    'task': 'core.tasks.collect_unreferenced_blobs',
+    'schedule': 6 * 60 * 60,  # every 6 hours
+  },
+}
+
+# Renditions process_image makes from each image, in any order
+# size: (max width, max height), the aspect ratio is kept and images are never enlarged
+# format: JPEG, WEBP or PNG; saved as blobs (see core.blobs)
+IMAGE_RENDITIONS = [
+  {'name': 'resized', 'size': (800, 600), 'format': 'JPEG', 'quality': 85, 'progressive': True},
+  {'name': 'resized_webp', 'size': (800, 600), 'format': 'WEBP', 'quality': 80},
+  {'name': 'thumbnail', 'size': (200, 200), 'format': 'JPEG', 'quality': 80},
+]
+
+# Batch image jobs render this many images at once on a thread pool
+# (None = one per CPU), handing them out IMAGE_BATCH_CHUNK_SIZE at a time
+IMAGE_BATCH_WORKERS = None
+IMAGE_BATCH_CHUNK_SIZE = 256
+
+# Deep Zoom tile pyramids (build_tile_pyramid jobs), served from
+# /api/datasets/<id>/image.dzi/ and /api/datasets/<id>/image_files/...
+TILE_ROOT = MEDIA_ROOT / 'tiles'
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_FORMAT = 'jpeg'  # or 'png'
+TILE_QUALITY = 85
+TILE_WORKERS = None  # threads per job, None = one per CPU
+# Largest image (width x height) a pyramid is built for: the whole image is
+# decoded at once, ~3 bytes per pixel as RGB (300 MP -> ~900 MB)
+# Pillow also refuses images over 2 x PIL.Image.MAX_IMAGE_PIXELS (~179 MP by
+# default); raise that where the worker starts to tile bigger images
+TILE_MAX_PIXELS = 300_000_000
+
+# Statistics on files bigger than this are split into chunks and profiled in parallel
+STATS_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MB
+# Same for datasets read from the columnar cache, in rows
+STATS_CHUNK_ROWS = 1_000_000
+
 # Use ASGI instead of WSGI
 ASGI_APPLICATION = 'mlplatform.asgi.application'
 